@@ -0,0 +1,490 @@
+"""
+Persistent background jobs for large batch watermark runs.
+
+A job is a resources x schools matrix stored in watermark_jobs and
+watermark_job_items. Every API worker runs a JobRunner that claims queued
+jobs, renders the items through the render executor's batch class, records
+per-school progress and packs the outputs into a ZIP artifact that stays
+downloadable until it expires. A job whose worker stops heartbeating (for
+example after a restart) is claimed again and only its unfinished items are
+redone. Cancelled and failed jobs keep their rendered items for a resume
+until the same TTL runs out.
+"""
+import os
+import json
+import uuid
+import shutil
+import socket
+import asyncio
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+
+from sqlalchemy import update
+
+from database import SessionLocal, WatermarkJob, WatermarkJobItem, Resource, School
+from render_executor import render_executor, BATCH
+from zip_stream import compress_type_for
+
+ROOT_DIR = Path(__file__).parent
+JOBS_DIR = Path(os.environ.get('WATERMARK_JOBS_DIR', ROOT_DIR / "jobs"))
+
+JOB_ARTIFACT_TTL_HOURS = int(os.environ.get('WATERMARK_JOB_TTL_HOURS', 72))
+JOB_POLL_SECONDS = float(os.environ.get('WATERMARK_JOB_POLL_SECONDS', 2))
+JOB_HEARTBEAT_SECONDS = 15
+JOB_STALE_SECONDS = int(os.environ.get('WATERMARK_JOB_STALE_SECONDS', 60))
+
+ACTIVE_STATUSES = ('queued', 'running')
+IMAGE_TYPES = ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']
+
+
+def is_watermarkable(file_path: str, file_type: Optional[str]) -> bool:
+    file_type_lower = file_type.lower() if file_type else ''
+    return (
+        'pdf' in file_type_lower or file_path.lower().endswith('.pdf')
+        or any(img_type in file_type_lower for img_type in IMAGE_TYPES)
+    )
+
+
+def _safe_name(name: str) -> str:
+    return name.replace('/', '_').replace('\\', '_')
+
+
+def create_job(
+    db,
+    resource_ids: List[str],
+    school_ids: Union[str, List[str]],
+    positions: Dict,
+    created_by: str = 'admin'
+) -> WatermarkJob:
+    """Persist a job and one pending item per (resource, school)"""
+    resources = db.query(Resource).filter(Resource.resource_id.in_(resource_ids)).all()
+    missing = set(resource_ids) - {resource.resource_id for resource in resources}
+    if missing:
+        raise ValueError(f"Resources not found: {', '.join(sorted(missing))}")
+
+    if school_ids == 'all':
+        schools = db.query(School).order_by(School.school_id).all()
+    else:
+        schools = db.query(School).filter(School.school_id.in_(school_ids)).all()
+    if not schools:
+        raise ValueError("No schools found")
+
+    job = WatermarkJob(
+        job_id=str(uuid.uuid4()),
+        resource_ids=json.dumps(resource_ids),
+        school_ids=json.dumps(school_ids),
+        positions=json.dumps(positions),
+        status='queued',
+        total_items=len(resources) * len(schools),
+        created_by=created_by
+    )
+    db.add(job)
+
+    for resource in resources:
+        for school in schools:
+            db.add(WatermarkJobItem(
+                job_id=job.job_id,
+                resource_id=resource.resource_id,
+                school_id=school.school_id,
+                school_name=school.school_name
+            ))
+
+    db.commit()
+    db.refresh(job)
+    job_runner.wake()
+    return job
+
+
+def refresh_counts(db, job: WatermarkJob):
+    """Recompute progress counters from the item rows"""
+    items = db.query(WatermarkJobItem.status).filter(WatermarkJobItem.job_id == job.job_id).all()
+    job.completed_items = sum(1 for (item_status,) in items if item_status in ('done', 'skipped'))
+    job.failed_items = sum(1 for (item_status,) in items if item_status == 'failed')
+
+
+def cancel_job(db, job: WatermarkJob) -> bool:
+    if job.status not in ACTIVE_STATUSES:
+        return False
+    job.status = 'cancelled'
+    job.finished_at = datetime.utcnow()
+    # Rendered items are kept for a resume, but not forever
+    job.expires_at = job.finished_at + timedelta(hours=JOB_ARTIFACT_TTL_HOURS)
+    db.commit()
+    return True
+
+
+def resume_job(db, job: WatermarkJob) -> bool:
+    """Requeue a cancelled or failed job; finished items are kept, failed ones retried"""
+    if job.status not in ('cancelled', 'failed'):
+        return False
+    db.query(WatermarkJobItem).filter(
+        WatermarkJobItem.job_id == job.job_id,
+        WatermarkJobItem.status.in_(['running', 'failed'])
+    ).update({'status': 'pending', 'error': None}, synchronize_session=False)
+    job.status = 'queued'
+    job.worker_id = None
+    job.heartbeat_at = None
+    job.finished_at = None
+    job.expires_at = None
+    job.error = None
+    refresh_counts(db, job)
+    db.commit()
+    job_runner.wake()
+    return True
+
+
+class JobRunner:
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._render_fn: Optional[Callable] = None
+        self._snapshot_fn: Optional[Callable] = None
+        self._resolve_path_fn: Optional[Callable] = None
+        self._pool_fn: Optional[Callable] = None
+        self._concurrency = 1
+
+    def configure(self, render_fn: Callable, snapshot_fn: Callable, resolve_path_fn: Callable, pool_fn: Callable, concurrency: int):
+        """Wire in the render helpers that live in server.py"""
+        self._render_fn = render_fn
+        self._snapshot_fn = snapshot_fn
+        self._resolve_path_fn = resolve_path_fn
+        self._pool_fn = pool_fn
+        self._concurrency = max(1, concurrency)
+
+    def start(self):
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        # Fresh pid after a fork or restart
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run_forever(self):
+        print(f"Watermark job runner started: {self.worker_id}")
+        while True:
+            try:
+                job_id = self._claim_next()
+                if job_id:
+                    await self._run_job(job_id)
+                    continue
+                self._expire_artifacts()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Watermark job runner error: {e}")
+                import traceback
+                traceback.print_exc()
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    # ---------- claiming ----------
+
+    def _claim_next(self) -> Optional[str]:
+        """Claim the oldest queued job, or a running job whose worker went quiet"""
+        db = SessionLocal()
+        try:
+            stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+            candidates = db.query(WatermarkJob).filter(
+                (WatermarkJob.status == 'queued') |
+                ((WatermarkJob.status == 'running') & (WatermarkJob.heartbeat_at < stale_before))
+            ).order_by(WatermarkJob.created_at).limit(5).all()
+
+            for job in candidates:
+                job_id, previous_status = job.job_id, job.status
+
+                # Compare-and-swap so only one worker wins the job
+                conditions = [WatermarkJob.id == job.id, WatermarkJob.status == job.status]
+                if job.heartbeat_at is None:
+                    conditions.append(WatermarkJob.heartbeat_at.is_(None))
+                else:
+                    conditions.append(WatermarkJob.heartbeat_at == job.heartbeat_at)
+
+                now = datetime.utcnow()
+                result = db.execute(
+                    update(WatermarkJob).where(*conditions).values(
+                        status='running',
+                        worker_id=self.worker_id,
+                        heartbeat_at=now,
+                        started_at=job.started_at or now
+                    )
+                )
+                if result.rowcount != 1:
+                    db.rollback()
+                    continue
+
+                # Items left running by a previous worker start over
+                db.query(WatermarkJobItem).filter(
+                    WatermarkJobItem.job_id == job_id,
+                    WatermarkJobItem.status == 'running'
+                ).update({'status': 'pending'}, synchronize_session=False)
+                db.commit()
+
+                print(f"Claimed watermark job {job_id} (was {previous_status})")
+                return job_id
+            return None
+        finally:
+            db.close()
+
+    async def _heartbeat(self, job_id: str):
+        """Keep the job's heartbeat fresh; returns once it has been failing for JOB_STALE_SECONDS"""
+        last_beat = datetime.utcnow()
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            db = SessionLocal()
+            try:
+                db.execute(
+                    update(WatermarkJob)
+                    .where(WatermarkJob.job_id == job_id, WatermarkJob.worker_id == self.worker_id)
+                    .values(heartbeat_at=datetime.utcnow())
+                )
+                db.commit()
+                last_beat = datetime.utcnow()
+            except Exception as e:
+                # e.g. SQLite's "database is locked"; the next beat usually gets through
+                db.rollback()
+                print(f"Job {job_id}: heartbeat failed: {e}")
+                if datetime.utcnow() - last_beat >= timedelta(seconds=JOB_STALE_SECONDS):
+                    # Another worker may claim the job as stale now; stop so it isn't rendered twice
+                    print(f"Job {job_id}: no heartbeat for {JOB_STALE_SECONDS}s, giving the job up")
+                    return
+            finally:
+                db.close()
+
+    # ---------- running ----------
+
+    async def _run_job(self, job_id: str):
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        db = SessionLocal()
+        try:
+            job = db.query(WatermarkJob).filter(WatermarkJob.job_id == job_id).first()
+            positions = json.loads(job.positions)
+            job_dir = JOBS_DIR / job_id / "items"
+            job_dir.mkdir(parents=True, exist_ok=True)
+
+            items = db.query(WatermarkJobItem).filter(
+                WatermarkJobItem.job_id == job_id,
+                WatermarkJobItem.status == 'pending'
+            ).order_by(WatermarkJobItem.id).all()
+
+            resources = {}
+            schools = {}
+            pending = iter(items)
+            in_flight = {}
+            cancelled = False
+
+            def still_active() -> bool:
+                if heartbeat.done():
+                    return False  # The job may already belong to another worker
+                db.refresh(job)
+                return job.status == 'running' and job.worker_id == self.worker_id
+
+            def resolve_resource(resource_id):
+                if resource_id not in resources:
+                    resource = db.query(Resource).filter(Resource.resource_id == resource_id).first()
+                    if resource:
+                        # The job's branding mode, or else each resource's own
+                        resource_positions = dict(
+                            positions,
+                            branding_mode=positions.get('branding_mode') or resource.branding_mode,
+                            branding_interval=positions.get('branding_interval') or resource.branding_interval
+                        )
+                        resources[resource_id] = (self._resolve_path_fn(resource.file_path), resource.file_type, resource_positions)
+                    else:
+                        resources[resource_id] = (None, None, positions)
+                return resources[resource_id]
+
+            def resolve_school(school_id):
+                if school_id not in schools:
+                    school = db.query(School).filter(School.school_id == school_id).first()
+                    schools[school_id] = self._snapshot_fn(school) if school else None
+                return schools[school_id]
+
+            def submit_next():
+                for item in pending:
+                    try:
+                        file_path, file_type, item_positions = resolve_resource(item.resource_id)
+                        school = resolve_school(item.school_id)
+                        if not file_path or not school:
+                            raise FileNotFoundError("Resource file or school no longer exists")
+                    except Exception as e:
+                        item.status = 'failed'
+                        item.error = str(e)
+                        db.commit()
+                        continue
+
+                    if not is_watermarkable(file_path, file_type):
+                        # Identical for every school; the artifact carries the original once
+                        item.status = 'skipped'
+                        db.commit()
+                        continue
+
+                    item.status = 'running'
+                    db.commit()
+                    task = asyncio.ensure_future(render_executor.run(
+                        self._render_fn, file_path, file_type, school, item_positions,
+                        str(job_dir / str(item.id)),
+                        priority=BATCH, executor=self._pool_fn(), enforce_queue_limit=False
+                    ))
+                    in_flight[task] = item
+                    return
+
+            for _ in range(self._concurrency):
+                submit_next()
+
+            try:
+                while in_flight:
+                    # Wake on the heartbeat too, to stop promptly if it gives up
+                    done, _ = await asyncio.wait([*in_flight, heartbeat], return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task is heartbeat:
+                            continue
+                        item = in_flight.pop(task)
+                        try:
+                            output = task.result()
+                            if not output or not os.path.exists(output):
+                                raise RuntimeError("Watermarking produced no output")
+                            item.output_path = output
+                            item.status = 'done'
+                            item.error = None
+                        except Exception as e:
+                            print(f"Job {job_id}: item {item.resource_id}/{item.school_id} failed: {e}")
+                            item.status = 'failed'
+                            item.error = str(e)
+
+                        refresh_counts(db, job)
+                        db.commit()
+
+                    if not still_active():
+                        cancelled = True
+                        break
+                    while len(in_flight) < self._concurrency:
+                        before = len(in_flight)
+                        submit_next()
+                        if len(in_flight) == before:
+                            break
+            finally:
+                for task, item in in_flight.items():
+                    task.cancel()
+                    item.status = 'pending'
+                db.commit()
+
+            if cancelled or not still_active():
+                print(f"Job {job_id} stopped ({job.status})")
+                return
+
+            refresh_counts(db, job)
+            if job.completed_items == 0:
+                job.status = 'failed'
+                job.error = "No items were processed successfully"
+                job.expires_at = datetime.utcnow() + timedelta(hours=JOB_ARTIFACT_TTL_HOURS)
+            else:
+                artifact_path = await asyncio.get_running_loop().run_in_executor(
+                    None, self._build_artifact, job_id
+                )
+                job.artifact_path = str(artifact_path)
+                job.artifact_size = os.path.getsize(artifact_path)
+                job.status = 'completed'
+                job.expires_at = datetime.utcnow() + timedelta(hours=JOB_ARTIFACT_TTL_HOURS)
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+            job.finished_at = datetime.utcnow()
+            db.commit()
+            print(f"Job {job_id} {job.status}: {job.completed_items} done, {job.failed_items} failed")
+
+        except Exception as e:
+            db.rollback()
+            print(f"Job {job_id} failed: {e}")
+            job = db.query(WatermarkJob).filter(WatermarkJob.job_id == job_id).first()
+            if job and job.status == 'running':
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_at = datetime.utcnow()
+                job.expires_at = job.finished_at + timedelta(hours=JOB_ARTIFACT_TTL_HOURS)
+                db.commit()
+        finally:
+            heartbeat.cancel()
+            db.close()
+
+    def _build_artifact(self, job_id: str) -> Path:
+        """Pack finished items into one ZIP, grouped by resource then school"""
+        db = SessionLocal()
+        try:
+            items = db.query(WatermarkJobItem).filter(
+                WatermarkJobItem.job_id == job_id,
+                WatermarkJobItem.status.in_(['done', 'skipped'])
+            ).order_by(WatermarkJobItem.id).all()
+
+            artifact_path = JOBS_DIR / job_id / f"watermark_job_{job_id[:8]}.zip"
+            originals_added = set()
+
+            with zipfile.ZipFile(artifact_path, 'w', allowZip64=True) as zipf:
+                for item in items:
+                    resource = db.query(Resource).filter(Resource.resource_id == item.resource_id).first()
+                    resource_name = (resource.name if resource else item.resource_id).replace(' ', '_')
+                    resource_folder = _safe_name(resource_name)
+
+                    if item.status == 'skipped':
+                        if item.resource_id in originals_added or not resource:
+                            continue
+                        file_path = self._resolve_path_fn(resource.file_path)
+                        arcname = f"{resource_folder}/{resource_name}{os.path.splitext(file_path)[1]}"
+                        zipf.write(file_path, arcname, compress_type=compress_type_for(arcname))
+                        originals_added.add(item.resource_id)
+                        continue
+
+                    school_name = item.school_name or item.school_id
+                    ext = os.path.splitext(item.output_path)[1]
+                    arcname = f"{resource_folder}/{_safe_name(school_name)}/{resource_name}_{school_name.replace(' ', '_')}_branded{ext}"
+                    zipf.write(item.output_path, arcname, compress_type=compress_type_for(arcname))
+
+            return artifact_path
+        finally:
+            db.close()
+
+    # ---------- expiry ----------
+
+    def _expire_artifacts(self):
+        """Remove the artifacts of completed jobs, and the kept items of cancelled or failed ones, past their TTL"""
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            expired = db.query(WatermarkJob).filter(
+                WatermarkJob.status.in_(['completed', 'cancelled', 'failed']),
+                (WatermarkJob.expires_at < now) | (
+                    # Stopped before stopped jobs were given an expiry
+                    WatermarkJob.expires_at.is_(None)
+                    & WatermarkJob.status.in_(['cancelled', 'failed'])
+                    & (WatermarkJob.finished_at < now - timedelta(hours=JOB_ARTIFACT_TTL_HOURS))
+                )
+            ).all()
+            for job in expired:
+                shutil.rmtree(JOBS_DIR / job.job_id, ignore_errors=True)
+                print(f"Expired {job.status} job {job.job_id}")
+                job.status = 'expired'
+                job.artifact_path = None
+            if expired:
+                db.commit()
+        finally:
+            db.close()
+
+
+job_runner = JobRunner()
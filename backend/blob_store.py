@@ -0,0 +1,137 @@
+"""
+Content-addressed storage for uploaded resource files.
+
+Each distinct file is stored once under
+uploads/resources/blobs/<aa>/<bb>/<sha256>.<ext>, so the same worksheet
+uploaded by several schools (or re-uploaded by the admin) shares one file on
+disk. Resource.file_path points at the blob; the number of Resource rows
+pointing at a path is its reference count, and the blob is unlinked when the
+last of them is deleted.
+
+Committing a blob and releasing it are serialized per blob with a BlobLock:
+an upload holds it from commit_blob until its Resource row is committed, and
+release_file holds it across the reference count and the unlink, so a
+deduplicated upload can never end up pointing at a blob deleted under it.
+"""
+import os
+import fcntl
+from pathlib import Path
+from typing import Optional
+
+from database import Resource
+from thumbnails import remove_thumbnails
+
+ROOT_DIR = Path(__file__).parent
+UPLOADS_DIR = ROOT_DIR / "uploads"
+BLOBS_DIR = UPLOADS_DIR / "resources" / "blobs"
+STAGING_DIR = BLOBS_DIR / ".staging"
+LOCKS_DIR = BLOBS_DIR / ".locks"
+
+
+class BlobLock:
+    """Exclusive lock on one blob across processes, taken on creation; blocking.
+
+    Held between calls (an upload keeps it until its row is committed), so it
+    is a plain object with release() as well as a context manager.
+    """
+
+    def __init__(self, name: str):
+        LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+        self._path = LOCKS_DIR / f"{name}.lock"
+        while True:
+            self._file = open(self._path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                # The previous holder removes the file on release; retry on a fresh one if so
+                if os.fstat(self._file.fileno()).st_ino == os.stat(self._path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            self._file.close()
+
+    def release(self):
+        if self._file is None:
+            return
+        self._path.unlink(missing_ok=True)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _clean_extension(file_extension: Optional[str]) -> str:
+    file_extension = (file_extension or '').strip('.').lower()
+    # Extensions come from client filenames; keep them to something path-safe
+    if not file_extension or not file_extension.isalnum() or len(file_extension) > 10:
+        return 'bin'
+    return file_extension
+
+
+def blob_relative_path(sha256: str, file_extension: Optional[str]) -> str:
+    """Public file_path of a blob, as stored on Resource"""
+    return f"/uploads/resources/blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.{_clean_extension(file_extension)}"
+
+
+def blob_disk_path(file_path: str) -> Path:
+    return ROOT_DIR / file_path.lstrip('/')
+
+
+def new_staging_path(name: str) -> Path:
+    """Staging location on the blob filesystem, so commits are plain renames"""
+    STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    return STAGING_DIR / name
+
+
+def commit_blob(staging_path: Path, sha256: str, file_extension: Optional[str]) -> str:
+    """Move a fully written, hashed file into the store and return its file_path.
+
+    If the content is already stored the staging file is dropped and the
+    existing blob is shared. Call with the blob's BlobLock held, and keep it
+    until the row referencing the blob is committed.
+    """
+    file_path = blob_relative_path(sha256, file_extension)
+    disk_path = blob_disk_path(file_path)
+
+    if disk_path.exists():
+        os.remove(staging_path)
+        print(f"Deduplicated upload into existing blob {file_path}")
+    else:
+        disk_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staging_path, disk_path)
+    return file_path
+
+
+def reference_count(db, file_path: str) -> int:
+    return db.query(Resource).filter(Resource.file_path == file_path).count()
+
+
+def release_file(db, file_path: str) -> bool:
+    """Unlink a resource file once no Resource references it; True if removed.
+
+    Call after the referencing row has been deleted and committed. Blocks
+    while an upload of the same content holds the blob's lock, so call it
+    through run_in_threadpool from async code.
+    """
+    disk_path = blob_disk_path(file_path)
+    # Blob file names are their sha256, as passed to BlobLock by uploads
+    with BlobLock(disk_path.stem):
+        if reference_count(db, file_path) > 0:
+            return False
+        if not disk_path.exists():
+            return False
+        disk_path.unlink()
+    remove_thumbnails(str(disk_path))
+
+    # Tidy empty fan-out directories
+    for parent in (disk_path.parent, disk_path.parent.parent):
+        if parent == BLOBS_DIR or not parent.is_relative_to(BLOBS_DIR):
+            break
+        try:
+            parent.rmdir()
+        except OSError:
+            break
+    return True
@@ -87,6 +87,7 @@ class Resource(Base):
     file_path = Column(String(1000), nullable=False)
     file_type = Column(String(50), nullable=False)  # 'pdf', 'doc', 'video', etc.
     file_size = Column(Integer, nullable=False)  # Size in bytes
+    file_sha256 = Column(String(64), nullable=True, index=True)  # Content hash, computed at upload
     class_level = Column(String(100), nullable=True)  # 'Nursery', 'LKG', 'UKG', etc.
     tags = Column(Text, nullable=True)  # Comma-separated tags
     uploaded_by_type = Column(String(50), nullable=False)  # 'admin' or 'school'
@@ -94,6 +95,8 @@ class Resource(Base):
     uploaded_by_name = Column(String(255), nullable=True)  # school name if uploaded by school
     approval_status = Column(String(50), default='approved')  # 'pending', 'approved', 'rejected'
     download_count = Column(Integer, default=0)
+    branding_mode = Column(String(20), default='every_page')  # Pages of a PDF that are branded, see watermark_stamp
+    branding_interval = Column(Integer, default=1)  # N for 'every_nth'
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -209,6 +212,10 @@ class AdminResourceWatermark(Base):
     contact_size = Column(Integer, default=12)
     contact_opacity = Column(Float, default=0.8)
     
+    # Branding mode; NULL uses the resource's
+    branding_mode = Column(String(20), nullable=True)
+    branding_interval = Column(Integer, nullable=True)
+    
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -240,6 +247,73 @@ class SchoolWatermarkText(Base):
         UniqueConstraint('school_id', 'resource_id', name='unique_school_resource_text'),
     )
 
+# Watermark Job Model - background batch watermarking runs
+class WatermarkJob(Base):
+    __tablename__ = "watermark_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(100), unique=True, nullable=False, index=True)
+    resource_ids = Column(Text, nullable=False)  # JSON list of resource_ids
+    school_ids = Column(Text, nullable=False)  # JSON list of school_ids, or "all"
+    positions = Column(Text, nullable=False)  # JSON WatermarkPosition
+    status = Column(String(50), default='queued', index=True)  # 'queued', 'running', 'completed', 'failed', 'cancelled', 'expired'
+    total_items = Column(Integer, default=0)
+    completed_items = Column(Integer, default=0)
+    failed_items = Column(Integer, default=0)
+    artifact_path = Column(String(1000), nullable=True)  # ZIP of all outputs once completed
+    artifact_size = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    worker_id = Column(String(100), nullable=True)  # Worker currently running the job
+    heartbeat_at = Column(DateTime, nullable=True)
+    created_by = Column(String(100), default='admin')
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True)  # Artifact is deleted after this
+
+# Watermark Job Item Model - one resource for one school within a job
+class WatermarkJobItem(Base):
+    __tablename__ = "watermark_job_items"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(100), nullable=False, index=True)
+    resource_id = Column(String(100), nullable=False)
+    school_id = Column(String(100), nullable=False)
+    school_name = Column(String(255), nullable=True)
+    status = Column(String(50), default='pending', index=True)  # 'pending', 'running', 'done', 'failed', 'skipped'
+    output_path = Column(String(1000), nullable=True)
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('job_id', 'resource_id', 'school_id', name='unique_job_resource_school'),
+    )
+
+# Upload Session Model - resumable chunked uploads of large resources
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    upload_id = Column(String(100), unique=True, nullable=False, index=True)
+    name = Column(String(500), nullable=False)
+    category = Column(String(100), nullable=False)
+    description = Column(Text, nullable=True)
+    class_level = Column(String(100), nullable=True)
+    tags = Column(Text, nullable=True)
+    file_name = Column(String(500), nullable=False)  # Original filename, for the extension
+    file_type = Column(String(100), nullable=True)
+    total_size = Column(Integer, nullable=False)  # Declared size in bytes
+    offset = Column(Integer, default=0)  # Bytes received so far
+    uploaded_by_type = Column(String(50), nullable=False)  # 'admin' or 'school'
+    uploaded_by_id = Column(String(100), nullable=True)
+    uploaded_by_name = Column(String(255), nullable=True)
+    status = Column(String(50), default='uploading', index=True)  # 'uploading', 'finalizing', 'completed'
+    resource_id = Column(String(100), nullable=True)  # Set once finalized
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True)  # Unfinished sessions are dropped after this
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,325 @@
+"""
+File responses with HTTP validators and byte ranges.
+
+Starlette's FileResponse always sends the whole file with a status of 200.
+file_response wraps it to add strong ETags, 304 Not Modified for
+If-None-Match / If-Modified-Since, and 206 Partial Content for single and
+multi-range requests (multipart/byteranges). Video seeking and PDF viewers
+then only fetch the bytes they need.
+
+deliver_file can instead hand the transfer to nginx (FILE_DELIVERY_MODE):
+  app     - Python streams the file (default, and for local development)
+  accel   - X-Accel-Redirect to an internal nginx location
+  signed  - 302 to an HMAC-signed, expiring /api/signed-files/ URL that nginx
+            verifies itself (deploy/nginx/njs/signed_files.js); the API route
+            of the same path is a stand-in verifier when nginx is not in front
+"""
+import os
+import sys
+import hmac
+import time
+import uuid
+import hashlib
+from pathlib import Path
+from urllib.parse import quote, urlencode
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+from fastapi import Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse, RedirectResponse
+
+ROOT_DIR = Path(__file__).parent
+
+CHUNK_SIZE = 64 * 1024
+
+DELIVERY_MODE = os.environ.get('FILE_DELIVERY_MODE', 'app')  # 'app', 'accel' or 'signed'
+ACCEL_REDIRECT_PREFIX = os.environ.get('FILE_ACCEL_REDIRECT_PREFIX', '/internal-files/')
+SIGNED_URL_PREFIX = '/api/signed-files/'
+SIGNED_URL_TTL_SECONDS = int(os.environ.get('FILE_SIGNED_URL_TTL_SECONDS', 300))
+SIGNING_KEY = os.environ.get('FILE_SIGNING_KEY') or os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
+
+# More ranges than this in one request is treated as abuse and answered in full
+MAX_RANGES = 16
+
+# Headers a 304 must repeat from the 200 it stands in for
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'expires', 'vary')
+
+
+def make_etag(stat_result: os.stat_result, content_hash: Optional[str] = None) -> str:
+    """Strong ETag from the content hash when known, otherwise from mtime and size"""
+    if content_hash:
+        return f'"{content_hash}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    candidates = [value.strip().removeprefix('W/') for value in header.split(',')]
+    return etag in candidates
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since is None:
+        return False
+    return int(mtime) <= since.timestamp()
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        return _not_modified_since(if_modified_since, mtime)
+    return False
+
+
+def _if_range_matches(request: Request, etag: str, mtime: float) -> bool:
+    """False if If-Range names an older version, in which case the full file is sent"""
+    if_range = request.headers.get('if-range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Strong comparison only
+        return if_range == etag
+    return _not_modified_since(if_range, mtime)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse a Range header into sorted, merged inclusive (start, end) pairs.
+
+    Returns None when the header is absent or malformed (send the whole file)
+    and an empty list when no range is satisfiable (416).
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start_text, sep, end_text = part.partition('-')
+        if not sep:
+            return None
+        start_text, end_text = start_text.strip(), end_text.strip()
+        try:
+            if not start_text:
+                # Suffix range: the last N bytes
+                length = int(end_text)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+            else:
+                start = int(start_text)
+                end = int(end_text) if end_text else size - 1
+                if end_text and end < start:
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+async def _read_ranges(path: str, ranges: List[Tuple[int, int]], parts: Optional[List[Tuple[bytes, bytes]]] = None):
+    async with await anyio.open_file(path, mode='rb') as file:
+        for index, (start, end) in enumerate(ranges):
+            if parts is not None:
+                yield parts[index][0]
+            await file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            if parts is not None:
+                yield parts[index][1]
+
+
+def file_response(
+    request: Request,
+    path: str,
+    media_type: str,
+    headers: Optional[Dict[str, str]] = None,
+    content_hash: Optional[str] = None,
+) -> Response:
+    """Serve a file honouring If-None-Match, If-Modified-Since, Range and If-Range"""
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    etag = make_etag(stat_result, content_hash)
+
+    headers = dict(headers or {})
+    headers['ETag'] = etag
+    headers['Last-Modified'] = formatdate(stat_result.st_mtime, usegmt=True)
+    headers['Accept-Ranges'] = 'bytes'
+
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        kept = {
+            name: value for name, value in headers.items()
+            if name.lower() in NOT_MODIFIED_HEADERS or name in ('ETag', 'Last-Modified')
+        }
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=kept)
+
+    ranges = parse_range(request.headers.get('range'), size)
+    if ranges is not None and _if_range_matches(request, etag, stat_result.st_mtime):
+        if not ranges:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'Content-Range': f"bytes */{size}", 'Accept-Ranges': 'bytes'}
+            )
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+            headers['Content-Length'] = str(end - start + 1)
+            return StreamingResponse(
+                _read_ranges(path, ranges),
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type=media_type,
+                headers=headers
+            )
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        content_length = 0
+        for start, end in ranges:
+            head = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode('latin-1')
+            parts.append((head, b"\r\n"))
+            content_length += len(head) + (end - start + 1) + 2
+        closing = f"--{boundary}--\r\n".encode('latin-1')
+        content_length += len(closing)
+
+        async def multipart_body():
+            async for chunk in _read_ranges(path, ranges, parts):
+                yield chunk
+            yield closing
+
+        headers['Content-Length'] = str(content_length)
+        return StreamingResponse(
+            multipart_body(),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=f"multipart/byteranges; boundary={boundary}",
+            headers=headers
+        )
+
+    return FileResponse(
+        path=path,
+        media_type=media_type,
+        headers=headers,
+        stat_result=stat_result
+    )
+
+
+class TempFileResponse(FileResponse):
+    """FileResponse for a one-off rendered file, deleted once sent or the client goes away"""
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def counts_as_download(request: Request, response: Response) -> bool:
+    """Whether a response starts a new download, so range continuations and 304s aren't logged twice"""
+    if response.status_code not in (
+        status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT, status.HTTP_302_FOUND
+    ):
+        return False
+    # Ranges may be answered by nginx after an X-Accel-Redirect, so look at the request
+    ranges = parse_range(request.headers.get('range'), sys.maxsize)
+    return not ranges or ranges[0][0] == 0
+
+
+# ---------- delivery through nginx ----------
+
+def sign_file_path(uri: str, expires: int) -> str:
+    """HMAC-SHA256 over expiry and decoded request path, as checked by nginx"""
+    message = f"{expires}:{uri}".encode('utf-8')
+    return hmac.new(SIGNING_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def verify_file_signature(uri: str, expires: int, signature: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign_file_path(uri, expires), signature or '')
+
+
+def signed_file_url(relative_path: str, filename: Optional[str] = None, inline: bool = False) -> str:
+    expires = int(time.time()) + SIGNED_URL_TTL_SECONDS
+    uri = SIGNED_URL_PREFIX + relative_path
+    params = {'expires': expires, 'signature': sign_file_path(uri, expires)}
+    if filename:
+        params['filename'] = filename
+    if inline:
+        params['inline'] = 1
+    return f"{quote(uri)}?{urlencode(params, quote_via=quote)}"
+
+
+def _relative_to_root(path: str) -> Optional[str]:
+    try:
+        return Path(path).resolve().relative_to(ROOT_DIR.resolve()).as_posix()
+    except ValueError:
+        return None
+
+
+def deliver_file(
+    request: Request,
+    path: str,
+    media_type: str,
+    headers: Optional[Dict[str, str]] = None,
+    content_hash: Optional[str] = None,
+    filename: Optional[str] = None,
+    inline: bool = False,
+) -> Response:
+    """Send a file the way FILE_DELIVERY_MODE says; Python only streams it in 'app' mode"""
+    relative_path = _relative_to_root(path)
+    if DELIVERY_MODE == 'app' or relative_path is None:
+        return file_response(request, path, media_type, headers=headers, content_hash=content_hash)
+
+    if DELIVERY_MODE == 'signed':
+        return RedirectResponse(
+            signed_file_url(relative_path, filename, inline),
+            status_code=status.HTTP_302_FOUND,
+            headers={'Cache-Control': 'no-store'}
+        )
+
+    # accel: nginx keeps Content-Type, Content-Disposition and Cache-Control from this
+    # response and serves the body (ranges, validators) itself
+    headers = dict(headers or {})
+    headers['X-Accel-Redirect'] = quote(ACCEL_REDIRECT_PREFIX + relative_path)
+    return Response(status_code=status.HTTP_200_OK, media_type=media_type, headers=headers)
@@ -0,0 +1,70 @@
+"""
+Fonts and text measurement for image watermarks.
+
+Fonts are looked up once per process and cached by (face, size); measured
+text extents are cached by (text, face, size), so laying out the school name
+and contact lines is a dict lookup after the first render. Faces are searched
+in FONT_DIR (default backend/fonts, for fonts shipped with the app), then by
+file name in the system font directories (the Docker images install DejaVu),
+and finally fall back to Pillow's built-in scalable default font.
+"""
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+ROOT_DIR = Path(__file__).parent
+FONT_DIR = Path(os.environ.get('FONT_DIR', ROOT_DIR / "fonts"))
+
+FONT_FILES = {
+    'regular': ("DejaVuSans.ttf", "LiberationSans-Regular.ttf", "Arial.ttf", "arial.ttf"),
+    'bold': ("DejaVuSans-Bold.ttf", "LiberationSans-Bold.ttf", "Arial Bold.ttf", "arialbd.ttf"),
+}
+
+# Scratch surface for measuring text; ImageDraw keeps no per-call state for textbbox
+_measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+_measure_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def font_file(face: str = 'regular') -> Optional[str]:
+    """Path (or system font name) of the first available file for a face, None if there is none"""
+    for name in FONT_FILES.get(face, FONT_FILES['regular']):
+        candidate = FONT_DIR / name
+        if candidate.exists():
+            return str(candidate)
+        try:
+            # Pillow searches the platform font directories for bare file names
+            ImageFont.truetype(name, 10)
+            return name
+        except OSError:
+            continue
+    print(f"No TrueType font found for '{face}', using Pillow's default font")
+    return None
+
+
+@lru_cache(maxsize=256)
+def get_font(size: int, face: str = 'regular') -> ImageFont.ImageFont:
+    size = max(1, int(size))
+    path = font_file(face)
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=4096)
+def text_bbox(text: str, size: int, face: str = 'regular') -> Tuple[int, int, int, int]:
+    """Bounding box of text drawn at (0, 0); multi-line text is measured as drawn by multiline_text"""
+    font = get_font(size, face)
+    with _measure_lock:
+        if '\n' in text:
+            return _measure_draw.multiline_textbbox((0, 0), text, font=font)
+        return _measure_draw.textbbox((0, 0), text, font=font)
+
+
+def text_size(text: str, size: int, face: str = 'regular') -> Tuple[int, int]:
+    left, top, right, bottom = text_bbox(text, size, face)
+    return right - left, bottom - top
@@ -0,0 +1,65 @@
+"""
+Tile compositing for image watermarks.
+
+Instead of drawing the logo and text onto a transparent layer the size of the
+image and alpha-compositing the whole canvas, each stamp element is rendered
+into its own small RGBA tile and blended into the base image in place, over
+just the pixels it covers. Memory and CPU then scale with the stamp, not the
+image.
+"""
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from font_registry import get_font, text_bbox
+
+
+class StampTile(NamedTuple):
+    x: int
+    y: int
+    image: Image.Image  # RGBA
+
+
+def text_tile(x: int, y: int, text: str, size: int, fill, align: str = 'left') -> StampTile:
+    """Tile holding text as ImageDraw would draw it with its top-left at (x, y)"""
+    left, top, right, bottom = text_bbox(text, size)
+    tile = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tile)
+    if '\n' in text:
+        draw.multiline_text((-left, -top), text, font=get_font(size), fill=fill, align=align)
+    else:
+        draw.text((-left, -top), text, font=get_font(size), fill=fill)
+    return StampTile(x + left, y + top, tile)
+
+
+def composite_tiles(base: Image.Image, tiles: Iterable[StampTile]) -> Image.Image:
+    """Alpha-blend tiles onto an RGB or RGBA base in place, clipped to its bounds"""
+    if base.mode not in ('RGB', 'RGBA'):
+        raise ValueError(f"Cannot composite onto a {base.mode} image")
+
+    for x, y, tile in tiles:
+        # Clip the tile to the base image
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(base.width, x + tile.width), min(base.height, y + tile.height)
+        if right <= left or bottom <= top:
+            continue
+
+        box = (left, top, right, bottom)
+        src = np.asarray(tile.crop((left - x, top - y, right - x, bottom - y)), dtype=np.float32) / 255.0
+        dst = np.asarray(base.crop(box), dtype=np.float32) / 255.0
+        src_alpha = src[..., 3:4]
+
+        if base.mode == 'RGB':
+            out = src[..., :3] * src_alpha + dst * (1.0 - src_alpha)
+        else:
+            # Porter-Duff "over" with a translucent base
+            dst_alpha = dst[..., 3:4]
+            out_alpha = src_alpha + dst_alpha * (1.0 - src_alpha)
+            color = src[..., :3] * src_alpha + dst[..., :3] * dst_alpha * (1.0 - src_alpha)
+            color = np.divide(color, out_alpha, out=np.zeros_like(color), where=out_alpha > 0)
+            out = np.concatenate((color, out_alpha), axis=-1)
+
+        pixels = np.clip(out * 255.0 + 0.5, 0, 255).astype(np.uint8)
+        base.paste(Image.fromarray(pixels), box)
+    return base
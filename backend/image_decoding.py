@@ -0,0 +1,68 @@
+"""
+Memory-bounded decoding of uploaded images for watermarking.
+
+Phone photos and scanned posters can be 40MP or more, and several branded
+downloads of them may render at once. Every render gets a pixel budget
+(WATERMARK_IMAGE_PIXEL_BUDGET): larger images are scaled down while they are
+decoded rather than afterwards. JPEGs are decoded straight at 1/2, 1/4 or 1/8
+scale with draft(), so the full-resolution bitmap never exists; other formats
+are decoded once and then reduced and converted to RGB in horizontal strips,
+so no second full-size copy is made. Images past WATERMARK_IMAGE_MAX_PIXELS
+are refused before decoding.
+"""
+import math
+import os
+from typing import Optional
+
+from PIL import Image
+
+# Largest working image a single render may hold
+IMAGE_PIXEL_BUDGET = int(os.environ.get('WATERMARK_IMAGE_PIXEL_BUDGET', 24_000_000))
+# Refuse anything larger before decoding
+IMAGE_MAX_PIXELS = int(os.environ.get('WATERMARK_IMAGE_MAX_PIXELS', 200_000_000))
+# Rows of output produced per strip when reducing
+STRIP_ROWS = 256
+
+# Pillow warns past MAX_IMAGE_PIXELS and raises DecompressionBombError at twice it
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS // 2
+
+
+def _reduce_in_strips(image: Image.Image, factor: int) -> Image.Image:
+    """Shrink by an integer factor and convert to RGB a strip at a time"""
+    width, height = image.size
+    output = Image.new('RGB', (math.ceil(width / factor), math.ceil(height / factor)))
+    if 'icc_profile' in image.info:
+        output.info['icc_profile'] = image.info['icc_profile']
+    step = STRIP_ROWS * factor
+    for top in range(0, height, step):
+        strip = image.crop((0, top, width, min(height, top + step)))
+        if strip.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            strip = strip.convert('RGBA' if 'transparency' in image.info or strip.mode == 'PA' else 'RGB')
+        if factor > 1:
+            strip = strip.reduce(factor)
+        output.paste(strip.convert('RGB'), (0, top // factor))
+    return output
+
+
+def open_rgb_bounded(path: str, max_pixels: Optional[int] = None) -> Image.Image:
+    """Decode an image as RGB, scaled down so it holds at most max_pixels pixels"""
+    max_pixels = max_pixels or IMAGE_PIXEL_BUDGET
+    image = Image.open(path)
+    width, height = image.size
+
+    if width * height > max_pixels and image.format == 'JPEG':
+        # Decode at the largest DCT reduction (1/2, 1/4, 1/8) that isn't smaller than the target
+        factor = math.ceil(math.sqrt(width * height / max_pixels))
+        image.draft('RGB', (math.ceil(width / factor), math.ceil(height / factor)))
+        print(f"Decoding {width}x{height} JPEG at {image.size}")
+        width, height = image.size
+
+    if width * height <= max_pixels:
+        if image.mode != 'RGB':
+            return image.convert('RGB')
+        image.load()
+        return image
+
+    factor = math.ceil(math.sqrt(width * height / max_pixels))
+    print(f"Reducing {width}x{height} image by {factor} to fit the pixel budget")
+    return _reduce_in_strips(image, factor)
@@ -0,0 +1,55 @@
+"""
+Encoder profiles for watermarked images.
+
+A branded image is written in the format it was uploaded in rather than
+always as PNG: JPEG stays a progressive, optimized JPEG, WebP stays WebP, and
+PNG (and anything Pillow can read but should not write lossy, such as GIF,
+BMP or TIFF) becomes an optimized PNG. Each profile carries the extension and
+Content-Type the rendered file is served with.
+"""
+import os
+from typing import Any, BinaryIO, Dict, NamedTuple, Optional
+
+from PIL import Image
+
+JPEG_QUALITY = int(os.environ.get('WATERMARK_JPEG_QUALITY', 85))
+WEBP_QUALITY = int(os.environ.get('WATERMARK_WEBP_QUALITY', 85))
+
+
+class EncoderProfile(NamedTuple):
+    format: str
+    extension: str
+    media_type: str
+    options: Dict[str, Any]
+
+
+JPEG_PROFILE = EncoderProfile('JPEG', '.jpg', 'image/jpeg', {
+    'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True,
+})
+WEBP_PROFILE = EncoderProfile('WEBP', '.webp', 'image/webp', {
+    'quality': WEBP_QUALITY, 'method': 4,
+})
+PNG_PROFILE = EncoderProfile('PNG', '.png', 'image/png', {
+    'optimize': True,
+})
+
+
+def image_profile(file_path: str, file_type: Optional[str]) -> EncoderProfile:
+    """Encoder profile for a watermarked copy of an uploaded image"""
+    file_type_lower = file_type.lower() if file_type else ''
+    extension = os.path.splitext(file_path)[1].lower()
+    if 'jpeg' in file_type_lower or 'jpg' in file_type_lower or extension in ('.jpg', '.jpeg'):
+        return JPEG_PROFILE
+    if 'webp' in file_type_lower or extension == '.webp':
+        return WEBP_PROFILE
+    return PNG_PROFILE
+
+
+def encode_image(image: Image.Image, output: BinaryIO, profile: EncoderProfile):
+    """Save an RGB image to output with the profile's encoder settings"""
+    options = dict(profile.options)
+    # Keep the source's colour profile so colours don't shift in the re-encode
+    icc_profile = image.info.get('icc_profile')
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    image.save(output, format=profile.format, **options)
@@ -47,6 +47,40 @@ def migrate_database():
                 print(f"  Note: {e}")
                 print("  Column might already exist or SQLite limitation encountered")
         
+        resource_columns = [col['name'] for col in inspector.get_columns('resources')]
+        if 'file_sha256' not in resource_columns:
+            print("Migrating database to add file_sha256 field to resources table...")
+            try:
+                db.execute(text("ALTER TABLE resources ADD COLUMN file_sha256 VARCHAR(64)"))
+                db.commit()
+                print("✓ Added file_sha256 column to resources table")
+            except Exception as e:
+                print(f"  Note: {e}")
+                print("  Column might already exist or SQLite limitation encountered")
+        
+        if 'branding_mode' not in resource_columns:
+            print("Migrating database to add branding mode fields to resources table...")
+            try:
+                db.execute(text("ALTER TABLE resources ADD COLUMN branding_mode VARCHAR(20) DEFAULT 'every_page'"))
+                db.execute(text("ALTER TABLE resources ADD COLUMN branding_interval INTEGER DEFAULT 1"))
+                db.commit()
+                print("✓ Added branding_mode and branding_interval columns to resources table")
+            except Exception as e:
+                print(f"  Note: {e}")
+                print("  Column might already exist or SQLite limitation encountered")
+        
+        template_columns = [col['name'] for col in inspector.get_columns('admin_resource_watermarks')]
+        if 'branding_mode' not in template_columns:
+            print("Migrating database to add branding mode fields to admin_resource_watermarks table...")
+            try:
+                db.execute(text("ALTER TABLE admin_resource_watermarks ADD COLUMN branding_mode VARCHAR(20)"))
+                db.execute(text("ALTER TABLE admin_resource_watermarks ADD COLUMN branding_interval INTEGER"))
+                db.commit()
+                print("✓ Added branding_mode and branding_interval columns to admin_resource_watermarks table")
+            except Exception as e:
+                print(f"  Note: {e}")
+                print("  Column might already exist or SQLite limitation encountered")
+        
         # Check if school_watermark_texts table exists
         table_names = inspector.get_table_names()
         if 'school_watermark_texts' not in table_names:
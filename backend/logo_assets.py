@@ -0,0 +1,142 @@
+"""
+School logo asset pipeline.
+
+Logos are normalized when a school is created or updated: decoded once,
+EXIF-rotated, converted to RGBA, trimmed to their visible pixels and stored as
+logo_master.png next to the uploaded original. Watermark renderers then ask
+for a logo at a given width and opacity and get a ready bitmap (or its PNG
+bytes) from a per-process LRU keyed by (logo, logo version, width, opacity),
+instead of decoding, resizing and re-encoding the upload on every call.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+MASTER_FILENAME = "logo_master.png"
+
+# Resized logo variants kept per process
+LOGO_CACHE_SIZE = int(os.environ.get('LOGO_CACHE_SIZE', 256))
+
+_variants: "OrderedDict[tuple, Tuple[Image.Image, bytes]]" = OrderedDict()
+_masters: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def normalize_logo(source_path: Path) -> Optional[Path]:
+    """Write the RGBA, trimmed master for an uploaded logo and return its path.
+
+    Returns None if the upload can't be decoded; renderers then fall back to
+    the original file as before.
+    """
+    source_path = Path(source_path)
+    master_path = source_path.parent / MASTER_FILENAME
+
+    try:
+        with Image.open(source_path) as uploaded:
+            logo = ImageOps.exif_transpose(uploaded).convert('RGBA')
+    except Exception as e:
+        print(f"Could not normalize logo {source_path}: {e}")
+        return None
+
+    # Trim fully transparent borders so width percentages apply to the visible logo
+    bbox = logo.getchannel('A').getbbox()
+    if bbox and bbox != (0, 0, logo.width, logo.height):
+        logo = logo.crop(bbox)
+
+    staging_path = master_path.with_suffix('.tmp')
+    logo.save(staging_path, format='PNG', optimize=True)
+    os.replace(staging_path, master_path)
+    print(f"Normalized logo {source_path.name}: {logo.width}x{logo.height}")
+    return master_path
+
+
+def _master_source(logo_path: str) -> str:
+    """The normalized master next to a logo if there is a current one, else the logo itself"""
+    master_path = os.path.join(os.path.dirname(logo_path), MASTER_FILENAME)
+    try:
+        if os.stat(master_path).st_mtime_ns >= os.stat(logo_path).st_mtime_ns:
+            return master_path
+    except FileNotFoundError:
+        pass
+    return logo_path
+
+
+def logo_version(logo_path: str) -> Optional[tuple]:
+    """(path, size, mtime) of the file a logo is rendered from; changes whenever the logo does"""
+    if not logo_path or not os.path.exists(logo_path):
+        return None
+    source = _master_source(logo_path)
+    stat = os.stat(source)
+    return (source, stat.st_size, stat.st_mtime_ns)
+
+
+def _load_master(version: tuple) -> Image.Image:
+    with _lock:
+        master = _masters.get(version)
+        if master is not None:
+            _masters.move_to_end(version)
+            return master
+
+    with Image.open(version[0]) as source:
+        master = source.convert('RGBA')
+
+    with _lock:
+        _masters[version] = master
+        while len(_masters) > 32:
+            _masters.popitem(last=False)
+    return master
+
+
+def _render_variant(master: Image.Image, width: int, opacity: float) -> Tuple[Image.Image, bytes]:
+    height = max(1, int(width / (master.width / master.height)))
+    logo = master.resize((width, height), Image.Resampling.LANCZOS)
+
+    if opacity < 1.0:
+        # Lookup table instead of a per-pixel Python callback
+        alpha = logo.getchannel('A').point([int(value * opacity) for value in range(256)])
+        logo.putalpha(alpha)
+
+    png = io.BytesIO()
+    logo.save(png, format='PNG')
+    return logo, png.getvalue()
+
+
+def _variant(logo_path: str, width: int, opacity: float) -> Optional[Tuple[Image.Image, bytes]]:
+    version = logo_version(logo_path)
+    if version is None or width < 1:
+        return None
+
+    key = (version, int(width), round(float(opacity), 3))
+    with _lock:
+        variant = _variants.get(key)
+        if variant is not None:
+            _variants.move_to_end(key)
+            return variant
+
+    variant = _render_variant(_load_master(version), int(width), min(1.0, float(opacity)))
+
+    with _lock:
+        _variants[key] = variant
+        while len(_variants) > LOGO_CACHE_SIZE:
+            _variants.popitem(last=False)
+    return variant
+
+
+def logo_image(logo_path: str, width: int, opacity: float) -> Optional[Image.Image]:
+    """RGBA logo resized to width with opacity applied; shared, so treat it as read-only"""
+    variant = _variant(logo_path, width, opacity)
+    return variant[0] if variant else None
+
+
+def logo_png(logo_path: str, width: int, opacity: float) -> Optional[Tuple[bytes, int, int]]:
+    """PNG bytes of the same logo, with its pixel size, for embedding in PDFs"""
+    variant = _variant(logo_path, width, opacity)
+    if not variant:
+        return None
+    image, png = variant
+    return png, image.width, image.height
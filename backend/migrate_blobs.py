@@ -0,0 +1,94 @@
+"""
+One-off migration of existing resource files into the content-addressed blob store.
+
+Every Resource whose file is not yet a blob is hashed, moved (or, if the same
+content is already stored, dropped in favour of the existing blob) and its
+file_path / file_sha256 updated. Safe to re-run; migrated rows are skipped.
+
+Usage:
+    python migrate_blobs.py            # migrate
+    python migrate_blobs.py --dry-run  # report what would be saved
+"""
+import os
+import sys
+import shutil
+import uuid
+import hashlib
+from pathlib import Path
+
+from database import SessionLocal, Resource
+from blob_store import ROOT_DIR, BlobLock, blob_relative_path, blob_disk_path, commit_blob, new_staging_path, release_file
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def migrate(dry_run: bool = False):
+    db = SessionLocal()
+    migrated = 0
+    deduplicated = 0
+    missing = 0
+    bytes_saved = 0
+    # Blobs seen in this run, for dry-run accounting
+    seen = set()
+
+    try:
+        resources = db.query(Resource).filter(~Resource.file_path.like('/uploads/resources/blobs/%')).all()
+        print(f"Found {len(resources)} resources outside the blob store")
+
+        for resource in resources:
+            old_path = ROOT_DIR / resource.file_path.lstrip('/')
+            if not old_path.exists():
+                print(f"  Missing file for {resource.resource_id}: {resource.file_path}")
+                missing += 1
+                continue
+
+            sha256 = file_sha256(old_path)
+            file_extension = os.path.splitext(old_path.name)[1]
+            new_file_path = blob_relative_path(sha256, file_extension)
+            size = old_path.stat().st_size
+
+            if blob_disk_path(new_file_path).exists() or new_file_path in seen:
+                deduplicated += 1
+                bytes_saved += size
+            seen.add(new_file_path)
+
+            if dry_run:
+                print(f"  {resource.file_path} -> {new_file_path}")
+                continue
+
+            old_file_path = resource.file_path
+            # Copy rather than move so other rows still pointing at the old file stay valid
+            staging_path = new_staging_path(f"{uuid.uuid4().hex}.part")
+            shutil.copyfile(old_path, staging_path)
+            with BlobLock(sha256):
+                commit_blob(staging_path, sha256, file_extension)
+
+                resource.file_path = new_file_path
+                resource.file_sha256 = sha256
+                db.commit()
+            migrated += 1
+
+            # Old file goes once nothing references it any more
+            release_file(db, old_file_path)
+            print(f"  {old_file_path} -> {new_file_path}")
+
+        print("=" * 50)
+        action = "Would migrate" if dry_run else "Migrated"
+        print(f"{action} {len(resources) - missing} resources ({deduplicated} duplicates, {missing} missing files)")
+        print(f"Disk space saved: {bytes_saved / (1024 * 1024):.2f}MB")
+    finally:
+        db.close()
+
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate(dry_run='--dry-run' in sys.argv)
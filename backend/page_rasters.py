@@ -0,0 +1,156 @@
+"""
+Single-page rasters of PDF resources for in-browser previews.
+
+Instead of sending a whole (possibly 100MB) PDF to flip through it, the
+client asks for one page at a time, rasterized with PyMuPDF at a given width
+or DPI. Rendered pages go into a bounded on-disk LRU cache (the same
+WatermarkCache used for branded downloads, under cache/pages), and the next
+few pages are rendered in the background at batch priority so they are
+usually ready by the time the reader turns to them.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import functools
+from pathlib import Path
+from typing import BinaryIO, Optional, Set, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from watermark_cache import WatermarkCache
+from render_executor import INTERACTIVE, BATCH, RenderQueueFull
+
+ROOT_DIR = Path(__file__).parent
+
+# Bump when rasterization changes so stale pages miss
+PAGE_RENDER_VERSION = "1"
+
+DEFAULT_PAGE_WIDTH = 1024
+MIN_PAGE_WIDTH = 64
+MAX_PAGE_WIDTH = int(os.environ.get('PAGE_RASTER_MAX_WIDTH', 2400))
+MIN_PAGE_DPI = 36
+MAX_PAGE_DPI = 300
+PAGE_WEBP_QUALITY = int(os.environ.get('PAGE_RASTER_WEBP_QUALITY', 80))
+# Pages after the requested one rendered ahead of time (one before it is also warmed)
+PAGE_PREFETCH = int(os.environ.get('PAGE_RASTER_PREFETCH', 2))
+
+PAGE_FORMATS = {
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+
+# Cache slot for pages of the unbranded original
+ORIGINAL = "original"
+
+page_cache = WatermarkCache(
+    root=Path(os.environ.get('PAGE_CACHE_DIR', ROOT_DIR / "cache" / "pages")),
+    max_bytes=int(os.environ.get('PAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+)
+
+# Page counts and sizes remembered per process, keyed on (path, size, mtime)
+PAGE_INFO_CACHE_SIZE = int(os.environ.get('PAGE_INFO_CACHE_SIZE', 1024))
+# Keys being prefetched, so a page is queued once
+_prefetching: Set[str] = set()
+_prefetch_tasks: Set[asyncio.Task] = set()
+
+
+@functools.lru_cache(maxsize=PAGE_INFO_CACHE_SIZE)
+def _page_count(pdf_path: str, file_size: int, mtime_ns: int) -> int:
+    with fitz.open(pdf_path) as pdf_document:
+        return len(pdf_document)
+
+
+@functools.lru_cache(maxsize=PAGE_INFO_CACHE_SIZE)
+def _page_size(pdf_path: str, file_size: int, mtime_ns: int, page_number: int) -> Tuple[float, float]:
+    with fitz.open(pdf_path) as pdf_document:
+        rect = pdf_document[page_number - 1].rect
+    return (rect.width, rect.height)
+
+
+def page_count(pdf_path: str) -> int:
+    """Number of pages in a PDF, memoized on (path, size, mtime)"""
+    stat = os.stat(pdf_path)
+    return _page_count(str(pdf_path), stat.st_size, stat.st_mtime_ns)
+
+
+def page_size(pdf_path: str, page_number: int = 1) -> Tuple[float, float]:
+    """(width, height) in points of one page (1-based), memoized on (path, size, mtime)"""
+    stat = os.stat(pdf_path)
+    return _page_size(str(pdf_path), stat.st_size, stat.st_mtime_ns, page_number)
+
+
+def page_key(source_digest: str, page_number: int, width: Optional[int], dpi: Optional[int], page_format: str) -> str:
+    payload = json.dumps({
+        'render_version': PAGE_RENDER_VERSION,
+        'source': source_digest,
+        'page': page_number,
+        'width': width,
+        'dpi': dpi,
+        'format': page_format,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def render_page(pdf_path: str, page_number: int, width: Optional[int], dpi: Optional[int], page_format: str, output: BinaryIO) -> bool:
+    """Rasterize one page (1-based) at width pixels or dpi and write it to output"""
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document[page_number - 1]
+        zoom = width / page.rect.width if width else dpi / 72
+        # Never exceed the width cap, whatever DPI was asked for
+        zoom = min(zoom, MAX_PAGE_WIDTH / page.rect.width)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+        if page_format == 'png':
+            output.write(pixmap.tobytes('png'))
+        else:
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+            image.save(output, format='WEBP', quality=PAGE_WEBP_QUALITY, method=4)
+    return True
+
+
+async def ensure_page(resource_id: str, pdf_path: str, source_digest: str, page_number: int,
+                      width: Optional[int], dpi: Optional[int], page_format: str,
+                      priority: int = INTERACTIVE) -> Optional[str]:
+    """Path of the cached raster for a page, rendering it first if needed"""
+    extension = PAGE_FORMATS[page_format][0]
+    key = page_key(source_digest, page_number, width, dpi, page_format)
+    cached = page_cache.get(resource_id, ORIGINAL, key, extension)
+    if cached:
+        return cached
+
+    render = functools.partial(render_page, pdf_path, page_number, width, dpi, page_format)
+    return await page_cache.render_once(resource_id, ORIGINAL, key, extension, render, priority=priority)
+
+
+async def _prefetch(resource_id: str, pdf_path: str, source_digest: str, page_number: int,
+                    width: Optional[int], dpi: Optional[int], page_format: str, key: str):
+    try:
+        await ensure_page(resource_id, pdf_path, source_digest, page_number, width, dpi, page_format, priority=BATCH)
+    except RenderQueueFull:
+        pass  # Busy; the page will render on demand instead
+    except Exception as e:
+        print(f"Error prefetching page {page_number} of {resource_id}: {e}")
+    finally:
+        _prefetching.discard(key)
+
+
+def prefetch_neighbours(resource_id: str, pdf_path: str, source_digest: str, page_number: int, total_pages: int,
+                        width: Optional[int], dpi: Optional[int], page_format: str):
+    """Render the pages around page_number in the background at batch priority"""
+    extension = PAGE_FORMATS[page_format][0]
+    neighbours = [page_number + offset for offset in range(1, PAGE_PREFETCH + 1)] + [page_number - 1]
+    for neighbour in neighbours:
+        if neighbour < 1 or neighbour > total_pages:
+            continue
+        key = page_key(source_digest, neighbour, width, dpi, page_format)
+        if key in _prefetching or page_cache.get(resource_id, ORIGINAL, key, extension):
+            continue
+        _prefetching.add(key)
+        task = asyncio.create_task(
+            _prefetch(resource_id, pdf_path, source_digest, neighbour, width, dpi, page_format, key)
+        )
+        # Hold a reference until done so the task isn't garbage collected
+        _prefetch_tasks.add(task)
+        task.add_done_callback(_prefetch_tasks.discard)
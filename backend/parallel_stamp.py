@@ -0,0 +1,155 @@
+"""
+Parallel branding of very large PDFs.
+
+A branded download of a 500-page PDF used to stamp every page in one loop on
+one core. When a render would stamp at least PARALLEL_STAMP_MIN_PAGES pages,
+the document is split into contiguous page ranges, one per worker process:
+each worker opens the source, copies its range into a scratch file in a
+per-render work directory and stamps it there, and the ranges are merged back
+in order with insert_pdf (outline and metadata are taken from the source).
+Smaller documents, and renders already running in a batch worker process,
+stay on the single-process path.
+
+The workers are a dedicated pool, forked at startup like the batch pool, so a
+huge interactive download never queues behind a batch ZIP. A cancelled render
+removes its work directory, which stops the workers between pages.
+
+Each range carries its own copy of resources shared across pages (fonts, the
+compiled stamp), so a split document comes out somewhat larger.
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import fitz  # PyMuPDF
+
+from render_executor import RenderToken
+from watermark_stamp import apply_stamp
+
+# Stamp this many pages or more across worker processes; 0 turns splitting off
+PARALLEL_STAMP_MIN_PAGES = int(os.environ.get('PARALLEL_STAMP_MIN_PAGES', 200))
+PARALLEL_STAMP_WORKERS = int(os.environ.get('PARALLEL_STAMP_WORKERS', os.cpu_count() or 1))
+# Never split into ranges smaller than this, the per-range overhead would dominate
+PARALLEL_STAMP_MIN_RANGE = int(os.environ.get('PARALLEL_STAMP_MIN_RANGE', 50))
+# How often a waiting render checks whether it was cancelled
+_CANCEL_POLL_SECONDS = 0.2
+
+_range_pool = None
+# Only the process that forked the pool may use it; batch workers inherit the global
+_pool_pid = None
+
+
+def start_range_workers():
+    """Fork the range workers; call at startup, before any render threads exist"""
+    global _range_pool, _pool_pid
+    if _range_pool is not None or PARALLEL_STAMP_MIN_PAGES <= 0 or PARALLEL_STAMP_WORKERS < 2:
+        return
+    _range_pool = ProcessPoolExecutor(
+        max_workers=PARALLEL_STAMP_WORKERS,
+        mp_context=multiprocessing.get_context('fork')
+    )
+    _pool_pid = os.getpid()
+    _range_pool.submit(os.getpid).result()
+
+
+def stop_range_workers():
+    if _range_pool is not None:
+        _range_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def should_split(stamped_pages: int) -> bool:
+    """Whether stamping this many pages is worth spreading over the range workers"""
+    return (
+        _range_pool is not None
+        and os.getpid() == _pool_pid
+        and stamped_pages >= max(PARALLEL_STAMP_MIN_PAGES, 2 * PARALLEL_STAMP_MIN_RANGE)
+    )
+
+
+def page_ranges(page_count: int, parts: int) -> List[Tuple[int, int]]:
+    """Split 0..page_count-1 into up to parts contiguous (first, last) ranges of near-equal size"""
+    parts = max(1, min(parts, page_count // max(1, PARALLEL_STAMP_MIN_RANGE)))
+    size, extra = divmod(page_count, parts)
+    ranges = []
+    first = 0
+    for index in range(parts):
+        last = first + size + (1 if index < extra else 0) - 1
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+
+def _restore_cross_range_links(source: "fitz.Document", merged: "fitz.Document", ranges: List[Tuple[int, int]]):
+    """insert_pdf drops links to pages outside the copied range; re-create them from the source"""
+    for first, last in ranges:
+        for page_number in range(first, last + 1):
+            for link in source[page_number].get_links():
+                if link['kind'] == fitz.LINK_GOTO and not first <= link['page'] <= last:
+                    merged[page_number].insert_link(link)
+
+
+def _stamp_range(pdf_path: str, first: int, last: int, pages: List[int], school_info: Dict[str, str],
+                 logo_path: Optional[str], positions, output_path: str, cancel: RenderToken) -> int:
+    """Worker: copy pages first..last of the source to output_path, stamping the listed ones"""
+    with fitz.open(pdf_path) as source, fitz.open() as part:
+        part.insert_pdf(source, from_page=first, to_page=last)
+        stamped = apply_stamp(part, school_info, logo_path, positions, cancel, [page - first for page in pages])
+        cancel.check()
+        part.save(output_path)
+    return stamped
+
+
+def stamp_in_ranges(pdf_path: str, page_count: int, pages: Sequence[int], school_info: Dict[str, str],
+                    logo_path: Optional[str], positions, cancel: Optional[RenderToken] = None) -> "fitz.Document":
+    """Stamp the given pages of a PDF across the range workers and return the merged document.
+
+    Blocking; raises RenderCancelled if cancel is cancelled while the ranges render.
+    """
+    work_dir = tempfile.mkdtemp(prefix="stamp_ranges_")
+    # Workers can't see the caller's token, so removing work_dir is how they are stopped
+    range_token = RenderToken(alive_path=work_dir)
+    pages = sorted(pages)
+    ranges = page_ranges(page_count, PARALLEL_STAMP_WORKERS)
+    futures = []
+    try:
+        for index, (first, last) in enumerate(ranges):
+            range_pages = [page for page in pages if first <= page <= last]
+            output_path = os.path.join(work_dir, f"{index:04d}.pdf")
+            futures.append((output_path, _range_pool.submit(
+                _stamp_range, pdf_path, first, last, range_pages, school_info, logo_path, positions,
+                output_path, range_token
+            )))
+
+        pending = [future for _, future in futures]
+        while pending:
+            done, pending = wait(pending, timeout=_CANCEL_POLL_SECONDS, return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()  # Re-raise a worker's error here
+            if cancel is not None:
+                cancel.check()
+
+        merged = fitz.open()
+        try:
+            for output_path, _ in futures:
+                with fitz.open(output_path) as part:
+                    merged.insert_pdf(part)
+            with fitz.open(pdf_path) as source:
+                _restore_cross_range_links(source, merged, ranges)
+                merged.set_metadata(source.metadata or {})
+                toc = source.get_toc(simple=False)
+            if toc:
+                merged.set_toc(toc)
+        except Exception:
+            merged.close()
+            raise
+        return merged
+    except BaseException:
+        for _, future in futures:
+            future.cancel()
+        raise
+    finally:
+        # Also stops any range still running after an error or cancellation
+        shutil.rmtree(work_dir, ignore_errors=True)
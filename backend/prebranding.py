@@ -0,0 +1,125 @@
+"""
+Eager branding of published resources.
+
+Every school's first "download with logo" of a new resource used to pay for
+the render itself, usually all at once when the resource is announced. With
+PREBRAND_MODE set, approving a resource (and a school saving its positions on
+one) queues the branded copies at batch priority, rendered straight into the
+watermark cache, so that first download is already a cache hit:
+
+    off   nothing is rendered ahead of time (default)
+    all   every school
+    top   the PREBRAND_TOP_SCHOOLS schools with the most downloads over the
+          last PREBRAND_ACTIVITY_DAYS days
+
+Each school is rendered with its effective positions, exactly as the download
+route would; schools that haven't positioned their branding on the resource
+download the original and are skipped.
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Set
+
+from sqlalchemy import func
+
+from database import SessionLocal, Resource, School, ResourceDownload
+from render_executor import BATCH
+from watermark_cache import watermark_cache
+
+PREBRAND_MODES = ('off', 'all', 'top')
+PREBRAND_MODE = os.environ.get('PREBRAND_MODE', 'off').lower()
+PREBRAND_TOP_SCHOOLS = int(os.environ.get('PREBRAND_TOP_SCHOOLS', 20))
+PREBRAND_ACTIVITY_DAYS = int(os.environ.get('PREBRAND_ACTIVITY_DAYS', 30))
+# Wait before rendering, so a logo save followed by a text save renders once
+PREBRAND_DELAY_SECONDS = float(os.environ.get('PREBRAND_DELAY_SECONDS', 5))
+
+if PREBRAND_MODE not in PREBRAND_MODES:
+    print(f"Unknown PREBRAND_MODE {PREBRAND_MODE!r}, pre-branding is off")
+    PREBRAND_MODE = 'off'
+
+
+class Prebrander:
+    """Renders branded copies of a resource in the background"""
+
+    def __init__(self):
+        self._plan_fn = None
+        self._resolve_path_fn = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def configure(self, plan_fn: Callable, resolve_path_fn: Callable):
+        """plan_fn(db, resource, school, full_path) returns the download's render plan or None"""
+        self._plan_fn = plan_fn
+        self._resolve_path_fn = resolve_path_fn
+
+    @property
+    def enabled(self) -> bool:
+        return PREBRAND_MODE != 'off' and self._plan_fn is not None
+
+    def schedule(self, resource_id: str, school_ids: Optional[List[str]] = None):
+        """Queue branded renders of a resource for the configured schools, or just school_ids"""
+        if not self.enabled:
+            return
+        task = asyncio.create_task(self._prebrand(resource_id, school_ids))
+        # Hold a reference until done so the task isn't garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _select_schools(self, db, school_ids: Optional[List[str]]) -> List[School]:
+        query = db.query(School)
+        if school_ids is not None:
+            return query.filter(School.school_id.in_(school_ids)).all()
+        if PREBRAND_MODE == 'top':
+            since = datetime.utcnow() - timedelta(days=PREBRAND_ACTIVITY_DAYS)
+            downloads = func.count(ResourceDownload.id)
+            most_active = db.query(ResourceDownload.school_id).filter(
+                ResourceDownload.downloaded_at >= since
+            ).group_by(ResourceDownload.school_id).order_by(downloads.desc()).limit(PREBRAND_TOP_SCHOOLS).all()
+            return query.filter(School.school_id.in_([row.school_id for row in most_active])).all()
+        return query.all()
+
+    async def _prebrand(self, resource_id: str, school_ids: Optional[List[str]]):
+        await asyncio.sleep(PREBRAND_DELAY_SECONDS)
+
+        db = SessionLocal()
+        try:
+            resource = db.query(Resource).filter(Resource.resource_id == resource_id).first()
+            if not resource or resource.approval_status != 'approved':
+                return
+            full_file_path = self._resolve_path_fn(resource.file_path)
+            source_digest = resource.file_sha256 or await asyncio.to_thread(watermark_cache.file_digest, full_file_path)
+
+            renders = []
+            for school in self._select_schools(db, school_ids):
+                plan = self._plan_fn(db, resource, school, full_file_path)
+                if plan:
+                    renders.append((school.school_id, plan.cache_key(source_digest), plan))
+        except FileNotFoundError:
+            print(f"Not pre-branding {resource_id}: file not found")
+            return
+        except Exception as e:
+            print(f"Error planning pre-branding of {resource_id}: {e}")
+            return
+        finally:
+            db.close()
+
+        # One school at a time, so a big rollout doesn't crowd out batch jobs
+        rendered = 0
+        for school_id, key, plan in renders:
+            if watermark_cache.get(resource_id, school_id, key, plan.output_ext):
+                continue
+            try:
+                # Joins the render if a download of the same copy already started it
+                if await watermark_cache.render_once(
+                    resource_id, school_id, key, plan.output_ext, plan.render,
+                    priority=BATCH, enforce_queue_limit=False
+                ):
+                    rendered += 1
+            except Exception as e:
+                print(f"Error pre-branding {resource_id} for {school_id}: {e}")
+
+        if rendered:
+            print(f"Pre-branded {rendered} copies of {resource_id}")
+
+
+prebrander = Prebrander()
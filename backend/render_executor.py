@@ -0,0 +1,242 @@
+"""
+Priority-aware executor for CPU-heavy rendering (PyMuPDF / PIL).
+
+Watermark routes are async, so blocking render calls are handed to a bounded
+worker pool instead of running on the event loop. Interactive single
+downloads are dispatched ahead of bulk batch work, and requests beyond the
+queue limit are rejected immediately with 503 + Retry-After.
+
+Long renders carry a RenderToken that their page and school loops check, so
+a render nobody is waiting for any more (the client went away, or the
+deadline passed) stops early instead of running to the end. Time spent on
+completed and abandoned renders is tracked separately in stats().
+"""
+import os
+import math
+import time
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Executor
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, status
+
+# Priority classes, highest first
+INTERACTIVE = 0
+BATCH = 1
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# How long an interactive request waits for its render before giving up (0 = no limit)
+RENDER_DEADLINE_SECONDS = float(os.environ.get('RENDER_DEADLINE_SECONDS', 0))
+
+
+class RenderQueueFull(HTTPException):
+    """Raised when a priority class already has too many queued renders"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Rendering queue is full, please retry shortly",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+
+class RenderCancelled(Exception):
+    """Raised inside a render loop once its token is cancelled"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RenderToken:
+    """Checked by render loops between pages or schools so they can stop early.
+
+    Tokens are plain objects so they also work in worker processes: there the
+    render is cancelled by removing alive_path (e.g. the batch's work directory).
+    """
+
+    def __init__(self, alive_path: Optional[str] = None):
+        self.alive_path = alive_path
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = 'abandoned'):
+        if self.reason is None:
+            self.reason = reason
+
+    def check(self):
+        """Raise RenderCancelled if the render should stop"""
+        if self.reason is None and self.alive_path and not os.path.exists(self.alive_path):
+            self.reason = 'abandoned'
+        if self.reason is not None:
+            raise RenderCancelled(self.reason)
+
+
+async def _until_disconnected(request):
+    # request.is_disconnected() can't see through BaseHTTPMiddleware, so wait on receive()
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def await_render(request, render: Awaitable, deadline_seconds: Optional[float] = None):
+    """Wait for a render on behalf of a request.
+
+    Raises RenderCancelled('disconnected') when the client goes away and
+    RenderCancelled('deadline') once deadline_seconds pass; either way the
+    render is cancelled, which stops it unless someone else still wants it.
+    """
+    if deadline_seconds is None:
+        deadline_seconds = RENDER_DEADLINE_SECONDS
+    task = asyncio.ensure_future(render)
+    watcher = asyncio.ensure_future(_until_disconnected(request))
+    try:
+        done, _ = await asyncio.wait(
+            {task, watcher}, timeout=deadline_seconds or None, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+
+    reason = 'disconnected' if watcher in done else 'deadline'
+    task.cancel(reason)
+    raise RenderCancelled(reason)
+
+
+class RenderExecutor:
+    def __init__(self, max_workers: int, batch_workers: int, queue_limits: dict):
+        # Batch work never takes every slot, so an interactive download can always start;
+        # that needs at least two slots, even on a single-CPU host
+        self.max_workers = max(2, max_workers)
+        batch_workers = max(1, min(batch_workers, self.max_workers - 1))
+        self._concurrency = {INTERACTIVE: self.max_workers, BATCH: batch_workers}
+        self._queue_limits = queue_limits
+        self._running = {priority: 0 for priority in PRIORITIES}
+        self._waiters = {priority: deque() for priority in PRIORITIES}
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._avg_seconds = 1.0
+        # Outcome -> [renders, seconds]: completed, failed, or why it was abandoned
+        self._outcomes = {}
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+        return self._pool
+
+    def _can_start(self, priority: int) -> bool:
+        return (
+            sum(self._running.values()) < self.max_workers
+            and self._running[priority] < self._concurrency[priority]
+        )
+
+    def _has_waiters_ahead(self, priority: int) -> bool:
+        return any(self._waiters[p] for p in PRIORITIES if p <= priority)
+
+    def _retry_after(self, priority: int) -> int:
+        queued = sum(len(self._waiters[p]) for p in PRIORITIES if p <= priority)
+        return max(1, math.ceil((queued + 1) * self._avg_seconds / self.max_workers))
+
+    def ensure_capacity(self, priority: int):
+        """Raise RenderQueueFull now if this priority class cannot take more work"""
+        if len(self._waiters[priority]) >= self._queue_limits[priority]:
+            raise RenderQueueFull(self._retry_after(priority))
+
+    async def _acquire(self, priority: int, enforce_queue_limit: bool):
+        if self._can_start(priority) and not self._has_waiters_ahead(priority):
+            self._running[priority] += 1
+            return
+
+        waiters = self._waiters[priority]
+        if enforce_queue_limit:
+            self.ensure_capacity(priority)
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted just as we were cancelled; hand it on
+                self._release(priority)
+            elif waiter in waiters:
+                waiters.remove(waiter)
+            raise
+
+    def _release(self, priority: int):
+        self._running[priority] -= 1
+        self._wake()
+
+    def _wake(self):
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters and self._can_start(priority):
+                waiter = waiters.popleft()
+                if waiter.cancelled():
+                    continue
+                self._running[priority] += 1
+                waiter.set_result(None)
+
+    async def run(
+        self,
+        fn: Callable,
+        *args,
+        priority: int = INTERACTIVE,
+        executor: Executor = None,
+        enforce_queue_limit: bool = True,
+        **kwargs
+    ):
+        """Run fn(*args, **kwargs) on a render worker once a slot is free for this priority.
+
+        Work that was already admitted (e.g. the remaining entries of a streaming
+        batch) passes enforce_queue_limit=False so it waits instead of failing.
+        """
+        await self._acquire(priority, enforce_queue_limit)
+        started = time.monotonic()
+
+        def finished(future):
+            elapsed = time.monotonic() - started
+            self._release(priority)
+            error = None if future.cancelled() else future.exception()
+            if isinstance(error, RenderCancelled):
+                outcome = error.reason
+                print(f"Render stopped after {elapsed:.2f}s: {error.reason}")
+            else:
+                outcome = 'failed' if error else 'completed'
+                self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+            totals = self._outcomes.setdefault(outcome, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor or self.pool, functools.partial(fn, *args, **kwargs))
+        # The slot is held until the worker actually finishes, even if the caller goes away
+        future.add_done_callback(finished)
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "running": {"interactive": self._running[INTERACTIVE], "batch": self._running[BATCH]},
+            "queued": {"interactive": len(self._waiters[INTERACTIVE]), "batch": len(self._waiters[BATCH])},
+            "avg_render_seconds": round(self._avg_seconds, 3),
+            # Seconds spent on renders that finished vs. ones stopped early (wasted)
+            "outcomes": {
+                outcome: {"renders": renders, "seconds": round(seconds, 3)}
+                for outcome, (renders, seconds) in self._outcomes.items()
+            },
+        }
+
+
+# At least two: one slot is always kept back from batch work (see RenderExecutor)
+_max_workers = max(2, int(os.environ.get('RENDER_WORKERS', min(4, os.cpu_count() or 1))))
+
+render_executor = RenderExecutor(
+    max_workers=_max_workers,
+    batch_workers=int(os.environ.get('RENDER_BATCH_WORKERS', max(1, _max_workers - 1))),
+    queue_limits={
+        INTERACTIVE: int(os.environ.get('RENDER_QUEUE_LIMIT', 32)),
+        BATCH: int(os.environ.get('RENDER_BATCH_QUEUE_LIMIT', 8)),
+    },
+)
@@ -0,0 +1,189 @@
+"""
+Resumable chunked uploads, modelled on the tus protocol.
+
+A client creates a session with the final size, then sends the file in
+chunks, each at the offset the server has confirmed so far. Chunk bodies are
+written straight into a staging file as they arrive, and every byte that made
+it to disk counts even if the connection drops mid-chunk, so a retry resumes
+from the last confirmed offset instead of starting over. Finalizing moves the
+staging file into the blob store; the session is claimed first
+(uploading -> finalizing), so a retried finalize never promotes it twice.
+"""
+import os
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator, Dict
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import update
+from starlette.requests import ClientDisconnect
+
+from database import UploadSession
+from upload_storage import MAX_UPLOAD_BYTES, UploadTooLarge, StoredUpload, promote_file
+
+ROOT_DIR = Path(__file__).parent
+# Kept outside uploads/, which is served as static files
+UPLOAD_SESSIONS_DIR = Path(os.environ.get('UPLOAD_SESSIONS_DIR', ROOT_DIR / "upload_sessions"))
+
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24))
+# Suggested chunk size for clients; any size is accepted
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 5 * 1024 * 1024))
+
+# One writer per session in this process; the offset compare-and-swap catches the rest
+_session_locks: Dict[str, asyncio.Lock] = {}
+
+
+def staging_path(upload_id: str) -> Path:
+    return UPLOAD_SESSIONS_DIR / f"{upload_id}.part"
+
+
+def create_session(db, total_size: int, **fields) -> UploadSession:
+    """Persist a new session and an empty staging file"""
+    if total_size < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid upload size")
+    if total_size > MAX_UPLOAD_BYTES:
+        raise UploadTooLarge()
+
+    expire_sessions(db)
+
+    session = UploadSession(
+        upload_id=str(uuid.uuid4()),
+        total_size=total_size,
+        offset=0,
+        status='uploading',
+        expires_at=datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS),
+        **fields
+    )
+    UPLOAD_SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+    staging_path(session.upload_id).touch()
+
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+    return session
+
+
+async def write_chunk(db, session: UploadSession, offset: int, chunks: AsyncIterator[bytes]) -> int:
+    """Append a request body at offset and return the new confirmed offset"""
+    if session.status != 'uploading':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload is already finalized")
+
+    lock = _session_locks.setdefault(session.upload_id, asyncio.Lock())
+    async with lock:
+        db.refresh(session)
+        start = session.offset
+        if offset != start:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Upload offset mismatch, expected {start}",
+                headers={"Upload-Offset": str(start)}
+            )
+
+        path = staging_path(session.upload_id)
+        if not path.exists():
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload session has expired")
+
+        written = 0
+        output = open(path, 'r+b')
+        try:
+            # Drop anything past the confirmed offset from an earlier interrupted write
+            output.truncate(start)
+            output.seek(start)
+            async for chunk in chunks:
+                if start + written + len(chunk) > session.total_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Chunk runs past the declared upload size"
+                    )
+                await run_in_threadpool(output.write, chunk)
+                written += len(chunk)
+        except ClientDisconnect:
+            print(f"Upload {session.upload_id}: client disconnected after {written} bytes")
+        finally:
+            output.close()
+            if written:
+                # Only move the offset if nobody else did in the meantime
+                result = db.execute(
+                    update(UploadSession)
+                    .where(UploadSession.upload_id == session.upload_id, UploadSession.offset == start)
+                    .values(offset=start + written, updated_at=datetime.utcnow())
+                )
+                db.commit()
+                if result.rowcount != 1:
+                    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload was modified concurrently")
+
+        db.refresh(session)
+        return session.offset
+
+
+class FinalizeInProgress(HTTPException):
+    """Raised when another request has already claimed the session for finalizing"""
+
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload is being finalized, please retry shortly",
+            headers={"Retry-After": "1"}
+        )
+
+
+async def finalize_session(db, session: UploadSession, file_extension: str) -> StoredUpload:
+    """Claim a fully received upload and move it into the blob store.
+
+    Raises FinalizeInProgress if another request claimed it first. The caller
+    commits the session as completed and then releases the returned upload.
+    """
+    lock = _session_locks.setdefault(session.upload_id, asyncio.Lock())
+    async with lock:
+        db.refresh(session)
+        if session.offset != session.total_size:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Upload is incomplete ({session.offset} of {session.total_size} bytes)",
+                headers={"Upload-Offset": str(session.offset)}
+            )
+
+        # Compare-and-swap, so only one request (in any worker) promotes the file
+        result = db.execute(
+            update(UploadSession)
+            .where(UploadSession.upload_id == session.upload_id, UploadSession.status == 'uploading')
+            .values(status='finalizing', updated_at=datetime.utcnow())
+        )
+        db.commit()
+        if result.rowcount != 1:
+            raise FinalizeInProgress()
+
+        try:
+            stored = await run_in_threadpool(promote_file, staging_path(session.upload_id), file_extension)
+        except Exception:
+            # Let the client retry
+            session.status = 'uploading'
+            db.commit()
+            raise
+    # Nothing writes to the session any more
+    _session_locks.pop(session.upload_id, None)
+    return stored
+
+
+def delete_session(db, session: UploadSession):
+    path = staging_path(session.upload_id)
+    if path.exists():
+        path.unlink()
+    _session_locks.pop(session.upload_id, None)
+    db.delete(session)
+    db.commit()
+
+
+def expire_sessions(db):
+    """Drop unfinished sessions past their expiry, and their staging files"""
+    expired = db.query(UploadSession).filter(
+        # A finalize that died halfway is left 'finalizing'
+        UploadSession.status.in_(['uploading', 'finalizing']),
+        UploadSession.expires_at < datetime.utcnow()
+    ).all()
+    for session in expired:
+        print(f"Expiring upload session {session.upload_id}")
+        delete_session(db, session)
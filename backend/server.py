@@ -1,6 +1,7 @@
 from fastapi import FastAPI, APIRouter, Depends, HTTPException, UploadFile, File, Form, status, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
 from dotenv import load_dotenv
 import os
 from starlette.middleware.cors import CORSMiddleware
@@ -11,27 +12,57 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List, Union, Dict, Any
+from typing import Optional, List, Union, Dict, Any, BinaryIO, Callable, NamedTuple, Literal
 import uuid
 import shutil
 from jose import JWTError, jwt
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import fitz  # PyMuPDF for PDF processing
 from io import BytesIO, StringIO
 import tempfile
 import io
-import zipfile
 import json
 import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import quote
 
 
 # Import database
 from database import (
     get_db, Admin, School, PasswordResetToken, ActivityLog, Resource, 
     Announcement, SupportTicket, ChatMessage, ResourceDownload, 
-    KnowledgeArticle, SchoolLogoPosition, SchoolWatermarkText, engine, Base, AdminResourceWatermark
+    KnowledgeArticle, SchoolLogoPosition, SchoolWatermarkText, engine, Base, AdminResourceWatermark,
+    WatermarkJob, WatermarkJobItem, UploadSession
 )
 from init_db import init_database
+from watermark_cache import watermark_cache
+from watermark_stamp import apply_branding, branded_pages, render_stamp_overlay, BRANDING_MODES, DEFAULT_BRANDING_MODE
+from parallel_stamp import start_range_workers, stop_range_workers, should_split, stamp_in_ranges
+from logo_assets import logo_image, logo_png, normalize_logo
+from font_registry import get_font, text_size
+from image_compositing import StampTile, text_tile, composite_tiles
+from image_decoding import open_rgb_bounded
+from image_encoding import image_profile, encode_image
+from thumbnails import THUMBNAIL_FORMATS, thumbnail_width, ensure_thumbnail, schedule_thumbnails
+from page_rasters import (
+    page_cache, page_count, page_size, ensure_page, prefetch_neighbours, PAGE_FORMATS,
+    DEFAULT_PAGE_WIDTH, MIN_PAGE_WIDTH, MAX_PAGE_WIDTH, MIN_PAGE_DPI, MAX_PAGE_DPI
+)
+from render_executor import render_executor, BATCH, RenderCancelled, RenderToken, await_render
+from zip_stream import ZipStream
+from upload_storage import store_upload, UploadLimitMiddleware
+from blob_store import release_file, blob_disk_path
+from file_delivery import (
+    file_response, deliver_file, counts_as_download, verify_file_signature, SIGNED_URL_PREFIX,
+    TempFileResponse
+)
+from resumable_uploads import UPLOAD_CHUNK_BYTES, FinalizeInProgress, create_session, write_chunk, finalize_session, delete_session
+import batch_jobs
+from batch_jobs import job_runner
+from prebranding import prebrander
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -58,9 +89,55 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 RESOURCES_UPLOAD_DIR = ROOT_DIR / "uploads" / "resources"
 RESOURCES_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# Worker processes for batch watermarking
+BATCH_PROCESS_WORKERS = int(os.environ.get('BATCH_PROCESS_WORKERS', os.cpu_count() or 1))
+_batch_process_pool = None
+
+# What a branded download gets when its render runs past RENDER_DEADLINE_SECONDS:
+# cached (an earlier branded copy, else 503), original (an earlier branded copy,
+# else the unbranded file) or none (503)
+WATERMARK_DEADLINE_FALLBACK = os.environ.get('WATERMARK_DEADLINE_FALLBACK', 'cached').lower()
+
+def get_batch_process_pool() -> ProcessPoolExecutor:
+    """Lazily create the batch worker pool (forked, so workers inherit the render helpers)"""
+    global _batch_process_pool
+    if _batch_process_pool is None:
+        _batch_process_pool = ProcessPoolExecutor(
+            max_workers=BATCH_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context('fork')
+        )
+    return _batch_process_pool
+
 # Create the main app
 app = FastAPI()
 
+@app.on_event("startup")
+async def start_batch_workers():
+    """Fork batch workers up front, before any render threads exist"""
+    await asyncio.wrap_future(get_batch_process_pool().submit(os.getpid))
+    # And the workers that stamp page ranges of very large PDFs
+    start_range_workers()
+    
+    # Pick up queued jobs and jobs left behind by a restarted worker
+    job_runner.configure(
+        render_fn=render_school_copy,
+        snapshot_fn=school_snapshot,
+        resolve_path_fn=get_full_file_path,
+        pool_fn=get_batch_process_pool,
+        concurrency=BATCH_PROCESS_WORKERS
+    )
+    job_runner.start()
+    
+    # Render branded copies ahead of the first downloads (PREBRAND_MODE)
+    prebrander.configure(plan_fn=branded_render_plan, resolve_path_fn=get_full_file_path)
+
+@app.on_event("shutdown")
+async def stop_batch_workers():
+    await job_runner.stop()
+    if _batch_process_pool is not None:
+        _batch_process_pool.shutdown(wait=False, cancel_futures=True)
+    stop_range_workers()
+
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -133,6 +210,8 @@ class ResourceResponse(BaseModel):
     uploaded_by_name: Optional[str] = None
     approval_status: str
     download_count: int
+    branding_mode: Optional[str] = DEFAULT_BRANDING_MODE
+    branding_interval: Optional[int] = 1
     created_at: datetime
     updated_at: datetime
 
@@ -235,12 +314,36 @@ class WatermarkPosition(BaseModel):
     contact_y: int = 90
     contact_size: int = 12
     contact_opacity: float = 0.8
+    # Pages of a PDF that get branded; None uses the resource's setting
+    branding_mode: Optional[Literal[BRANDING_MODES]] = None
+    branding_interval: Optional[int] = None
+
+class BrandingModeUpdate(BaseModel):
+    branding_mode: Literal[BRANDING_MODES]
+    branding_interval: int = 1
 
 class BatchWatermarkRequest(BaseModel):
     resource_id: str
     school_ids: Union[str, List[str]]  # 'all' or list of school IDs
     positions: WatermarkPosition
 
+class WatermarkJobRequest(BatchWatermarkRequest):
+    resource_ids: List[str] = []  # Extra resources, for resources x schools runs
+    created_by: str = 'admin'
+
+class ResumableUploadCreate(BaseModel):
+    name: str
+    category: str
+    file_name: str
+    file_type: Optional[str] = None
+    total_size: int
+    description: Optional[str] = None
+    class_level: Optional[str] = None
+    tags: Optional[str] = None
+    uploaded_by_type: str = 'admin'  # 'admin' or 'school'
+    school_id: Optional[str] = None
+    school_name: Optional[str] = None
+
 class SaveTemplateRequest(BaseModel):
     admin_id: str
     resource_id: str
@@ -308,131 +411,75 @@ def get_school_logo_path(school: School) -> str:
     
     return None
 
-def add_watermark_to_pdf(pdf_path: str, school: School, positions: WatermarkPosition) -> str:
-    """Add watermark to PDF with school info"""
+def rendered_extension(file_path: str, file_type: Optional[str]) -> str:
+    """File extension of the watermarked output for a resource"""
+    file_type_lower = file_type.lower() if file_type else ''
+    if 'pdf' in file_type_lower or file_path.lower().endswith('.pdf'):
+        return '.pdf'
+    return image_profile(file_path, file_type).extension
+
+def rendered_media_type(file_path: str, file_type: Optional[str]) -> str:
+    """Content-Type of the watermarked output for a resource"""
+    if rendered_extension(file_path, file_type) == '.pdf':
+        return 'application/pdf'
+    return image_profile(file_path, file_type).media_type
+
+def resource_branding(positions: WatermarkPosition, resource: Resource) -> WatermarkPosition:
+    """positions with the resource's branding mode wherever the request didn't choose one"""
+    return positions.model_copy(update={
+        'branding_mode': positions.branding_mode or resource.branding_mode or DEFAULT_BRANDING_MODE,
+        'branding_interval': positions.branding_interval or resource.branding_interval or 1,
+    })
+
+def add_watermark_to_pdf(pdf_path: str, school: School, positions: WatermarkPosition, output: BinaryIO = None,
+                         cancel: Optional[RenderToken] = None) -> Union[bytes, BinaryIO, None]:
+    """Add watermark to PDF with school info.
+    
+    Writes the PDF to output when given and returns it, otherwise returns the PDF bytes.
+    Raises RenderCancelled between pages once cancel is cancelled.
+    """
     try:
         print(f"Adding watermark to PDF for school: {school.school_name}")
         
         # Open PDF
         pdf_document = fitz.open(pdf_path)
         
-        # Create temp file
-        temp_file = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
-        output_path = temp_file.name
-        
         # Get school logo if available
         logo_path = get_school_logo_path(school)
         
-        # Process each page
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            page_width = page.rect.width
-            page_height = page.rect.height
-            
-            # Add logo if available
-            if logo_path and os.path.exists(logo_path):
-                try:
-                    logo_img = Image.open(logo_path)
-                    if logo_img.mode != 'RGBA':
-                        logo_img = logo_img.convert('RGBA')
-                    
-                    # Apply opacity
-                    if positions.logo_opacity < 1.0:
-                        alpha = logo_img.split()[3]
-                        alpha = alpha.point(lambda p: p * positions.logo_opacity)
-                        logo_img.putalpha(alpha)
-                    
-                    # Resize logo
-                    logo_width_pixels = int(page_width * (positions.logo_width / 100))
-                    aspect_ratio = logo_img.width / logo_img.height
-                    logo_height_pixels = int(logo_width_pixels / aspect_ratio)
-                    logo_img = logo_img.resize((logo_width_pixels, logo_height_pixels), Image.Resampling.LANCZOS)
-                    
-                    # Convert to bytes
-                    logo_bytes = io.BytesIO()
-                    logo_img.save(logo_bytes, format='PNG')
-                    logo_bytes.seek(0)
-                    
-                    # Position logo
-                    x_position = page_width * (positions.logo_x / 100)
-                    y_position = page_height * (positions.logo_y / 100)
-                    
-                    rect = fitz.Rect(
-                        x_position - (logo_width_pixels / 2),
-                        y_position - (logo_height_pixels / 2),
-                        x_position + (logo_width_pixels / 2),
-                        y_position + (logo_height_pixels / 2)
-                    )
-                    
-                    page.insert_image(rect, stream=logo_bytes.getvalue())
-                    print(f"Added logo to page {page_num + 1}")
-                except Exception as e:
-                    print(f"Error adding logo: {e}")
-            
-            # Add school name
-            school_name_x = page_width * (positions.school_name_x / 100)
-            school_name_y = page_height * (positions.school_name_y / 100)
-            
-            # Draw school name
-            try:
-                text = f"{school.school_name}"
-                rect = fitz.Rect(
-                    school_name_x - 200,
-                    school_name_y - 20,
-                    school_name_x + 200,
-                    school_name_y + 20
-                )
-                
-                # Calculate font size based on positions
-                font_size = positions.school_name_size * 0.75  # Convert to points
-                
-                page.insert_textbox(
-                    rect,
-                    text,
-                    fontsize=font_size,
-                    color=(0, 0, 0, positions.school_name_opacity),
-                    align=1  # Center aligned
-                )
-                print(f"Added school name to page {page_num + 1}")
-            except Exception as e:
-                print(f"Error adding school name: {e}")
-            
-            # Add contact info
-            contact_x = page_width * (positions.contact_x / 100)
-            contact_y = page_height * (positions.contact_y / 100)
-            
-            contact_text = f"{school.email}"
-            if school.contact_number:
-                contact_text += f"\n{school.contact_number}"
-            
-            try:
-                contact_rect = fitz.Rect(
-                    contact_x - 200,
-                    contact_y - 30,
-                    contact_x + 200,
-                    contact_y + 30
-                )
-                
-                contact_font_size = positions.contact_size * 0.75  # Convert to points
-                
-                page.insert_textbox(
-                    contact_rect,
-                    contact_text,
-                    fontsize=contact_font_size,
-                    color=(0, 0, 0, positions.contact_opacity),
-                    align=1  # Center aligned
-                )
-                print(f"Added contact info to page {page_num + 1}")
-            except Exception as e:
-                print(f"Error adding contact info: {e}")
+        school_info = {
+            'school_name': school.school_name,
+            'email': school.email,
+            'contact_number': school.contact_number
+        }
+        
+        # Logo, name and contact are compiled into one stamp per page size and
+        # referenced from each page the branding mode selects (or a cover page)
+        pages = branded_pages(len(pdf_document), positions.branding_mode, positions.branding_interval)
+        if should_split(len(pages)):
+            # Very large documents are stamped in page ranges across worker processes
+            merged = stamp_in_ranges(pdf_path, len(pdf_document), pages, school_info, logo_path, positions, cancel)
+            pdf_document.close()
+            pdf_document = merged
+            stamped_pages = len(pages)
+        else:
+            stamped_pages = apply_branding(pdf_document, school_info, logo_path, positions, cancel)
+        print(f"Branded {stamped_pages} pages ({positions.branding_mode or DEFAULT_BRANDING_MODE})")
         
         # Save watermarked PDF
-        pdf_document.save(output_path)
+        if output is not None:
+            pdf_document.save(output)
+            result = output
+        else:
+            result = pdf_document.tobytes()
         pdf_document.close()
         
-        print(f"Watermarked PDF saved to: {output_path}")
-        return output_path
+        print(f"Watermarked PDF rendered for: {school.school_name}")
+        return result
         
+    except RenderCancelled:
+        pdf_document.close()
+        raise
     except Exception as e:
         print(f"Error adding watermark to PDF: {e}")
         import traceback
@@ -447,14 +494,9 @@ def create_preview_image(resource: Resource, school: School, positions: Watermar
         draw = ImageDraw.Draw(img)
         
         # Draw resource info
-        try:
-            font_large = ImageFont.truetype("arial.ttf", 24)
-            font_medium = ImageFont.truetype("arial.ttf", 16)
-            font_small = ImageFont.truetype("arial.ttf", 12)
-        except:
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
-            font_small = ImageFont.load_default()
+        font_large = get_font(24)
+        font_medium = get_font(16)
+        font_small = get_font(12)
         
         # Title
         draw.text((400, 50), "Watermark Preview", font=font_large, fill='black', anchor="mm")
@@ -595,32 +637,66 @@ async def generate_watermark_preview(
             contact_x=positions.get('contact_x', 50),
             contact_y=positions.get('contact_y', 90),
             contact_size=positions.get('contact_size', 12),
-            contact_opacity=positions.get('contact_opacity', 0.8)
+            contact_opacity=positions.get('contact_opacity', 0.8),
+            branding_mode=positions.get('branding_mode'),
+            branding_interval=positions.get('branding_interval')
         )
+        watermark_positions = resource_branding(watermark_positions, resource)
         
         # Check file type and apply appropriate watermark
         file_type_lower = resource.file_type.lower() if resource.file_type else ''
         file_path_lower = file_path.lower()
         
+        # Overlay mode: just the stamp as a transparent PNG sized to page 1, for the
+        # positioning editor to layer over the cached page raster
+        if request.get('mode') == 'overlay':
+            if rendered_extension(file_path, resource.file_type) != '.pdf':
+                raise HTTPException(status_code=400, detail="Overlay previews are only available for PDF resources")
+            
+            width = int(request.get('width') or DEFAULT_PAGE_WIDTH)
+            if not MIN_PAGE_WIDTH <= width <= MAX_PAGE_WIDTH:
+                raise HTTPException(status_code=400, detail=f"width must be between {MIN_PAGE_WIDTH} and {MAX_PAGE_WIDTH}")
+            
+            page_width, page_height = await run_in_threadpool(page_size, file_path)
+            overlay = await render_executor.run(
+                render_stamp_overlay,
+                {
+                    'school_name': school.school_name,
+                    'email': school.email,
+                    'contact_number': school.contact_number
+                },
+                get_school_logo_path(school),
+                watermark_positions,
+                page_width,
+                page_height,
+                width
+            )
+            return Response(
+                content=overlay,
+                media_type="image/png",
+                headers={
+                    "Cache-Control": "no-store",
+                    # Page 1 at the same width; cached and long-lived, unlike the overlay
+                    "X-Preview-Base": f"/api/resources/{resource_id}/pages/1?width={width}"
+                }
+            )
+        
         # For PDF files - apply actual watermark and return PDF
         if 'pdf' in file_type_lower or file_path_lower.endswith('.pdf'):
             print("Processing PDF for watermark preview")
             
-            # Apply watermark to PDF
-            watermarked_pdf = add_watermark_to_pdf(file_path, school, watermark_positions)
+            # Apply watermark to PDF, rendered to disk and streamed from there
+            rendered_file = await render_executor.run(
+                render_to_temp_file,
+                functools.partial(add_watermark_to_pdf, file_path, school, watermark_positions),
+                '.pdf'
+            )
             
-            if watermarked_pdf and os.path.exists(watermarked_pdf):
-                # Read the watermarked PDF
-                with open(watermarked_pdf, 'rb') as f:
-                    content = f.read()
-                
-                # Clean up temp file
-                os.remove(watermarked_pdf)
-                
-                print(f"Returning watermarked PDF, size: {len(content)} bytes")
+            if rendered_file:
+                print(f"Returning watermarked PDF, size: {os.path.getsize(rendered_file)} bytes")
                 
-                return Response(
-                    content=content,
+                return TempFileResponse(
+                    rendered_file,
                     media_type="application/pdf",
                     headers={
                         "Content-Disposition": "inline; filename=\"preview.pdf\"",
@@ -642,44 +718,39 @@ async def generate_watermark_preview(
                 'contact_number': school.contact_number
             }
             
-            # Create temp output path
-            temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-            output_path = temp_file.name
-            temp_file.close()
-            
-            # Apply watermark to image
-            result = add_logo_and_text_to_image(
-                file_path,
-                logo_path,
-                watermark_positions,
-                resource.file_type,
-                school_info,
-                {
-                    'name_x': watermark_positions.school_name_x,
-                    'name_y': watermark_positions.school_name_y,
-                    'name_size': watermark_positions.school_name_size,
-                    'name_opacity': watermark_positions.school_name_opacity,
-                    'contact_x': watermark_positions.contact_x,
-                    'contact_y': watermark_positions.contact_y,
-                    'contact_size': watermark_positions.contact_size,
-                    'contact_opacity': watermark_positions.contact_opacity
-                },
-                output_path
+            # Apply watermark to image, rendered to disk and streamed from there
+            preview_extension = rendered_extension(file_path, resource.file_type)
+            rendered_file = await render_executor.run(
+                render_to_temp_file,
+                functools.partial(
+                    add_logo_and_text_to_image,
+                    file_path,
+                    logo_path,
+                    watermark_positions,
+                    resource.file_type,
+                    school_info,
+                    {
+                        'name_x': watermark_positions.school_name_x,
+                        'name_y': watermark_positions.school_name_y,
+                        'name_size': watermark_positions.school_name_size,
+                        'name_opacity': watermark_positions.school_name_opacity,
+                        'contact_x': watermark_positions.contact_x,
+                        'contact_y': watermark_positions.contact_y,
+                        'contact_size': watermark_positions.contact_size,
+                        'contact_opacity': watermark_positions.contact_opacity
+                    }
+                ),
+                preview_extension
             )
             
-            if result and os.path.exists(result):
-                with open(result, 'rb') as f:
-                    content = f.read()
+            if rendered_file:
+                print(f"Returning watermarked image, size: {os.path.getsize(rendered_file)} bytes")
                 
-                os.remove(result)
-                
-                print(f"Returning watermarked image, size: {len(content)} bytes")
-                
-                return Response(
-                    content=content,
-                    media_type="image/png",
+                return TempFileResponse(
+                    rendered_file,
+                    media_type=rendered_media_type(file_path, resource.file_type),
                     headers={
-                        "Content-Disposition": "inline; filename=\"preview.png\"",
+                        "Content-Disposition": f"inline; filename=\"preview{preview_extension}\"",
                         "Cache-Control": "no-cache, no-store, must-revalidate"
                     }
                 )
@@ -688,13 +759,9 @@ async def generate_watermark_preview(
         else:
             print(f"Returning original file for preview: {resource.file_type}")
             
-            # Read original file
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
             # Return original file with watermark note
-            return Response(
-                content=content,
+            return FileResponse(
+                file_path,
                 media_type=resource.file_type or "application/octet-stream",
                 headers={
                     "Content-Disposition": "inline; filename=\"preview\"",
@@ -741,6 +808,8 @@ async def save_watermark_template(
             existing.contact_y = request.positions.contact_y
             existing.contact_size = request.positions.contact_size
             existing.contact_opacity = request.positions.contact_opacity
+            existing.branding_mode = request.positions.branding_mode
+            existing.branding_interval = request.positions.branding_interval
             existing.updated_at = datetime.utcnow()
             message = "Template updated successfully"
         else:
@@ -760,7 +829,9 @@ async def save_watermark_template(
                 contact_x=request.positions.contact_x,
                 contact_y=request.positions.contact_y,
                 contact_size=request.positions.contact_size,
-                contact_opacity=request.positions.contact_opacity
+                contact_opacity=request.positions.contact_opacity,
+                branding_mode=request.positions.branding_mode,
+                branding_interval=request.positions.branding_interval
             )
             db.add(watermark)
             message = "Template saved successfully"
@@ -775,12 +846,100 @@ async def save_watermark_template(
         print(f"Error saving template: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def school_snapshot(school: School) -> SimpleNamespace:
+    """Plain copy of the school fields used for branding, safe to hand to worker processes"""
+    return SimpleNamespace(
+        school_id=school.school_id,
+        school_name=school.school_name,
+        email=school.email,
+        contact_number=school.contact_number,
+        logo_path=school.logo_path
+    )
+
+def render_school_copy(
+    file_path: str,
+    file_type: str,
+    school,
+    positions: Union[WatermarkPosition, Dict[str, Any]],
+    output_base: str,
+    cancel: Optional[RenderToken] = None
+) -> Optional[str]:
+    """Render one school's branded copy of a PDF or image to output_base + extension.
+    
+    Returns the written path, or None if watermarking failed.
+    """
+    if isinstance(positions, dict):
+        positions = WatermarkPosition(**positions)
+    
+    output_path = output_base + rendered_extension(file_path, file_type)
+    with open(output_path, 'wb') as output:
+        rendered = render_school_copy_into(file_path, file_type, school, positions, output, cancel)
+    
+    if not rendered:
+        os.remove(output_path)
+        return None
+    return output_path
+
+def render_to_temp_file(render: Callable[[BinaryIO], Any], suffix: str) -> Optional[str]:
+    """Call render(stream) on a new temp file and return its path, or None if nothing was rendered"""
+    fd, temp_path = tempfile.mkstemp(prefix="render_", suffix=suffix)
+    os.close(fd)
+    try:
+        # Reopened by name: PyMuPDF mistakes the int .name of an fdopen'ed file for a stream
+        with open(temp_path, 'wb') as output:
+            rendered = render(output)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    
+    if not rendered:
+        os.remove(temp_path)
+        return None
+    return temp_path
+
+def render_school_copy_into(file_path: str, file_type: str, school, positions: WatermarkPosition, output: BinaryIO,
+                            cancel: Optional[RenderToken] = None):
+    """Write one school's branded copy of a PDF or image to output"""
+    file_type_lower = file_type.lower() if file_type else ''
+    
+    # For PDFs
+    if 'pdf' in file_type_lower or file_path.lower().endswith('.pdf'):
+        print(f"Applying watermark to PDF for {school.school_name}")
+        return add_watermark_to_pdf(file_path, school, positions, output, cancel)
+    
+    # For images
+    print(f"Applying watermark to image for {school.school_name}")
+    school_info = {
+        'school_name': school.school_name,
+        'email': school.email,
+        'contact_number': school.contact_number
+    }
+    return add_logo_and_text_to_image(
+        file_path,
+        get_school_logo_path(school),
+        positions,
+        file_type,
+        school_info,
+        {
+            'name_x': positions.school_name_x,
+            'name_y': positions.school_name_y,
+            'name_size': positions.school_name_size,
+            'name_opacity': positions.school_name_opacity,
+            'contact_x': positions.contact_x,
+            'contact_y': positions.contact_y,
+            'contact_size': positions.contact_size,
+            'contact_opacity': positions.contact_opacity
+        },
+        output,
+        cancel
+    )
+
 @api_router.post("/admin/download-batch-watermarked")
 async def download_batch_watermarked(
     request: Dict[str, Any],
     db: Session = Depends(get_db)
 ):
-    """Download multiple watermarked resources as ZIP"""
+    """Download multiple watermarked resources as a streamed ZIP"""
     try:
         resource_id = request.get('resource_id')
         school_ids = request.get('school_ids', [])
@@ -828,118 +987,116 @@ async def download_batch_watermarked(
             contact_x=positions.get('contact_x', 50),
             contact_y=positions.get('contact_y', 90),
             contact_size=positions.get('contact_size', 12),
-            contact_opacity=positions.get('contact_opacity', 0.8)
+            contact_opacity=positions.get('contact_opacity', 0.8),
+            branding_mode=positions.get('branding_mode'),
+            branding_interval=positions.get('branding_interval')
+        )
+        watermark_positions = resource_branding(watermark_positions, resource)
+        
+        file_type = resource.file_type
+        file_type_lower = file_type.lower() if file_type else ''
+        is_watermarkable = (
+            'pdf' in file_type_lower or file_path.lower().endswith('.pdf')
+            or any(img_type in file_type_lower for img_type in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp'])
         )
         
-        # Create temporary directory for watermarked files
-        temp_dir = tempfile.mkdtemp()
+        # Reject now, while a proper 503 can still be sent
+        if is_watermarkable:
+            render_executor.ensure_capacity(BATCH)
+        
+        # The response streams after this handler returns, so copy what it needs
+        school_copies = [school_snapshot(school) for school in schools]
+        resource_name = resource.name.replace(' ', '_')
+        file_extension = os.path.splitext(file_path)[1] or '.file'
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        zip_filename = f"{resource.name.replace(' ', '_')}_watermarked_{timestamp}.zip"
-        zip_path = os.path.join(temp_dir, zip_filename)
+        zip_filename = f"{resource_name}_watermarked_{timestamp}.zip"
         
-        # Create ZIP file
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            processed_count = 0
-            for i, school in enumerate(schools):
+        async def zip_chunks():
+            zip_stream = ZipStream()
+            
+            if not is_watermarkable:
+                # Every school would get identical bytes, so the original goes in once
+                print(f"Adding original file once for {len(school_copies)} schools")
+                async for chunk in iterate_in_threadpool(zip_stream.add_file(file_path, f"{resource_name}{file_extension}")):
+                    yield chunk
+            else:
+                pool = get_batch_process_pool()
+                # Workers write each copy straight into this directory; it goes once the ZIP is done
+                work_dir = tempfile.mkdtemp(prefix="batch_")
+                # Renders still running when the client goes away stop at their next page
+                # once the work directory is removed
+                cancel = RenderToken(alive_path=work_dir)
+                pending = enumerate(school_copies)
+                in_flight = {}
+                failed = []
+                processed_count = 0
+                
+                def submit_next():
+                    index, school = next(pending, (None, None))
+                    if school is not None:
+                        task = asyncio.ensure_future(render_executor.run(
+                            render_school_copy, file_path, file_type, school, watermark_positions,
+                            os.path.join(work_dir, str(index)),
+                            priority=BATCH, executor=pool, enforce_queue_limit=False, cancel=cancel
+                        ))
+                        in_flight[task] = school
+                
+                # Keep every worker busy; each entry is sent as soon as it is rendered
+                for _ in range(BATCH_PROCESS_WORKERS):
+                    submit_next()
+                
                 try:
-                    print(f"Processing school {i+1}/{len(schools)}: {school.school_name}")
-                    
-                    watermarked_file = None
-                    file_type_lower = resource.file_type.lower() if resource.file_type else ''
-                    
-                    # For PDFs
-                    if 'pdf' in file_type_lower or file_path.lower().endswith('.pdf'):
-                        print(f"Applying watermark to PDF for {school.school_name}")
-                        watermarked_file = add_watermark_to_pdf(file_path, school, watermark_positions)
-                    
-                    # For images
-                    elif any(img_type in file_type_lower for img_type in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']):
-                        print(f"Applying watermark to image for {school.school_name}")
-                        
-                        # Get school info
-                        school_info = {
-                            'school_name': school.school_name,
-                            'email': school.email,
-                            'contact_number': school.contact_number
-                        }
-                        
-                        # Get logo path
-                        logo_path = get_school_logo_path(school)
-                        
-                        # Apply watermark
-                        watermarked_file = add_logo_and_text_to_image(
-                            file_path,
-                            logo_path,
-                            watermark_positions,
-                            resource.file_type,
-                            school_info,
-                            {
-                                'name_x': watermark_positions.school_name_x,
-                                'name_y': watermark_positions.school_name_y,
-                                'name_size': watermark_positions.school_name_size,
-                                'name_opacity': watermark_positions.school_name_opacity,
-                                'contact_x': watermark_positions.contact_x,
-                                'contact_y': watermark_positions.contact_y,
-                                'contact_size': watermark_positions.contact_size,
-                                'contact_opacity': watermark_positions.contact_opacity
-                            },
-                            None  # Will create temp file
-                        )
-                    
-                    # For other file types, copy original
-                    else:
-                        print(f"Copying original file for {school.school_name}")
-                        watermarked_file = file_path
-                    
-                    # Add to ZIP if file exists
-                    if watermarked_file and os.path.exists(watermarked_file):
-                        # Create safe filename
-                        school_folder = school.school_name.replace('/', '_').replace('\\', '_')
-                        file_extension = os.path.splitext(file_path)[1] or '.file'
-                        filename = f"{resource.name.replace(' ', '_')}_{school.school_name.replace(' ', '_')}_branded{file_extension}"
-                        arcname = f"{school_folder}/{filename}"
-                        
-                        zipf.write(watermarked_file, arcname)
-                        processed_count += 1
-                        
-                        # Clean up temp file if it's not the original
-                        if watermarked_file != file_path:
+                    while in_flight:
+                        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            school = in_flight.pop(task)
+                            submit_next()
+                            
                             try:
-                                os.remove(watermarked_file)
-                            except:
-                                pass
-                        
-                        print(f"Added to ZIP: {arcname}")
-                    
-                except Exception as e:
-                    print(f"Error processing school {school.school_name}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    continue
-        
-        if processed_count == 0:
-            raise HTTPException(status_code=500, detail="No files were processed successfully")
-        
-        # Read ZIP file
-        with open(zip_path, 'rb') as f:
-            zip_content = f.read()
-        
-        print(f"ZIP created successfully: {len(zip_content)} bytes, {processed_count} files")
-        
-        # Clean up
-        try:
-            os.remove(zip_path)
-            os.rmdir(temp_dir)
-        except:
-            pass
-        
-        return Response(
-            content=zip_content,
+                                watermarked_file = task.result()
+                            except Exception as e:
+                                print(f"Error processing school {school.school_name}: {e}")
+                                watermarked_file = None
+                            
+                            if not watermarked_file or not os.path.exists(watermarked_file):
+                                failed.append(school.school_name)
+                                continue
+                            
+                            # Create safe filename
+                            school_folder = school.school_name.replace('/', '_').replace('\\', '_')
+                            filename = f"{resource_name}_{school.school_name.replace(' ', '_')}_branded{os.path.splitext(watermarked_file)[1]}"
+                            arcname = f"{school_folder}/{filename}"
+                            
+                            try:
+                                async for chunk in iterate_in_threadpool(zip_stream.add_file(watermarked_file, arcname)):
+                                    yield chunk
+                                processed_count += 1
+                                print(f"Added to ZIP: {arcname}")
+                            finally:
+                                try:
+                                    os.remove(watermarked_file)
+                                except OSError:
+                                    pass
+                finally:
+                    for task in in_flight:
+                        task.cancel()
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                
+                if failed:
+                    report = "Watermarking failed for:\n" + "\n".join(failed) + "\n"
+                    for chunk in zip_stream.add_bytes("errors.txt", report.encode('utf-8')):
+                        yield chunk
+                
+                print(f"ZIP streamed: {processed_count} files, {len(failed)} failed")
+            
+            for chunk in zip_stream.close():
+                yield chunk
+        
+        return StreamingResponse(
+            zip_chunks(),
             media_type="application/zip",
             headers={
-                "Content-Disposition": f"attachment; filename={zip_filename}",
-                "Content-Type": "application/zip",
-                "Content-Length": str(len(zip_content))
+                "Content-Disposition": f"attachment; filename={zip_filename}"
             }
         )
         
@@ -951,6 +1108,118 @@ async def download_batch_watermarked(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
     
+# ==================== BATCH WATERMARK JOB ROUTES ====================
+
+def serialize_watermark_job(job: WatermarkJob, items: List[WatermarkJobItem] = None) -> Dict[str, Any]:
+    result = {
+        "job_id": job.job_id,
+        "status": job.status,
+        "resource_ids": json.loads(job.resource_ids),
+        "school_ids": json.loads(job.school_ids),
+        "total_items": job.total_items,
+        "completed_items": job.completed_items,
+        "failed_items": job.failed_items,
+        "progress": round(100 * (job.completed_items + job.failed_items) / job.total_items, 1) if job.total_items else 0,
+        "artifact_size": job.artifact_size,
+        "download_available": job.status == 'completed' and bool(job.artifact_path),
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "expires_at": job.expires_at.isoformat() if job.expires_at else None
+    }
+    if items is not None:
+        result["items"] = [{
+            "resource_id": item.resource_id,
+            "school_id": item.school_id,
+            "school_name": item.school_name,
+            "status": item.status,
+            "error": item.error,
+            "updated_at": item.updated_at.isoformat() if item.updated_at else None
+        } for item in items]
+    return result
+
+def get_watermark_job_or_404(job_id: str, db: Session) -> WatermarkJob:
+    job = db.query(WatermarkJob).filter(WatermarkJob.job_id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.post("/admin/watermark-jobs")
+async def submit_watermark_job(
+    request: WatermarkJobRequest,
+    db: Session = Depends(get_db)
+):
+    """Queue a background watermark run for one or more resources and schools"""
+    resource_ids = list(dict.fromkeys([request.resource_id] + request.resource_ids))
+    
+    try:
+        job = batch_jobs.create_job(
+            db,
+            resource_ids,
+            request.school_ids,
+            request.positions.model_dump(),
+            created_by=request.created_by
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    
+    print(f"Queued watermark job {job.job_id}: {len(resource_ids)} resources, {job.total_items} items")
+    return serialize_watermark_job(job)
+
+@api_router.get("/admin/watermark-jobs")
+async def list_watermark_jobs(
+    status: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """List recent watermark jobs"""
+    query = db.query(WatermarkJob)
+    if status:
+        query = query.filter(WatermarkJob.status == status)
+    jobs = query.order_by(WatermarkJob.created_at.desc()).limit(50).all()
+    return [serialize_watermark_job(job) for job in jobs]
+
+@api_router.get("/admin/watermark-jobs/{job_id}")
+async def get_watermark_job(job_id: str, db: Session = Depends(get_db)):
+    """Get job status with per-school progress"""
+    job = get_watermark_job_or_404(job_id, db)
+    items = db.query(WatermarkJobItem).filter(
+        WatermarkJobItem.job_id == job_id
+    ).order_by(WatermarkJobItem.id).all()
+    return serialize_watermark_job(job, items)
+
+@api_router.post("/admin/watermark-jobs/{job_id}/cancel")
+async def cancel_watermark_job(job_id: str, db: Session = Depends(get_db)):
+    """Cancel a queued or running job"""
+    job = get_watermark_job_or_404(job_id, db)
+    if not batch_jobs.cancel_job(db, job):
+        raise HTTPException(status_code=400, detail=f"Job is already {job.status}")
+    return {"message": "Job cancelled", "status": "success"}
+
+@api_router.post("/admin/watermark-jobs/{job_id}/resume")
+async def resume_watermark_job(job_id: str, db: Session = Depends(get_db)):
+    """Resume a cancelled or failed job, keeping items that already finished"""
+    job = get_watermark_job_or_404(job_id, db)
+    if not batch_jobs.resume_job(db, job):
+        raise HTTPException(status_code=400, detail=f"Job cannot be resumed while {job.status}")
+    return {"message": "Job resumed", "status": "success"}
+
+@api_router.get("/admin/watermark-jobs/{job_id}/download")
+async def download_watermark_job(job_id: str, db: Session = Depends(get_db)):
+    """Download the ZIP produced by a completed job"""
+    job = get_watermark_job_or_404(job_id, db)
+    
+    if job.status == 'expired':
+        raise HTTPException(status_code=410, detail="Job output has expired")
+    if job.status != 'completed' or not job.artifact_path or not os.path.exists(job.artifact_path):
+        raise HTTPException(status_code=409, detail=f"Job output is not available ({job.status})")
+    
+    return FileResponse(
+        path=job.artifact_path,
+        media_type="application/zip",
+        filename=os.path.basename(job.artifact_path)
+    )
+
 # Add this helper function for creating branded versions of non-image/PDF files:
 def create_branded_version(file_path: str, school: School, positions: WatermarkPosition) -> str:
     """Create a branded version of non-image/PDF files"""
@@ -1018,38 +1287,28 @@ async def download_watermarked_resource(
         # Get original file
         file_path = get_full_file_path(resource.file_path)
         
-        # Create watermarked version
-        watermarked_file = None
-        if resource.file_type and 'pdf' in resource.file_type.lower():
-            watermarked_file = add_watermark_to_pdf(file_path, school, request.positions)
-        else:
-            # For non-PDF files, return original with note
-            # You could implement image watermarking here
-            watermarked_file = file_path
-        
-        if not watermarked_file or not os.path.exists(watermarked_file):
-            raise HTTPException(status_code=500, detail="Failed to create watermarked file")
-        
-        # Read file
-        with open(watermarked_file, 'rb') as f:
-            content = f.read()
-        
-        # Clean up temp file if it was created
-        if watermarked_file != file_path and os.path.exists(watermarked_file):
-            os.remove(watermarked_file)
-        
         # Determine filename
         file_extension = resource.file_type.split('/')[-1] if resource.file_type else 'pdf'
         filename = f"{resource.name.replace(' ', '_')}_{school.school_name.replace(' ', '_')}.{file_extension}"
+        headers = {"Content-Disposition": f"attachment; filename={filename}"}
+        media_type = resource.file_type or "application/octet-stream"
         
-        return Response(
-            content=content,
-            media_type=resource.file_type or "application/octet-stream",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Content-Type": resource.file_type or "application/octet-stream"
-            }
-        )
+        # Create watermarked version on disk; it is streamed and then deleted
+        if resource.file_type and 'pdf' in resource.file_type.lower():
+            watermarked_file = await render_executor.run(
+                render_to_temp_file,
+                functools.partial(add_watermark_to_pdf, file_path, school, resource_branding(request.positions, resource)),
+                '.pdf'
+            )
+            if not watermarked_file:
+                raise HTTPException(status_code=500, detail="Failed to create watermarked file")
+            return TempFileResponse(watermarked_file, media_type=media_type, headers=headers)
+        
+        # For non-PDF files, return original with note
+        # You could implement image watermarking here
+        if not os.path.exists(file_path):
+            raise HTTPException(status_code=500, detail="Failed to create watermarked file")
+        return FileResponse(file_path, media_type=media_type, headers=headers)
         
     except HTTPException:
         raise
@@ -1205,6 +1464,7 @@ async def create_school(
         
         with open(logo_file_path, "wb") as buffer:
             shutil.copyfileobj(logo.file, buffer)
+        await run_in_threadpool(normalize_logo, logo_file_path)
         
         logo_path = f"/uploads/school_logos/{school_id}/{logo_filename}"
     
@@ -1275,6 +1535,7 @@ async def update_school(
         
         with open(logo_file_path, "wb") as buffer:
             shutil.copyfileobj(logo.file, buffer)
+        await run_in_threadpool(normalize_logo, logo_file_path)
         
         school.logo_path = f"/uploads/school_logos/{school_id}/{logo_filename}"
     
@@ -1282,6 +1543,10 @@ async def update_school(
     db.commit()
     db.refresh(school)
     
+    # Branded downloads embed name, email, contact and logo
+    if school_name or email or contact_number is not None or logo:
+        watermark_cache.invalidate_school(school_id, keep_previous=True)
+    
     return school
 
 @api_router.delete("/admin/schools/{school_id}")
@@ -1302,6 +1567,7 @@ async def delete_school(school_id: str, db: Session = Depends(get_db)):
     
     db.delete(school)
     db.commit()
+    watermark_cache.invalidate_school(school_id)
     
     return {"message": "School deleted successfully"}
 
@@ -1363,58 +1629,42 @@ async def upload_resource(
     db: Session = Depends(get_db)
 ):
     """Admin upload resource"""
-    # Validate file size (100MB limit)
-    MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB in bytes
-    
-    # Read file to check size
-    contents = await file.read()
-    file_size = len(contents)
-    
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"File size exceeds 100MB limit. Your file is {file_size / (1024*1024):.2f}MB"
-        )
-    
-    # Reset file pointer
-    await file.seek(0)
-    
     # Generate unique resource ID
     resource_id = str(uuid.uuid4())
     
-    # Create category folder
-    category_folder = RESOURCES_UPLOAD_DIR / category
-    category_folder.mkdir(parents=True, exist_ok=True)
-    
-    # Save file
+    # Save file; identical content already in the blob store is shared
     file_extension = file.filename.split('.')[-1]
-    safe_filename = f"{resource_id}.{file_extension}"
-    file_path_on_disk = category_folder / safe_filename
-    
-    with open(file_path_on_disk, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    file_path = f"/uploads/resources/{category}/{safe_filename}"
-    
-    # Create resource record
-    new_resource = Resource(
-        resource_id=resource_id,
-        name=name,
-        description=description,
-        category=category,
-        file_path=file_path,
-        file_type=file.content_type or f"application/{file_extension}",
-        file_size=file_size,
-        class_level=class_level,
-        tags=tags,
-        uploaded_by_type='admin',
-        approval_status='approved'
-    )
     
-    db.add(new_resource)
-    db.commit()
+    # Streamed in chunks with the 100MB cap enforced as it is written
+    stored = await run_in_threadpool(store_upload, file.file, file_extension)
+    
+    try:
+        # Create resource record
+        new_resource = Resource(
+            resource_id=resource_id,
+            name=name,
+            description=description,
+            category=category,
+            file_path=stored.file_path,
+            file_type=file.content_type or f"application/{file_extension}",
+            file_size=stored.size,
+            file_sha256=stored.sha256,
+            class_level=class_level,
+            tags=tags,
+            uploaded_by_type='admin',
+            approval_status='approved'
+        )
+        
+        db.add(new_resource)
+        db.commit()
+    finally:
+        # The blob can't be released by a concurrent delete until this row exists
+        stored.release()
     db.refresh(new_resource)
     
+    # Card thumbnails are made in the background, next to the stored file
+    schedule_thumbnails(str(blob_disk_path(stored.file_path)), new_resource.file_type)
+    
     return new_resource
 
 @api_router.get("/admin/resources", response_model=List[ResourceResponse])
@@ -1447,6 +1697,9 @@ async def approve_resource(resource_id: str, db: Session = Depends(get_db)):
     resource.updated_at = datetime.utcnow()
     db.commit()
     
+    # Warm the schools' branded copies before they start downloading
+    prebrander.schedule(resource_id)
+    
     return {"message": "Resource approved successfully"}
 
 @api_router.put("/admin/resources/{resource_id}/reject")
@@ -1463,6 +1716,32 @@ async def reject_resource(resource_id: str, db: Session = Depends(get_db)):
     
     return {"message": "Resource rejected"}
 
+@api_router.put("/admin/resources/{resource_id}/branding-mode", response_model=ResourceResponse)
+async def update_resource_branding_mode(
+    resource_id: str,
+    update: BrandingModeUpdate,
+    db: Session = Depends(get_db)
+):
+    """Choose which pages of a PDF resource get branded"""
+    resource = db.query(Resource).filter(Resource.resource_id == resource_id).first()
+    
+    if not resource:
+        raise HTTPException(status_code=404, detail="Resource not found")
+    if update.branding_interval < 1:
+        raise HTTPException(status_code=400, detail="Branding interval must be at least 1")
+    
+    resource.branding_mode = update.branding_mode
+    resource.branding_interval = update.branding_interval
+    resource.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(resource)
+    
+    # Every school's branded copy changes
+    watermark_cache.invalidate_resource(resource_id, keep_previous=True)
+    prebrander.schedule(resource_id)
+    
+    return resource
+
 @api_router.delete("/admin/resources/{resource_id}")
 async def delete_resource(resource_id: str, db: Session = Depends(get_db)):
     """Delete a resource - Admin only"""
@@ -1471,14 +1750,16 @@ async def delete_resource(resource_id: str, db: Session = Depends(get_db)):
     if not resource:
         raise HTTPException(status_code=404, detail="Resource not found")
     
-    # Delete file from disk
-    file_path = ROOT_DIR / resource.file_path.lstrip('/')
-    if file_path.exists():
-        file_path.unlink()
-    
+    file_path = resource.file_path
     db.delete(resource)
     db.commit()
     
+    # The file may be a blob shared with other resources; only the last reference removes it
+    if await run_in_threadpool(release_file, db, file_path):
+        print(f"Deleted resource file {file_path}")
+    watermark_cache.invalidate_resource(resource_id)
+    page_cache.invalidate_resource(resource_id)
+    
     return {"message": "Resource deleted successfully"}
 
 # School Resource Routes
@@ -1519,62 +1800,180 @@ async def school_upload_resource(
     db: Session = Depends(get_db)
 ):
     """School upload resource (requires admin approval)"""
-    # Validate file size (100MB limit)
-    MAX_FILE_SIZE = 100 * 1024 * 1024
+    resource_id = str(uuid.uuid4())
     
-    contents = await file.read()
-    file_size = len(contents)
+    # Save file; identical content already in the blob store is shared
+    file_extension = file.filename.split('.')[-1]
     
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"File size exceeds 100MB limit"
+    stored = await run_in_threadpool(store_upload, file.file, file_extension)
+    
+    try:
+        # Create resource record (pending approval)
+        new_resource = Resource(
+            resource_id=resource_id,
+            name=name,
+            description=description,
+            category=category,
+            file_path=stored.file_path,
+            file_type=file.content_type or f"application/{file_extension}",
+            file_size=stored.size,
+            file_sha256=stored.sha256,
+            class_level=class_level,
+            tags=tags,
+            uploaded_by_type='school',
+            uploaded_by_id=school_id,
+            uploaded_by_name=school_name,
+            approval_status='pending'
         )
+        
+        db.add(new_resource)
+        db.commit()
+    finally:
+        stored.release()
+    db.refresh(new_resource)
     
-    await file.seek(0)
+    schedule_thumbnails(str(blob_disk_path(stored.file_path)), new_resource.file_type)
     
-    resource_id = str(uuid.uuid4())
+    return new_resource
+
+# Resumable Upload Routes (tus-style: create, HEAD for offset, PATCH chunks, finalize)
+def get_upload_session_or_404(db: Session, upload_id: str) -> UploadSession:
+    session = db.query(UploadSession).filter(UploadSession.upload_id == upload_id).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+def upload_offset_headers(session: UploadSession) -> Dict[str, str]:
+    return {
+        "Upload-Offset": str(session.offset),
+        "Upload-Length": str(session.total_size),
+        "Cache-Control": "no-store"
+    }
+
+@api_router.post("/resumable-uploads", status_code=status.HTTP_201_CREATED)
+async def create_resumable_upload(request: ResumableUploadCreate, response: Response, db: Session = Depends(get_db)):
+    """Start a resumable upload; chunks are then sent with PATCH"""
+    if request.uploaded_by_type not in ('admin', 'school'):
+        raise HTTPException(status_code=400, detail="uploaded_by_type must be 'admin' or 'school'")
+    if request.uploaded_by_type == 'school' and not request.school_id:
+        raise HTTPException(status_code=400, detail="school_id is required for school uploads")
+    
+    session = create_session(
+        db,
+        total_size=request.total_size,
+        name=request.name,
+        category=request.category,
+        description=request.description,
+        class_level=request.class_level,
+        tags=request.tags,
+        file_name=request.file_name,
+        file_type=request.file_type,
+        uploaded_by_type=request.uploaded_by_type,
+        uploaded_by_id=request.school_id if request.uploaded_by_type == 'school' else None,
+        uploaded_by_name=request.school_name if request.uploaded_by_type == 'school' else None
+    )
+    print(f"Created upload session {session.upload_id} for {request.file_name} ({request.total_size} bytes)")
     
-    # Create category folder
-    category_folder = RESOURCES_UPLOAD_DIR / category / "school_uploads" / school_id
-    category_folder.mkdir(parents=True, exist_ok=True)
+    response.headers.update(upload_offset_headers(session))
+    response.headers["Location"] = f"/api/resumable-uploads/{session.upload_id}"
+    return {
+        "upload_id": session.upload_id,
+        "offset": session.offset,
+        "total_size": session.total_size,
+        "chunk_size": UPLOAD_CHUNK_BYTES,
+        "expires_at": session.expires_at.isoformat()
+    }
+
+@api_router.head("/resumable-uploads/{upload_id}")
+async def get_resumable_upload_offset(upload_id: str, db: Session = Depends(get_db)):
+    """Current confirmed offset, for resuming after a dropped connection"""
+    session = get_upload_session_or_404(db, upload_id)
+    return Response(status_code=status.HTTP_200_OK, headers=upload_offset_headers(session))
+
+@api_router.patch("/resumable-uploads/{upload_id}")
+async def upload_resumable_chunk(upload_id: str, request: Request, db: Session = Depends(get_db)):
+    """Write the request body at Upload-Offset, streaming it to the staging file"""
+    session = get_upload_session_or_404(db, upload_id)
     
-    # Save file
-    file_extension = file.filename.split('.')[-1]
-    safe_filename = f"{resource_id}.{file_extension}"
-    file_path_on_disk = category_folder / safe_filename
-    
-    with open(file_path_on_disk, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    file_path = f"/uploads/resources/{category}/school_uploads/{school_id}/{safe_filename}"
-    
-    # Create resource record (pending approval)
-    new_resource = Resource(
-        resource_id=resource_id,
-        name=name,
-        description=description,
-        category=category,
-        file_path=file_path,
-        file_type=file.content_type or f"application/{file_extension}",
-        file_size=file_size,
-        class_level=class_level,
-        tags=tags,
-        uploaded_by_type='school',
-        uploaded_by_id=school_id,
-        uploaded_by_name=school_name,
-        approval_status='pending'
-    )
+    offset_header = request.headers.get("upload-offset")
+    if offset_header is None or not offset_header.isdigit():
+        raise HTTPException(status_code=400, detail="Upload-Offset header is required")
     
-    db.add(new_resource)
-    db.commit()
+    await write_chunk(db, session, int(offset_header), request.stream())
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=upload_offset_headers(session))
+
+@api_router.post("/resumable-uploads/{upload_id}/finalize", response_model=ResourceResponse)
+async def finalize_resumable_upload(upload_id: str, db: Session = Depends(get_db)):
+    """Create the resource once every byte has arrived"""
+    session = get_upload_session_or_404(db, upload_id)
+    
+    def finalized_resource():
+        resource = db.query(Resource).filter(Resource.resource_id == session.resource_id).first()
+        if not resource:
+            raise HTTPException(status_code=404, detail="Resource not found")
+        return resource
+    
+    if session.status == 'completed':
+        # Finalize is safe to retry
+        return finalized_resource()
+    
+    resource_id = str(uuid.uuid4())
+    file_extension = session.file_name.split('.')[-1]
+    
+    try:
+        stored = await finalize_session(db, session, file_extension)
+    except FinalizeInProgress:
+        # A concurrent finalize may have finished meanwhile
+        db.refresh(session)
+        if session.status == 'completed':
+            return finalized_resource()
+        raise
+    
+    try:
+        # Same record upload_resource / school_upload_resource create
+        new_resource = Resource(
+            resource_id=resource_id,
+            name=session.name,
+            description=session.description,
+            category=session.category,
+            file_path=stored.file_path,
+            file_type=session.file_type or f"application/{file_extension}",
+            file_size=stored.size,
+            file_sha256=stored.sha256,
+            class_level=session.class_level,
+            tags=session.tags,
+            uploaded_by_type=session.uploaded_by_type,
+            uploaded_by_id=session.uploaded_by_id,
+            uploaded_by_name=session.uploaded_by_name,
+            approval_status='pending' if session.uploaded_by_type == 'school' else 'approved'
+        )
+        db.add(new_resource)
+        
+        session.status = 'completed'
+        session.resource_id = resource_id
+        db.commit()
+    finally:
+        stored.release()
     db.refresh(new_resource)
     
+    schedule_thumbnails(str(blob_disk_path(stored.file_path)), new_resource.file_type)
+    
+    print(f"Finalized upload session {upload_id} as resource {resource_id}")
     return new_resource
 
+@api_router.delete("/resumable-uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_resumable_upload(upload_id: str, db: Session = Depends(get_db)):
+    """Abandon an unfinished upload and free its staging file"""
+    session = get_upload_session_or_404(db, upload_id)
+    if session.status != 'uploading':
+        raise HTTPException(status_code=409, detail="Upload is already finalized")
+    delete_session(db, session)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 @api_router.get("/resources/{resource_id}/download")
 async def download_resource(
     resource_id: str,
+    request: Request,
     school_id: str = None,
     school_name: str = None,
     db: Session = Depends(get_db)
@@ -1626,36 +2025,40 @@ async def download_resource(
         
         print(f"File found at: {full_file_path}, size: {os.path.getsize(full_file_path)} bytes")
         
-        # Log download if school info is provided
-        if school_id and school_name:
-            download_log = ResourceDownload(
-                resource_id=resource_id,
-                school_id=school_id,
-                school_name=school_name
-            )
-            db.add(download_log)
-            
-            # Increment download count
-            resource.download_count += 1
-            db.commit()
-        
         # Determine file extension for download
         file_extension = resource.file_type.split('/')[-1] if resource.file_type else ''
         download_filename = f"{resource.name}"
         if file_extension and not download_filename.endswith(f".{file_extension}"):
             download_filename = f"{download_filename}.{file_extension}"
         
-        # Return the file for download
-        return FileResponse(
-            path=full_file_path,
-            filename=download_filename,
+        # Return the file for download; Range and If-None-Match are honoured
+        response = deliver_file(
+            request,
+            full_file_path,
             media_type=resource.file_type or 'application/octet-stream',
+            content_hash=resource.file_sha256,
+            filename=download_filename,
             headers={
                 "Content-Disposition": f"attachment; filename=\"{download_filename}\"",
                 "Access-Control-Expose-Headers": "Content-Disposition"
             }
         )
         
+        # Log download if school info is provided; resumed ranges and 304s are not new downloads
+        if school_id and school_name and counts_as_download(request, response):
+            download_log = ResourceDownload(
+                resource_id=resource_id,
+                school_id=school_id,
+                school_name=school_name
+            )
+            db.add(download_log)
+            
+            # Increment download count
+            resource.download_count += 1
+            db.commit()
+        
+        return response
+        
     except HTTPException as he:
         print(f"HTTP Exception in download: {he.detail}")
         raise he
@@ -1666,9 +2069,105 @@ async def download_resource(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/resources/{resource_id}/pages/{page_number}")
+async def get_resource_page(
+    resource_id: str,
+    page_number: int,
+    request: Request,
+    width: Optional[int] = None,
+    dpi: Optional[int] = None,
+    format: str = 'webp',
+    db: Session = Depends(get_db)
+):
+    """One page of a PDF resource as an image, so previews don't download the whole document"""
+    resource = db.query(Resource).filter(Resource.resource_id == resource_id).first()
+    if not resource:
+        raise HTTPException(status_code=404, detail="Resource not found")
+    
+    try:
+        file_path = get_full_file_path(resource.file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found on server")
+    if rendered_extension(file_path, resource.file_type) != '.pdf':
+        raise HTTPException(status_code=400, detail="Page previews are only available for PDF resources")
+    
+    if format not in PAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of: {', '.join(PAGE_FORMATS)}")
+    if width is not None and dpi is not None:
+        raise HTTPException(status_code=400, detail="Pass either width or dpi, not both")
+    if dpi is not None and not MIN_PAGE_DPI <= dpi <= MAX_PAGE_DPI:
+        raise HTTPException(status_code=400, detail=f"dpi must be between {MIN_PAGE_DPI} and {MAX_PAGE_DPI}")
+    if dpi is None:
+        width = width or DEFAULT_PAGE_WIDTH
+        if not MIN_PAGE_WIDTH <= width <= MAX_PAGE_WIDTH:
+            raise HTTPException(status_code=400, detail=f"width must be between {MIN_PAGE_WIDTH} and {MAX_PAGE_WIDTH}")
+    
+    total_pages = await run_in_threadpool(page_count, file_path)
+    if not 1 <= page_number <= total_pages:
+        raise HTTPException(status_code=404, detail=f"Page not found, the document has {total_pages} pages")
+    
+    source_digest = resource.file_sha256 or await run_in_threadpool(page_cache.file_digest, file_path)
+    page_file = await ensure_page(resource_id, file_path, source_digest, page_number, width, dpi, format)
+    if not page_file:
+        raise HTTPException(status_code=500, detail="Failed to render page")
+    
+    # Readers usually turn to the next page; have it ready
+    prefetch_neighbours(resource_id, file_path, source_digest, page_number, total_pages, width, dpi, format)
+    
+    return deliver_file(
+        request,
+        page_file,
+        media_type=PAGE_FORMATS[format][1],
+        filename=f"page-{page_number}{PAGE_FORMATS[format][0]}",
+        inline=True,
+        headers={
+            # A resource's file never changes, so its pages can be kept for long
+            "Cache-Control": "public, max-age=604800",
+            "X-Page-Count": str(total_pages)
+        }
+    )
+
+@api_router.get("/resources/{resource_id}/thumbnail")
+async def get_resource_thumbnail(
+    resource_id: str,
+    request: Request,
+    width: int = 320,
+    db: Session = Depends(get_db)
+):
+    """Small card image for a resource: PDF first page, resized image or a type placeholder"""
+    resource = db.query(Resource).filter(Resource.resource_id == resource_id).first()
+    if not resource:
+        raise HTTPException(status_code=404, detail="Resource not found")
+    
+    try:
+        file_path = get_full_file_path(resource.file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found on server")
+    
+    # Browsers that decode WebP say so in Accept; anything else gets JPEG
+    accept = request.headers.get('accept', '')
+    thumbnail_format = 'webp' if not accept or 'image/webp' in accept else 'jpeg'
+    
+    thumbnail_file = await ensure_thumbnail(file_path, resource.file_type, thumbnail_width(width), thumbnail_format)
+    if not thumbnail_file:
+        raise HTTPException(status_code=500, detail="Failed to create thumbnail")
+    
+    return deliver_file(
+        request,
+        thumbnail_file,
+        media_type=THUMBNAIL_FORMATS[thumbnail_format][1],
+        inline=True,
+        headers={
+            # Stored files never change, so neither do their thumbnails
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "Vary": "Accept"
+        }
+    )
+
 @api_router.get("/resources/{resource_id}/preview")
 async def preview_resource(
     resource_id: str,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """Preview a resource file (supports all file types)"""
@@ -1724,13 +2223,15 @@ async def preview_resource(
         
         # Return the file for inline preview with proper headers
         # Using "inline" disposition allows browser to display the file
-        return FileResponse(
-            path=full_file_path,
-            filename=resource.name,
+        return deliver_file(
+            request,
+            full_file_path,
             media_type=file_type,
+            content_hash=resource.file_sha256,
+            filename=resource.name,
+            inline=True,
             headers={
                 "Content-Disposition": f"inline; filename=\"{resource.name}\"",
-                "Accept-Ranges": "bytes",
                 "Cache-Control": "public, max-age=3600"
             }
         )
@@ -1743,6 +2244,35 @@ async def preview_resource(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/signed-files/{file_path:path}")
+async def serve_signed_file(
+    file_path: str,
+    request: Request,
+    expires: int,
+    signature: str,
+    filename: Optional[str] = None,
+    inline: bool = False
+):
+    """Serve a signed URL from FILE_DELIVERY_MODE=signed; nginx normally answers these itself"""
+    if not verify_file_signature(SIGNED_URL_PREFIX + file_path, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+    
+    full_file_path = (ROOT_DIR / file_path).resolve()
+    if not full_file_path.is_relative_to(ROOT_DIR.resolve()) or not full_file_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found on server")
+    
+    import mimetypes
+    headers = {}
+    if filename:
+        disposition = "inline" if inline else "attachment"
+        headers["Content-Disposition"] = f"{disposition}; filename*=UTF-8''{quote(filename)}"
+    return file_response(
+        request,
+        str(full_file_path),
+        media_type=mimetypes.guess_type(str(full_file_path))[0] or 'application/octet-stream',
+        headers=headers
+    )
+
 # Debug endpoint to check file structure
 @api_router.get("/debug/files")
 async def debug_files():
@@ -2070,6 +2600,8 @@ async def save_logo_position(
         print(f"Created new position for school: {school_id}")
     
     db.commit()
+    watermark_cache.invalidate(resource_id, school_id, keep_previous=True)
+    prebrander.schedule(resource_id, [school_id])
     print(f"Logo position saved successfully for school: {school_id}")
     return {"message": message, "status": "success"}
 
@@ -2125,6 +2657,7 @@ async def reset_logo_position(
     if position:
         db.delete(position)
         db.commit()
+        watermark_cache.invalidate(resource_id, school_id)
         print(f"Deleted position for school: {school_id}")
     
     return {"message": "Logo position reset to default"}
@@ -2205,6 +2738,8 @@ async def save_text_watermark_position(
         message = "Text watermark position saved"
     
     db.commit()
+    watermark_cache.invalidate(resource_id, school_id, keep_previous=True)
+    prebrander.schedule(resource_id, [school_id])
     return {"message": message, "status": "success"}
 
 @api_router.get("/school/text-watermark/{resource_id}")
@@ -2249,7 +2784,7 @@ async def get_text_watermark_position(
 # ==================== LOGO WATERMARK ROUTES ====================
 
 def add_logo_watermark(file_path, logo_path, logo_position, file_type, school_info=None, text_position=None):
-    """Add logo and text watermark to a file and return the watermarked file path"""
+    """Add logo and text watermark to a file and return the watermarked bytes"""
     try:
         print(f"=== WATERMARKING FUNCTION ===")
         print(f"File: {file_path}")
@@ -2258,25 +2793,15 @@ def add_logo_watermark(file_path, logo_path, logo_position, file_type, school_in
         print(f"School info: {school_info}")
         print(f"Text position: {text_position}")
         
-        # Create unique temp file path
-        import tempfile
-        temp_dir = tempfile.gettempdir()
-        file_name = os.path.basename(file_path)
-        name, ext = os.path.splitext(file_name)
-        temp_filename = f"{name}_branded{ext}"
-        temp_file_path = os.path.join(temp_dir, temp_filename)
-        
-        print(f"Temp output: {temp_file_path}")
-        
         file_type_lower = file_type.lower() if file_type else ''
         
         # Handle different file types
         if 'pdf' in file_type_lower or file_path.lower().endswith('.pdf'):
             print(f"Processing as PDF")
-            return add_logo_and_text_to_pdf(file_path, logo_path, logo_position, school_info, text_position, temp_file_path)
+            return add_logo_and_text_to_pdf(file_path, logo_path, logo_position, school_info, text_position)
         elif any(img_type in file_type_lower for img_type in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']):
             print(f"Processing as image")
-            return add_logo_and_text_to_image(file_path, logo_path, logo_position, school_info, text_position, temp_file_path)
+            return add_logo_and_text_to_image(file_path, logo_path, logo_position, file_type, school_info, text_position)
         else:
             print(f"Unsupported file type for watermarking: {file_type}")
             return None
@@ -2287,8 +2812,8 @@ def add_logo_watermark(file_path, logo_path, logo_position, file_type, school_in
         traceback.print_exc()
         return None
 
-def add_logo_and_text_to_pdf(pdf_path, logo_path, logo_position, school_info, text_position, output_path):
-    """Add logo and text to PDF"""
+def add_logo_and_text_to_pdf(pdf_path, logo_path, logo_position, school_info, text_position, output: BinaryIO = None):
+    """Add logo and text to PDF; writes to output when given, otherwise returns the PDF bytes"""
     try:
         print(f"=== ADDING LOGO AND TEXT TO PDF ===")
         print(f"PDF: {pdf_path}")
@@ -2300,47 +2825,24 @@ def add_logo_and_text_to_pdf(pdf_path, logo_path, logo_position, school_info, te
         
         pdf_document = fitz.open(pdf_path)
         
-        # Open logo image if exists
-        logo_img = None
-        if logo_path and os.path.exists(logo_path):
-            logo_img = Image.open(logo_path)
-            print(f"Original logo size: {logo_img.size}")
-            
-            # Convert logo to RGBA if needed
-            if logo_img.mode != 'RGBA':
-                logo_img = logo_img.convert('RGBA')
-            
-            # Apply opacity
-            if logo_position.opacity < 1.0:
-                alpha = logo_img.split()[3]
-                alpha = alpha.point(lambda p: p * logo_position.opacity)
-                logo_img.putalpha(alpha)
-                print(f"Applied opacity: {logo_position.opacity}")
-        
         # Get first page for dimensions
         first_page = pdf_document[0]
         page_width = first_page.rect.width
         page_height = first_page.rect.height
         print(f"Page dimensions: {page_width}x{page_height}")
         
+        # Resized, opacity-applied logo PNG from the logo cache
+        logo = None
+        if logo_path and os.path.exists(logo_path):
+            logo = logo_png(logo_path, int(page_width * (logo_position.width / 100)), logo_position.opacity)
+        
         # Add logo if exists
-        if logo_img:
-            # Calculate logo size
-            logo_width_pixels = int(page_width * (logo_position.width / 100))
-            aspect_ratio = logo_img.width / logo_img.height
-            logo_height_pixels = int(logo_width_pixels / aspect_ratio)
-            
+        if logo:
+            logo_png_bytes, logo_width_pixels, logo_height_pixels = logo
             print(f"Resized logo: {logo_width_pixels}x{logo_height_pixels}")
             
-            # Resize logo
-            logo_img = logo_img.resize((logo_width_pixels, logo_height_pixels), Image.Resampling.LANCZOS)
-            
-            # Convert to bytes
-            logo_bytes = io.BytesIO()
-            logo_img.save(logo_bytes, format='PNG')
-            logo_bytes.seek(0)
-            
-            # Add logo to each page
+            # Add logo to each page; the image is embedded once and reused by xref
+            logo_xref = 0
             for page_num in range(len(pdf_document)):
                 page = pdf_document[page_num]
                 x_position = page.rect.width * (logo_position.x_position / 100)
@@ -2355,7 +2857,10 @@ def add_logo_and_text_to_pdf(pdf_path, logo_path, logo_position, school_info, te
                     y_position + (logo_height_pixels / 2)
                 )
                 
-                page.insert_image(rect, stream=logo_bytes.getvalue())
+                if logo_xref:
+                    page.insert_image(rect, xref=logo_xref)
+                else:
+                    logo_xref = page.insert_image(rect, stream=logo_png_bytes)
         
         # Add text watermarks if school info exists
         if school_info and text_position:
@@ -2399,14 +2904,16 @@ def add_logo_and_text_to_pdf(pdf_path, logo_path, logo_position, school_info, te
                     print(f"Page {page_num+1}: Contact info at ({contact_x}, {contact_y})")
         
         # Save watermarked PDF
-        pdf_document.save(output_path)
+        if output is not None:
+            pdf_document.save(output)
+            result = output
+        else:
+            result = pdf_document.tobytes()
         pdf_document.close()
         
-        print(f"Saved watermarked PDF to: {output_path}")
-        print(f"File exists: {os.path.exists(output_path)}")
-        print(f"File size: {os.path.getsize(output_path)} bytes")
+        print(f"Rendered watermarked PDF: {pdf_path}")
         
-        return output_path
+        return result
         
     except Exception as e:
         print(f"Error adding logo and text to PDF: {str(e)}")
@@ -2421,9 +2928,14 @@ def add_logo_and_text_to_image(
     file_type: str,
     school_info: Dict[str, str],
     text_position: Dict[str, Any],
-    output_path: str = None
-) -> str:
-    """Add logo and text watermark to image"""
+    output: BinaryIO = None,
+    cancel: Optional[RenderToken] = None
+) -> Union[bytes, BinaryIO, None]:
+    """Add logo and text watermark to image.
+    
+    Writes the image to output when given and returns it, otherwise returns the image bytes.
+    Raises RenderCancelled after decoding if cancel has been cancelled by then.
+    """
     try:
         print(f"=== ADDING LOGO AND TEXT TO IMAGE ===")
         print(f"Image: {image_path}")
@@ -2431,44 +2943,28 @@ def add_logo_and_text_to_image(
         print(f"School Info: {school_info}")
         print(f"Text Position: {text_position}")
         
-        # Open base image
-        base_img = Image.open(image_path)
-        
-        # Convert to RGBA if not already
-        if base_img.mode != 'RGBA':
-            base_img = base_img.convert('RGBA')
+        # Open base image as RGB within the per-render pixel budget
+        base_img = open_rgb_bounded(image_path)
         
         print(f"Base image size: {base_img.size}, mode: {base_img.mode}")
+        if cancel is not None:
+            cancel.check()
         
-        # Create a transparent layer for watermarks
-        watermark_layer = Image.new('RGBA', base_img.size, (255, 255, 255, 0))
+        # Logo and text are rendered into small tiles and blended over just the pixels they cover
+        tiles = []
         
         # Add logo if exists
         if logo_path and os.path.exists(logo_path):
             try:
-                logo_img = Image.open(logo_path)
-                if logo_img.mode != 'RGBA':
-                    logo_img = logo_img.convert('RGBA')
-                
-                # Apply opacity
-                if positions.logo_opacity < 1.0:
-                    alpha = logo_img.split()[3]
-                    alpha = alpha.point(lambda p: p * positions.logo_opacity)
-                    logo_img.putalpha(alpha)
-                
-                # Calculate logo size and position
+                # Calculate logo size; the logo cache keeps the aspect ratio
                 base_width, base_height = base_img.size
-                logo_width = int(base_width * (positions.logo_width / 100))
-                
-                # Maintain aspect ratio
-                aspect_ratio = logo_img.width / logo_img.height
-                logo_height = int(logo_width / aspect_ratio)
+                logo_img = logo_image(logo_path, int(base_width * (positions.logo_width / 100)), positions.logo_opacity)
+                if logo_img is None:
+                    raise ValueError("logo could not be loaded")
+                logo_width, logo_height = logo_img.size
                 
                 print(f"Logo size: {logo_width}x{logo_height}")
                 
-                # Resize logo
-                logo_img = logo_img.resize((logo_width, logo_height), Image.Resampling.LANCZOS)
-                
                 # Calculate position
                 x_position = int(base_width * (positions.logo_x / 100) - (logo_width / 2))
                 y_position = int(base_height * (positions.logo_y / 100) - (logo_height / 2))
@@ -2479,45 +2975,26 @@ def add_logo_and_text_to_image(
                 
                 print(f"Logo position: {x_position}, {y_position}")
                 
-                # Paste logo onto watermark layer
-                watermark_layer.paste(logo_img, (x_position, y_position), logo_img)
+                tiles.append(StampTile(x_position, y_position, logo_img))
                 
             except Exception as logo_error:
                 print(f"Error adding logo: {logo_error}")
         
-        # Add text watermarks
-        from PIL import ImageDraw, ImageFont
-        
-        draw = ImageDraw.Draw(watermark_layer)
-        
-        # Try to load a font
-        try:
-            # Use default font
-            font_name = ImageFont.truetype("arial.ttf", text_position['name_size']) if os.name == 'nt' else ImageFont.load_default()
-            font_contact = ImageFont.truetype("arial.ttf", text_position['contact_size']) if os.name == 'nt' else ImageFont.load_default()
-        except:
-            font_name = ImageFont.load_default()
-            font_contact = ImageFont.load_default()
-        
         # Add school name
         if school_info.get('school_name'):
             name_x = int(base_img.width * (text_position['name_x'] / 100))
             name_y = int(base_img.height * (text_position['name_y'] / 100))
             
             # Calculate text size for centering
-            from PIL import ImageDraw
-            temp_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
-            bbox = temp_draw.textbbox((0, 0), school_info['school_name'], font=font_name)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+            text_width, text_height = text_size(school_info['school_name'], text_position['name_size'])
             
             name_x -= text_width // 2
             name_y -= text_height // 2
             
             # Draw text with opacity
             name_color = (0, 0, 0, int(255 * text_position['name_opacity']))
-            draw.text((name_x, name_y), school_info['school_name'], 
-                     font=font_name, fill=name_color)
+            tiles.append(text_tile(name_x, name_y, school_info['school_name'],
+                                   text_position['name_size'], name_color))
             print(f"School name at ({name_x}, {name_y})")
         
         # Add contact info
@@ -2533,48 +3010,165 @@ def add_logo_and_text_to_image(
             contact_y = int(base_img.height * (text_position['contact_y'] / 100))
             
             # Calculate text size for centering
-            temp_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
-            bbox = temp_draw.multiline_textbbox((0, 0), contact_text, font=font_contact)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+            text_width, text_height = text_size(contact_text, text_position['contact_size'])
             
             contact_x -= text_width // 2
             contact_y -= text_height // 2
             
             # Draw text with opacity
             contact_color = (0, 0, 0, int(255 * text_position['contact_opacity']))
-            draw.multiline_text((contact_x, contact_y), contact_text,
-                              font=font_contact, fill=contact_color, align='center')
+            tiles.append(text_tile(contact_x, contact_y, contact_text,
+                                   text_position['contact_size'], contact_color, align='center'))
             print(f"Contact info at ({contact_x}, {contact_y})")
         
-        # Combine base image with watermark layer
-        watermarked_img = Image.alpha_composite(base_img, watermark_layer)
-        
-        # Convert back to original mode if needed
-        if 'RGB' in base_img.mode:
-            watermarked_img = watermarked_img.convert('RGB')
+        watermarked_img = composite_tiles(base_img, tiles)
         
-        # Save to output path or temp file
-        if not output_path:
-            temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-            output_path = temp_file.name
-            temp_file.close()
+        # Save to the caller's stream or an in-memory buffer, in the source's format
+        target = output if output is not None else io.BytesIO()
+        encode_image(watermarked_img, target, image_profile(image_path, file_type))
         
-        watermarked_img.save(output_path, quality=95)
-        
-        print(f"Saved watermarked image to: {output_path}")
-        print(f"File size: {os.path.getsize(output_path)} bytes")
-        return output_path
+        print(f"Rendered watermarked image: {image_path}")
+        return output if output is not None else target.getvalue()
         
+    except RenderCancelled:
+        raise
     except Exception as e:
         print(f"Error adding logo and text to image: {str(e)}")
         import traceback
         traceback.print_exc()
         return None
 
+class BrandedRender(NamedTuple):
+    """How one school's branded copy of a resource is rendered"""
+    positions: WatermarkPosition
+    branding_version: str
+    output_ext: str
+    render: Callable[[BinaryIO], Any]
+    
+    def cache_key(self, source_digest: str) -> str:
+        # Same source, branding and positions always render the same output
+        return watermark_cache.make_key(source_digest, self.branding_version, self.positions.model_dump())
+
+def branded_render_plan(db: Session, resource: Resource, school: School, full_file_path: str) -> Optional[BrandedRender]:
+    """The school's branded render of a resource, or None if it downloads the original.
+    
+    Only schools that saved a logo or text position for the resource get a branded
+    copy; the defaults fill in whichever of the two is missing.
+    """
+    # Get logo position
+    logo_position_db = db.query(SchoolLogoPosition).filter(
+        SchoolLogoPosition.school_id == school.school_id,
+        SchoolLogoPosition.resource_id == resource.resource_id
+    ).first()
+    
+    # Get text watermark position
+    text_position_db = db.query(SchoolWatermarkText).filter(
+        SchoolWatermarkText.school_id == school.school_id,
+        SchoolWatermarkText.resource_id == resource.resource_id
+    ).first()
+    
+    if not logo_position_db and not text_position_db:
+        return None
+    
+    # Use saved positions or defaults
+    if logo_position_db:
+        logo_positions = {
+            'x_position': logo_position_db.x_position,
+            'y_position': logo_position_db.y_position,
+            'width': logo_position_db.width,
+            'opacity': logo_position_db.opacity
+        }
+        print(f"Using saved logo position: {logo_positions}")
+    else:
+        # Default logo position
+        logo_positions = {
+            'x_position': 50,
+            'y_position': 10,
+            'width': 20,
+            'opacity': 0.7
+        }
+        print(f"Using default logo position: {logo_positions}")
+    
+    if text_position_db:
+        text_positions = {
+            'name_x': text_position_db.name_x,
+            'name_y': text_position_db.name_y,
+            'name_size': text_position_db.name_size,
+            'name_opacity': text_position_db.name_opacity,
+            'contact_x': text_position_db.contact_x,
+            'contact_y': text_position_db.contact_y,
+            'contact_size': text_position_db.contact_size,
+            'contact_opacity': text_position_db.contact_opacity
+        }
+        print(f"Using saved text position: {text_positions}")
+    else:
+        # Default text position
+        text_positions = {
+            'name_x': 50,
+            'name_y': 25,
+            'name_size': 20,
+            'name_opacity': 0.8,
+            'contact_x': 50,
+            'contact_y': 90,
+            'contact_size': 12,
+            'contact_opacity': 0.7
+        }
+        print(f"Using default text position: {text_positions}")
+    
+    file_type_lower = resource.file_type.lower() if resource.file_type else ''
+    is_pdf = 'pdf' in file_type_lower or full_file_path.lower().endswith('.pdf')
+    is_image = any(img_type in file_type_lower for img_type in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp'])
+    if not (is_pdf or is_image):
+        print(f"File type {resource.file_type} not supported for watermarking, using original")
+        return None
+    
+    logo_path = get_school_logo_path(school)
+    
+    watermark_positions = WatermarkPosition(
+        logo_x=logo_positions['x_position'],
+        logo_y=logo_positions['y_position'],
+        logo_width=logo_positions['width'],
+        logo_opacity=logo_positions['opacity'],
+        school_name_x=text_positions['name_x'],
+        school_name_y=text_positions['name_y'],
+        school_name_size=text_positions['name_size'],
+        school_name_opacity=text_positions['name_opacity'],
+        contact_x=text_positions['contact_x'],
+        contact_y=text_positions['contact_y'],
+        contact_size=text_positions['contact_size'],
+        contact_opacity=text_positions['contact_opacity']
+    )
+    watermark_positions = resource_branding(watermark_positions, resource)
+    
+    if is_pdf:
+        render = functools.partial(add_watermark_to_pdf, full_file_path, school, watermark_positions)
+    else:
+        school_info = {
+            'school_name': school.school_name,
+            'email': school.email,
+            'contact_number': school.contact_number
+        }
+        render = functools.partial(
+            add_logo_and_text_to_image,
+            full_file_path,
+            logo_path,
+            watermark_positions,
+            resource.file_type,
+            school_info,
+            text_positions
+        )
+    
+    return BrandedRender(
+        positions=watermark_positions,
+        branding_version=watermark_cache.branding_version(school, logo_path),
+        output_ext=rendered_extension(full_file_path, resource.file_type),
+        render=render
+    )
+
 @api_router.get("/resources/{resource_id}/download-with-logo")
 async def download_resource_with_logo(
     resource_id: str,
+    request: Request,
     school_id: str = None,
     school_name: str = None,
     db: Session = Depends(get_db)
@@ -2629,169 +3223,54 @@ async def download_resource_with_logo(
         
         print(f"Final file path: {full_file_path}")
         
-        # Check if we should add watermark
-        should_add_watermark = False
+        # Only schools that positioned their branding on this resource get a branded copy
         watermarked_file = None
         
         if school and school_id and resource_id:
-            # Get logo position
-            logo_position_db = db.query(SchoolLogoPosition).filter(
-                SchoolLogoPosition.school_id == school_id,
-                SchoolLogoPosition.resource_id == resource_id
-            ).first()
-            
-            # Get text watermark position
-            text_position_db = db.query(SchoolWatermarkText).filter(
-                SchoolWatermarkText.school_id == school_id,
-                SchoolWatermarkText.resource_id == resource_id
-            ).first()
-            
-            # Prepare positions
-            logo_positions = None
-            text_positions = None
-            
-            # Use saved positions or defaults
-            if logo_position_db:
-                logo_positions = {
-                    'x_position': logo_position_db.x_position,
-                    'y_position': logo_position_db.y_position,
-                    'width': logo_position_db.width,
-                    'opacity': logo_position_db.opacity
-                }
-                should_add_watermark = True
-                print(f"Using saved logo position: {logo_positions}")
-            else:
-                # Default logo position
-                logo_positions = {
-                    'x_position': 50,
-                    'y_position': 10,
-                    'width': 20,
-                    'opacity': 0.7
-                }
-                print(f"Using default logo position: {logo_positions}")
-            
-            if text_position_db:
-                text_positions = {
-                    'name_x': text_position_db.name_x,
-                    'name_y': text_position_db.name_y,
-                    'name_size': text_position_db.name_size,
-                    'name_opacity': text_position_db.name_opacity,
-                    'contact_x': text_position_db.contact_x,
-                    'contact_y': text_position_db.contact_y,
-                    'contact_size': text_position_db.contact_size,
-                    'contact_opacity': text_position_db.contact_opacity
-                }
-                should_add_watermark = True
-                print(f"Using saved text position: {text_positions}")
-            else:
-                # Default text position
-                text_positions = {
-                    'name_x': 50,
-                    'name_y': 25,
-                    'name_size': 20,
-                    'name_opacity': 0.8,
-                    'contact_x': 50,
-                    'contact_y': 90,
-                    'contact_size': 12,
-                    'contact_opacity': 0.7
-                }
-                print(f"Using default text position: {text_positions}")
-            
-            # Get school logo path
-            logo_path = None
-            if school and school.logo_path:
-                logo_path = school.logo_path
-                if logo_path.startswith('/'):
-                    logo_path = logo_path[1:]
-                logo_full_path = os.path.join(ROOT_DIR, logo_path)
-                if os.path.exists(logo_full_path):
-                    logo_path = logo_full_path
-                    print(f"Logo found at: {logo_path}")
-                else:
-                    print(f"Logo not found at: {logo_full_path}")
-                    logo_path = None
-            
-            # Prepare school info
-            school_info = {
-                'school_name': school.school_name,
-                'email': school.email,
-                'contact_number': school.contact_number
-            }
+            plan = branded_render_plan(db, resource, school, full_file_path)
             
-            # Create WatermarkPosition object
-            watermark_positions = WatermarkPosition(
-                logo_x=logo_positions['x_position'],
-                logo_y=logo_positions['y_position'],
-                logo_width=logo_positions['width'],
-                logo_opacity=logo_positions['opacity'],
-                school_name_x=text_positions['name_x'],
-                school_name_y=text_positions['name_y'],
-                school_name_size=text_positions['name_size'],
-                school_name_opacity=text_positions['name_opacity'],
-                contact_x=text_positions['contact_x'],
-                contact_y=text_positions['contact_y'],
-                contact_size=text_positions['contact_size'],
-                contact_opacity=text_positions['contact_opacity']
-            )
-            
-            # Apply watermark based on file type
-            if should_add_watermark:
+            if plan:
                 print(f"Applying watermark to file type: {resource.file_type}")
+                # Blob-stored resources already carry their content hash
+                source_digest = resource.file_sha256 or await run_in_threadpool(watermark_cache.file_digest, full_file_path)
+                cache_key = plan.cache_key(source_digest)
+                watermarked_file = watermark_cache.get(resource_id, school_id, cache_key, plan.output_ext)
                 
-                file_type_lower = resource.file_type.lower() if resource.file_type else ''
-                
-                # For PDF files
-                if 'pdf' in file_type_lower or full_file_path.lower().endswith('.pdf'):
-                    print("Applying watermark to PDF")
-                    watermarked_file = add_watermark_to_pdf(full_file_path, school, watermark_positions)
-                
-                # For image files
-                elif any(img_type in file_type_lower for img_type in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']):
-                    print("Applying watermark to image")
-                    watermarked_file = add_logo_and_text_to_image(
-                        full_file_path,
-                        logo_path,
-                        watermark_positions,
-                        resource.file_type,
-                        school_info,
-                        text_positions,
-                        None  # Will create temp file
-                    )
-                
+                if watermarked_file:
+                    print(f"Watermark cache hit: {watermarked_file}")
                 else:
-                    print(f"File type {resource.file_type} not supported for watermarking, using original")
+                    # Rendered straight into the cache entry, once for all concurrent requests,
+                    # and stopped early if every one of them leaves or runs out of time
+                    try:
+                        watermarked_file = await await_render(request, watermark_cache.render_once(
+                            resource_id, school_id, cache_key, plan.output_ext, plan.render, cancellable=True
+                        ))
+                    except RenderCancelled as cancelled:
+                        if cancelled.reason == 'disconnected':
+                            print("Client left before the branded copy was ready")
+                            return Response(status_code=499)
+                        
+                        if WATERMARK_DEADLINE_FALLBACK not in ('cached', 'original'):
+                            raise HTTPException(status_code=503, detail="Branded copy is taking too long, please retry later")
+                        # A copy rendered before the school's branding or positions last changed
+                        watermarked_file = watermark_cache.latest(resource_id, school_id, plan.output_ext)
+                        if not watermarked_file and WATERMARK_DEADLINE_FALLBACK != 'original':
+                            raise HTTPException(status_code=503, detail="Branded copy is taking too long, please retry later")
+                        print(f"Render deadline passed, falling back to {watermarked_file or 'the original'}")
         
         # Use watermarked file if created successfully
         if watermarked_file and os.path.exists(watermarked_file):
             print(f"Watermarked file created: {watermarked_file}")
             final_file_path = watermarked_file
             filename_suffix = "_branded"
+            content_hash = None  # Validators come from the cache entry's mtime and size
+            media_type = rendered_media_type(full_file_path, resource.file_type)
         else:
             print(f"Using original file")
             final_file_path = full_file_path
             filename_suffix = ""
-        
-        # Log download
-        if school_id and school_name:
-            download_log = ResourceDownload(
-                resource_id=resource_id,
-                school_id=school_id,
-                school_name=school_name
-            )
-            db.add(download_log)
-            resource.download_count += 1
-            db.commit()
-        
-        # Read file content
-        with open(final_file_path, 'rb') as f:
-            file_content = f.read()
-        
-        # Clean up temp watermarked file if created
-        if watermarked_file and watermarked_file != full_file_path and os.path.exists(watermarked_file):
-            try:
-                os.remove(watermarked_file)
-            except:
-                pass
+            content_hash = resource.file_sha256
+            media_type = resource.file_type or 'application/octet-stream'
         
         # Determine download filename
         file_extension = os.path.splitext(resource.name)[1]
@@ -2800,20 +3279,39 @@ async def download_resource_with_logo(
                 file_extension = "." + resource.file_type.split('/')[-1]
             else:
                 file_extension = ".pdf"
+        if media_type != (resource.file_type or '').lower():
+            # e.g. a GIF or TIFF is branded as PNG; name it for what it is
+            file_extension = os.path.splitext(final_file_path)[1]
         
         download_filename = f"{resource.name.replace(' ', '_')}{filename_suffix}{file_extension}"
         
-        print(f"Returning file: {download_filename}, size: {len(file_content)} bytes")
+        print(f"Returning file: {download_filename}, size: {os.path.getsize(final_file_path)} bytes")
         
-        return Response(
-            content=file_content,
-            media_type=resource.file_type or 'application/octet-stream',
+        # Watermarked output lives in the cache, so a repeat download is just a file send
+        response = deliver_file(
+            request,
+            final_file_path,
+            media_type=media_type,
+            content_hash=content_hash,
+            filename=download_filename,
             headers={
-                "Content-Disposition": f"attachment; filename=\"{download_filename}\"",
-                "Content-Length": str(len(file_content))
+                "Content-Disposition": f"attachment; filename=\"{download_filename}\""
             }
         )
         
+        # Log download; resumed ranges and 304s are not new downloads
+        if school_id and school_name and counts_as_download(request, response):
+            download_log = ResourceDownload(
+                resource_id=resource_id,
+                school_id=school_id,
+                school_name=school_name
+            )
+            db.add(download_log)
+            resource.download_count += 1
+            db.commit()
+        
+        return response
+        
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -2994,6 +3492,12 @@ async def debug_logo_position(
         "updated_at": position.updated_at.isoformat() if position.updated_at else None
     }
 
+# Debug endpoint for the rendering queue
+@api_router.get("/debug/render-queue")
+async def debug_render_queue():
+    """Debug endpoint to check render workers and queued renders"""
+    return render_executor.stats()
+
 @api_router.get("/")
 async def root():
     return {"message": "Wonder Learning Digital Library API"}
@@ -3001,6 +3505,12 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Cap upload bodies before the multipart form is parsed
+app.add_middleware(
+    UploadLimitMiddleware,
+    paths=["/api/admin/resources/upload", "/api/school/resources/upload"]
+)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -3008,7 +3518,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"]
+    expose_headers=["Content-Disposition", "Location", "Upload-Offset", "Upload-Length", "ETag", "Last-Modified", "Content-Range", "Accept-Ranges", "X-Page-Count", "X-Preview-Base"]
 )
 
 # Add CORS headers to all responses
@@ -3017,8 +3527,8 @@ async def add_cors_header(request, call_next):
     response = await call_next(request)
     response.headers["Access-Control-Allow-Origin"] = "https://koshquest.in"
     response.headers["Access-Control-Allow-Credentials"] = "true"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response.headers["Access-Control-Allow-Methods"] = "GET, HEAD, POST, PUT, PATCH, DELETE, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, Upload-Offset, Upload-Length, Range, If-Range, If-None-Match, If-Modified-Since"
     return response
 
 # Serve static files from the uploads directory
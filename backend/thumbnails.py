@@ -0,0 +1,173 @@
+"""
+Thumbnails for resource cards, generated when a resource is uploaded.
+
+Listing pages used to load full originals (or embed whole PDFs) just to draw
+a 150px card. Each upload now queues, at batch priority, small derivatives
+stored next to the original file:
+
+    <name>.thumb-<width>.webp    first page of a PDF, or the image resized,
+                                 or a labelled placeholder for other types
+
+at each of THUMBNAIL_WIDTHS. JPEG variants are made on demand for clients
+that don't accept WebP. Files in the blob store never change, so neither do
+their thumbnails, and /api/resources/{id}/thumbnail serves them as immutable.
+Derivatives missing after a restart, or for files uploaded before thumbnails
+existed, are generated on first request: also at batch priority, waiting
+for a slot rather than failing, and once per file however many cards ask.
+"""
+import os
+import uuid
+import asyncio
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageOps
+
+from font_registry import get_font, text_size
+from render_executor import render_executor, BATCH
+
+THUMBNAIL_WIDTHS = sorted(int(width) for width in os.environ.get('THUMBNAIL_WIDTHS', '160,320,640').split(','))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+# (source, format) -> the task generating its derivatives, so each is generated once
+_generating: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+def thumbnail_path(file_path: str, width: int, thumbnail_format: str = 'webp') -> str:
+    """Disk path of a derivative, next to the original"""
+    base, _ = os.path.splitext(file_path)
+    extension = 'jpg' if thumbnail_format == 'jpeg' else thumbnail_format
+    return f"{base}.thumb-{width}.{extension}"
+
+
+def thumbnail_width(requested: int) -> int:
+    """The smallest generated width that covers the requested one"""
+    for width in THUMBNAIL_WIDTHS:
+        if width >= requested:
+            return width
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def remove_thumbnails(file_path: str):
+    """Delete every derivative of an original"""
+    original = Path(file_path)
+    for derivative in original.parent.glob(f"{original.stem}.thumb-*"):
+        derivative.unlink(missing_ok=True)
+
+
+def _is_pdf(file_path: str, file_type: Optional[str]) -> bool:
+    return 'pdf' in (file_type or '').lower() or file_path.lower().endswith('.pdf')
+
+
+def _is_image(file_type: Optional[str]) -> bool:
+    return (file_type or '').lower().startswith('image/') and 'svg' not in (file_type or '').lower()
+
+
+def _pdf_first_page(file_path: str, width: int) -> Image.Image:
+    with fitz.open(file_path) as pdf_document:
+        page = pdf_document[0]
+        zoom = width / page.rect.width
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def _image_source(file_path: str, width: int) -> Image.Image:
+    with Image.open(file_path) as image:
+        # Decode JPEGs straight at a reduced scale; thumbnail() reduces the rest
+        image.draft('RGB', (width, width * 4))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width * 4))
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Transparent areas show as white on the card
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+
+
+def _placeholder(file_path: str, width: int) -> Image.Image:
+    """Grey card labelled with the file extension"""
+    height = width * 3 // 4
+    image = Image.new('RGB', (width, height), (240, 240, 240))
+    label = (os.path.splitext(file_path)[1].lstrip('.') or 'file').upper()[:5]
+    size = max(10, width // 6)
+    text_width, text_height = text_size(label, size, 'bold')
+    draw = ImageDraw.Draw(image)
+    draw.text(((width - text_width) // 2, (height - text_height) // 2), label, font=get_font(size, 'bold'), fill=(150, 150, 150))
+    return image
+
+
+def generate_thumbnails(file_path: str, file_type: Optional[str], formats: Iterable[str] = ('webp',)) -> List[str]:
+    """Write every configured width of a file's thumbnail and return the paths; blocking"""
+    largest = THUMBNAIL_WIDTHS[-1]
+    try:
+        if _is_pdf(file_path, file_type):
+            source = _pdf_first_page(file_path, largest)
+        elif _is_image(file_type):
+            source = _image_source(file_path, largest)
+        else:
+            source = _placeholder(file_path, largest)
+    except Exception as e:
+        print(f"Could not read {file_path} for thumbnails, using a placeholder: {e}")
+        source = _placeholder(file_path, largest)
+
+    written = []
+    for width in THUMBNAIL_WIDTHS:
+        image = source.copy()
+        image.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+        for thumbnail_format in formats:
+            path = thumbnail_path(file_path, width, thumbnail_format)
+            # Staged and renamed, so a concurrent reader never sees half a file
+            staging_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                image.save(staging_path, format=THUMBNAIL_FORMATS[thumbnail_format][0], quality=THUMBNAIL_QUALITY)
+                os.replace(staging_path, path)
+            finally:
+                if os.path.exists(staging_path):
+                    os.remove(staging_path)
+            written.append(path)
+    return written
+
+
+async def ensure_thumbnail(file_path: str, file_type: Optional[str], width: int, thumbnail_format: str = 'webp') -> Optional[str]:
+    """Path of a thumbnail, generating the file's derivatives now if it is missing"""
+    path = thumbnail_path(file_path, width, thumbnail_format)
+    if not os.path.exists(path):
+        # Shared with other requests for the same file; one leaving doesn't cancel it
+        await asyncio.shield(_generate(file_path, file_type, thumbnail_format))
+    return path if os.path.exists(path) else None
+
+
+async def _generate_in_background(file_path: str, file_type: Optional[str], thumbnail_format: str):
+    try:
+        # A grid of older resources asks for many at once; wait for a batch slot rather than fail
+        await render_executor.run(
+            generate_thumbnails, file_path, file_type, (thumbnail_format,), priority=BATCH, enforce_queue_limit=False
+        )
+        print(f"Generated thumbnails for {file_path}")
+    except Exception as e:
+        print(f"Error generating thumbnails for {file_path}: {e}")
+
+
+def _generate(file_path: str, file_type: Optional[str], thumbnail_format: str) -> asyncio.Task:
+    """The task generating a file's derivatives in one format, started if none is running"""
+    key = (file_path, thumbnail_format)
+    task = _generating.get(key)
+    if task is None:
+        task = _generating[key] = asyncio.create_task(_generate_in_background(file_path, file_type, thumbnail_format))
+        task.add_done_callback(lambda _: _generating.pop(key, None))
+    return task
+
+
+def schedule_thumbnails(file_path: str, file_type: Optional[str]):
+    """Queue thumbnail generation for a newly stored file"""
+    if os.path.exists(thumbnail_path(file_path, THUMBNAIL_WIDTHS[-1])):
+        return  # Deduplicated upload of a blob that already has them
+    _generate(file_path, file_type, 'webp')
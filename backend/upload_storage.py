@@ -0,0 +1,147 @@
+"""
+Streaming, size-capped storage for uploaded resource files.
+
+Uploads are copied to disk in fixed-size chunks while their size and SHA-256
+are computed, into a staging file that is committed to the content-addressed
+blob store only once the whole file has arrived. Oversized requests
+are refused by UploadLimitMiddleware from Content-Length before the body is
+parsed, or as soon as the running body size passes the cap.
+"""
+import os
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+from typing import NamedTuple, Iterable, Optional
+
+from fastapi import HTTPException, status
+from starlette.responses import JSONResponse
+
+from blob_store import BlobLock, new_staging_path, commit_blob
+
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 100 * 1024 * 1024))
+
+# Allowance for the other form fields and multipart boundaries around the file
+FORM_OVERHEAD_BYTES = 1024 * 1024
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(HTTPException):
+    """Raised when an upload goes past the size cap"""
+
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES):
+        super().__init__(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File size exceeds {max_bytes / (1024 * 1024):g}MB limit"
+        )
+
+
+class StoredUpload(NamedTuple):
+    file_path: str  # Public path of the content-addressed blob
+    size: int
+    sha256: str
+    # Held until the Resource row is committed, so the blob can't be released meanwhile
+    lock: Optional[BlobLock] = None
+
+    def release(self):
+        """Let go of the blob's lock; call once the referencing row is committed (or abandoned)"""
+        if self.lock is not None:
+            self.lock.release()
+
+
+def store_upload(source, file_extension: str, max_bytes: int = MAX_UPLOAD_BYTES) -> StoredUpload:
+    """Copy a file object into the blob store in chunks, hashing as it goes.
+
+    Blocking; call through run_in_threadpool. Nothing is stored if the copy
+    fails or the file is larger than max_bytes. The result holds the blob's
+    lock: commit the Resource row, then call release().
+    """
+    # Staged on the blob filesystem so the final rename is atomic
+    staging_path = new_staging_path(f"{uuid.uuid4().hex}.part")
+
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(staging_path, 'wb') as output:
+            for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                sha.update(chunk)
+                output.write(chunk)
+        lock = BlobLock(sha.hexdigest())
+        try:
+            file_path = commit_blob(staging_path, sha.hexdigest(), file_extension)
+        except Exception:
+            lock.release()
+            raise
+    finally:
+        if staging_path.exists():
+            os.remove(staging_path)
+
+    return StoredUpload(file_path=file_path, size=size, sha256=sha.hexdigest(), lock=lock)
+
+
+def promote_file(source_path: Path, file_extension: str) -> StoredUpload:
+    """Hash a fully received file and move it into the blob store; the result holds the blob's lock"""
+    sha = hashlib.sha256()
+    size = 0
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            size += len(chunk)
+            sha.update(chunk)
+
+    # A rename when both share a filesystem, a copy otherwise
+    staging_path = new_staging_path(f"{uuid.uuid4().hex}.part")
+    shutil.move(str(source_path), str(staging_path))
+    lock = BlobLock(sha.hexdigest())
+    try:
+        file_path = commit_blob(staging_path, sha.hexdigest(), file_extension)
+    except Exception:
+        lock.release()
+        raise
+    finally:
+        if staging_path.exists():
+            os.remove(staging_path)
+    return StoredUpload(file_path=file_path, size=size, sha256=sha.hexdigest(), lock=lock)
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware capping the request body size of upload routes.
+
+    The form is parsed (and the file spooled) before a route handler runs, so
+    the limit has to be enforced here to stop oversized uploads early.
+    """
+
+    def __init__(self, app, paths: Iterable[str], max_body_bytes: int = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES):
+        self.app = app
+        self.paths = set(paths)
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            error = UploadTooLarge()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    # Surfaces from request.form() and is turned into a 413 response
+                    raise UploadTooLarge()
+            return message
+
+        await self.app(scope, limited_receive, send)
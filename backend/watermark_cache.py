@@ -0,0 +1,324 @@
+"""
+Content-addressed on-disk cache for watermarked resource downloads
+
+A missing entry is rendered once however many requests want it at the same
+time: callers in one process share a single in-flight render, and workers
+in other processes wait on a lock file next to the entry and pick up the
+output of whichever worker got there first.
+"""
+import os
+import json
+import fcntl
+import asyncio
+import hashlib
+import functools
+import threading
+import uuid
+import time
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, Any, Callable, BinaryIO
+
+from render_executor import render_executor, RenderToken, INTERACTIVE
+
+ROOT_DIR = Path(__file__).parent
+
+# Bump when the watermark renderers change their output so stale entries miss
+RENDER_VERSION = "5"
+
+# Name an invalidated directory's newest entry is kept under, for deadline fallbacks
+PREVIOUS_ENTRY = "previous"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class _Flight:
+    """A render in progress and how many callers are waiting for it"""
+
+    def __init__(self, priority: int, task: asyncio.Task, token: Optional[RenderToken]):
+        self.priority = priority
+        self.task = task
+        self.token = token
+        self.waiters = 0
+
+
+class WatermarkCache:
+    """Stores rendered outputs under <root>/<resource_id>/<school_id>/<key><ext>
+    and evicts least recently used entries once the total size passes max_bytes."""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        # (path, size, mtime_ns) -> sha256, so unchanged files are hashed once per process
+        self._digests: Dict[tuple, str] = {}
+        # Entry path -> the render producing it in this process
+        self._in_flight: Dict[str, _Flight] = {}
+
+    # ---------- keys ----------
+
+    def file_digest(self, path: str) -> str:
+        """SHA-256 of a file, memoized on (path, size, mtime)"""
+        stat = os.stat(path)
+        memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(memo_key)
+        if digest:
+            return digest
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self._digests[memo_key] = digest
+        return digest
+
+    def branding_version(self, school, logo_path: Optional[str]) -> str:
+        """Version of everything about a school that ends up on the page"""
+        logo_digest = self.file_digest(logo_path) if logo_path and os.path.exists(logo_path) else None
+        branding = {
+            'school_name': school.school_name,
+            'email': school.email,
+            'contact_number': school.contact_number,
+            'logo': logo_digest,
+        }
+        return hashlib.sha256(json.dumps(branding, sort_keys=True).encode()).hexdigest()[:16]
+
+    def make_key(self, source_digest: str, branding_version: str, positions: Dict[str, Any]) -> str:
+        """Combine source content, school branding and effective positions into one key"""
+        payload = json.dumps({
+            'render_version': RENDER_VERSION,
+            'source': source_digest,
+            'branding': branding_version,
+            'positions': positions,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    # ---------- entries ----------
+
+    def _entry_dir(self, resource_id: str, school_id: str) -> Path:
+        return self.root / resource_id / school_id
+
+    def _entry_path(self, resource_id: str, school_id: str, key: str, ext: str) -> Path:
+        return self._entry_dir(resource_id, school_id) / f"{key}{ext}"
+
+    def get(self, resource_id: str, school_id: str, key: str, ext: str) -> Optional[str]:
+        """Return the cached file path and mark it as recently used, or None"""
+        path = self._entry_path(resource_id, school_id, key, ext)
+        try:
+            # Recency lives in atime so mtime stays the render time, which
+            # Last-Modified and ETag validators are derived from; set in ns,
+            # as a float mtime would round and change st_mtime_ns on every hit
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            return None
+        return str(path)
+
+    def latest(self, resource_id: str, school_id: str, ext: str) -> Optional[str]:
+        """Most recently rendered variant of a resource for a school, whatever its key.
+
+        Includes the copy kept by an invalidation with keep_previous, even
+        though its inputs have changed since.
+        """
+        newest, newest_mtime = None, 0
+        entry_dir = self._entry_dir(resource_id, school_id)
+        for path in entry_dir.glob(f"*{ext}") if entry_dir.exists() else ():
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if not path.name.startswith('.') and mtime > newest_mtime:
+                newest, newest_mtime = path, mtime
+        return self.get(resource_id, school_id, newest.stem, ext) if newest else None
+
+    @contextmanager
+    def _entry_lock(self, entry_dir: Path, key: str, ext: str):
+        """Hold an exclusive lock on one entry across processes"""
+        lock_path = entry_dir / f".{key}{ext}.lock"
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # The previous holder removes the file on release; retry on a fresh one if so
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        try:
+            yield
+        finally:
+            lock_path.unlink(missing_ok=True)
+            lock_file.close()
+
+    def render_into(self, resource_id: str, school_id: str, key: str, ext: str, render: Callable[[BinaryIO], Any]) -> Optional[str]:
+        """Call render(stream) on a staging file and publish it atomically as the cached entry.
+
+        Blocks while another process renders the same entry and then returns its output.
+        Returns the cached path, or None (leaving nothing behind) if render fails.
+        """
+        entry_dir = self._entry_dir(resource_id, school_id)
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        final_path = self._entry_path(resource_id, school_id, key, ext)
+
+        with self._entry_lock(entry_dir, key, ext):
+            if final_path.exists():
+                print(f"Reusing entry rendered by another worker: {final_path}")
+                return self.get(resource_id, school_id, key, ext)
+
+            # Stage next to the final path so the rename is atomic
+            staging_path = entry_dir / f".{uuid.uuid4().hex}.tmp"
+            try:
+                with open(staging_path, 'wb') as output:
+                    rendered = render(output)
+                if not rendered:
+                    return None
+                os.replace(staging_path, final_path)
+            finally:
+                if staging_path.exists():
+                    os.remove(staging_path)
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += final_path.stat().st_size
+        self._evict_if_needed(keep=final_path)
+        return str(final_path)
+
+    async def render_once(self, resource_id: str, school_id: str, key: str, ext: str, render: Callable[..., Any],
+                          priority: int = INTERACTIVE, enforce_queue_limit: bool = True,
+                          cancellable: bool = False) -> Optional[str]:
+        """render_into on a render worker, shared by every concurrent caller asking for the same entry.
+
+        With cancellable, render also gets cancel=RenderToken, which is cancelled
+        once every caller waiting for it has been cancelled.
+        """
+        path = str(self._entry_path(resource_id, school_id, key, ext))
+        flight = self._in_flight.get(path)
+        # A more urgent caller doesn't queue behind a batch render, and nobody joins one
+        # being cancelled; the entry lock still makes whichever starts second reuse the output
+        if flight and flight.priority <= priority and not (flight.token and flight.token.reason):
+            print(f"Joining in-flight render of {path}")
+        else:
+            token = RenderToken() if cancellable else None
+            if token:
+                render = functools.partial(render, cancel=token)
+            task = asyncio.ensure_future(render_executor.run(
+                self.render_into, resource_id, school_id, key, ext, render,
+                priority=priority, enforce_queue_limit=enforce_queue_limit
+            ))
+            flight = self._in_flight[path] = _Flight(priority, task, token)
+            task.add_done_callback(lambda done: self._end_flight(path, done))
+
+        flight.waiters += 1
+        try:
+            # One caller going away doesn't cancel the others' render
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError as cancelled:
+            if flight.waiters == 1 and flight.token and not flight.task.done():
+                # Nobody wants it any more: stop the loop if running, drop it if still queued
+                flight.token.cancel(cancelled.args[0] if cancelled.args else 'abandoned')
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _end_flight(self, path: str, task: asyncio.Task):
+        flight = self._in_flight.get(path)
+        if flight and flight.task is task:
+            del self._in_flight[path]
+        if not task.cancelled():
+            task.exception()  # Retrieved, in case every caller has gone
+
+    # ---------- invalidation ----------
+
+    # With keep_previous, the newest entry of each directory is kept as
+    # PREVIOUS_ENTRY so latest() can still offer it when a fresh render runs
+    # past its deadline; it is evicted like any other entry.
+
+    def invalidate(self, resource_id: str, school_id: str, keep_previous: bool = False):
+        """Drop every cached variant of one resource for one school"""
+        self._invalidate_dir(self._entry_dir(resource_id, school_id), keep_previous)
+
+    def invalidate_resource(self, resource_id: str, keep_previous: bool = False):
+        """Drop every cached variant of a resource, for all schools"""
+        if keep_previous:
+            for school_dir in (self.root / resource_id).glob("*"):
+                self._invalidate_dir(school_dir, keep_previous)
+        else:
+            self._remove_tree(self.root / resource_id)
+
+    def invalidate_school(self, school_id: str, keep_previous: bool = False):
+        """Drop every cached variant branded for a school"""
+        for school_dir in self.root.glob(f"*/{school_id}"):
+            self._invalidate_dir(school_dir, keep_previous)
+
+    def _invalidate_dir(self, entry_dir: Path, keep_previous: bool):
+        if not keep_previous:
+            self._remove_tree(entry_dir)
+            return
+        try:
+            entries = [path for path in entry_dir.iterdir() if path.is_file() and not path.name.startswith('.')]
+        except FileNotFoundError:
+            return
+        newest = max(entries, key=lambda path: path.stat().st_mtime, default=None)
+        for path in entries:
+            # Lock and staging files (dot-files) of renders in progress are left alone
+            if path == newest:
+                os.replace(path, entry_dir / f"{PREVIOUS_ENTRY}{path.suffix}")
+            else:
+                path.unlink(missing_ok=True)
+        with self._lock:
+            self._total_bytes = None
+
+    def _remove_tree(self, path: Path):
+        if path.exists():
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self._total_bytes = None
+
+    # ---------- eviction ----------
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat
+
+    def _evict_if_needed(self, keep: Path = None):
+        with self._lock:
+            if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+                return
+
+            entries = list(self._entries())
+            total = sum(stat.st_size for _, stat in entries)
+            if total > self.max_bytes:
+                # Oldest access first; get() touches atime on every hit
+                entries.sort(key=lambda entry: entry[1].st_atime)
+                for path, stat in entries:
+                    if total <= self.max_bytes:
+                        break
+                    if keep is not None and path == str(keep):
+                        continue
+                    try:
+                        os.remove(path)
+                        total -= stat.st_size
+                        print(f"Evicted watermark cache entry: {path}")
+                    except FileNotFoundError:
+                        pass
+            self._total_bytes = total
+
+
+watermark_cache = WatermarkCache(
+    root=Path(os.environ.get('WATERMARK_CACHE_DIR', ROOT_DIR / "cache" / "watermarked")),
+    max_bytes=int(os.environ.get('WATERMARK_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)),
+)
@@ -0,0 +1,305 @@
+"""
+Compiled watermark stamps for PDFs.
+
+A school's logo, name and contact block are rendered once into a one-page PDF
+of the target page size. Every page of a document then references that page
+through show_pdf_page, so the logo is decoded, resized and embedded once per
+document instead of once per page.
+
+A resource's branding mode decides which pages get the stamp. Long documents
+can be branded on the first and/or last page, on every Nth page, or not
+stamped at all but given a generated cover page, which is compiled once per
+school and page size and inserted in front with insert_pdf.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from logo_assets import logo_png, logo_version
+
+# Compiled stamps kept per process, keyed by branding, positions and page size
+STAMP_CACHE_SIZE = int(os.environ.get('WATERMARK_STAMP_CACHE_SIZE', 128))
+
+_stamp_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+_stamp_lock = threading.Lock()
+
+# Which pages of a PDF are branded
+BRANDING_MODES = ('every_page', 'cover_page', 'first_page', 'last_page', 'first_last', 'every_nth')
+DEFAULT_BRANDING_MODE = 'every_page'
+# Fields of the positions that choose pages rather than change the stamp
+BRANDING_FIELDS = {'branding_mode', 'branding_interval'}
+
+
+def _stamp_key(school_info: Dict[str, str], logo_path: Optional[str], positions, page_width: float, page_height: float):
+    return (
+        school_info.get('school_name'),
+        school_info.get('email'),
+        school_info.get('contact_number'),
+        logo_version(logo_path),
+        tuple(sorted(positions.model_dump(exclude=BRANDING_FIELDS).items())),
+        round(page_width, 2),
+        round(page_height, 2),
+    )
+
+
+def _draw_stamp(school_info: Dict[str, str], logo_path: Optional[str], positions, page_width: float, page_height: float) -> "fitz.Document":
+    """Draw logo, school name and contact info onto a blank page of the given size"""
+    stamp_doc = fitz.open()
+    page = stamp_doc.new_page(width=page_width, height=page_height)
+
+    # Add logo if available
+    if logo_path and os.path.exists(logo_path):
+        try:
+            logo_width_pixels = int(page_width * (positions.logo_width / 100))
+            logo = logo_png(logo_path, logo_width_pixels, positions.logo_opacity)
+            if logo:
+                png, logo_width_pixels, logo_height_pixels = logo
+
+                # Position logo
+                x_position = page_width * (positions.logo_x / 100)
+                y_position = page_height * (positions.logo_y / 100)
+                rect = fitz.Rect(
+                    x_position - (logo_width_pixels / 2),
+                    y_position - (logo_height_pixels / 2),
+                    x_position + (logo_width_pixels / 2),
+                    y_position + (logo_height_pixels / 2)
+                )
+                page.insert_image(rect, stream=png)
+        except Exception as e:
+            print(f"Error adding logo to stamp: {e}")
+
+    # Add school name
+    try:
+        school_name_x = page_width * (positions.school_name_x / 100)
+        school_name_y = page_height * (positions.school_name_y / 100)
+        rect = fitz.Rect(
+            school_name_x - 200,
+            school_name_y - 20,
+            school_name_x + 200,
+            school_name_y + 20
+        )
+        page.insert_textbox(
+            rect,
+            f"{school_info.get('school_name')}",
+            fontsize=positions.school_name_size * 0.75,  # Convert to points
+            color=(0, 0, 0, positions.school_name_opacity),
+            align=1  # Center aligned
+        )
+    except Exception as e:
+        print(f"Error adding school name to stamp: {e}")
+
+    # Add contact info
+    contact_text = f"{school_info.get('email')}"
+    if school_info.get('contact_number'):
+        contact_text += f"\n{school_info['contact_number']}"
+
+    try:
+        contact_x = page_width * (positions.contact_x / 100)
+        contact_y = page_height * (positions.contact_y / 100)
+        contact_rect = fitz.Rect(
+            contact_x - 200,
+            contact_y - 30,
+            contact_x + 200,
+            contact_y + 30
+        )
+        page.insert_textbox(
+            contact_rect,
+            contact_text,
+            fontsize=positions.contact_size * 0.75,  # Convert to points
+            color=(0, 0, 0, positions.contact_opacity),
+            align=1  # Center aligned
+        )
+    except Exception as e:
+        print(f"Error adding contact info to stamp: {e}")
+
+    return stamp_doc
+
+
+def _render_stamp(school_info: Dict[str, str], logo_path: Optional[str], positions, page_width: float, page_height: float) -> bytes:
+    """The stamp page as compact PDF bytes"""
+    with _draw_stamp(school_info, logo_path, positions, page_width, page_height) as stamp_doc:
+        return stamp_doc.tobytes(garbage=3, deflate=True)
+
+
+def _compiled(key: tuple, render) -> bytes:
+    """Cached result of render() for key, kept in the per-process stamp LRU"""
+    with _stamp_lock:
+        stamp_bytes = _stamp_cache.get(key)
+        if stamp_bytes is not None:
+            _stamp_cache.move_to_end(key)
+            return stamp_bytes
+
+    stamp_bytes = render()
+
+    with _stamp_lock:
+        _stamp_cache[key] = stamp_bytes
+        _stamp_cache.move_to_end(key)
+        while len(_stamp_cache) > STAMP_CACHE_SIZE:
+            _stamp_cache.popitem(last=False)
+
+    return stamp_bytes
+
+
+def compile_stamp(school_info: Dict[str, str], logo_path: Optional[str], positions, page_width: float, page_height: float) -> bytes:
+    """Return the one-page stamp PDF for a school and page size, rendering it on first use"""
+    key = _stamp_key(school_info, logo_path, positions, page_width, page_height)
+    return _compiled(key, lambda: _render_stamp(school_info, logo_path, positions, page_width, page_height))
+
+
+def _fit_textbox(page: "fitz.Page", rect: "fitz.Rect", text: str, fontsize: float, **options) -> float:
+    """insert_textbox, shrinking the font until the text fits; returns the height used"""
+    for _ in range(6):
+        spare = page.insert_textbox(rect, text, fontsize=fontsize, **options)
+        if spare >= 0:
+            return rect.height - spare
+        fontsize *= 0.85
+    return 0
+
+
+def _render_cover(school_info: Dict[str, str], logo_path: Optional[str], page_width: float, page_height: float) -> bytes:
+    """A cover page: the logo, school name and contact details centred on a blank page"""
+    with fitz.open() as cover_doc:
+        page = cover_doc.new_page(width=page_width, height=page_height)
+        margin = page_width * 0.1
+        y = page_height * 0.22
+
+        if logo_path and os.path.exists(logo_path):
+            try:
+                logo = logo_png(logo_path, int(page_width * 0.4), 1.0)
+                if logo:
+                    png, logo_width, logo_height = logo
+                    # Keep tall logos from pushing the text off the page
+                    scale = min(1.0, page_height * 0.3 / logo_height)
+                    logo_width, logo_height = logo_width * scale, logo_height * scale
+                    page.insert_image(fitz.Rect(
+                        (page_width - logo_width) / 2, y, (page_width + logo_width) / 2, y + logo_height
+                    ), stream=png)
+                    y += logo_height + page_height * 0.05
+            except Exception as e:
+                print(f"Error adding logo to cover: {e}")
+
+        name_size = page_width / 18
+        y += _fit_textbox(
+            page,
+            fitz.Rect(margin, y, page_width - margin, y + name_size * 4),
+            school_info.get('school_name') or '',
+            name_size,
+            fontname='hebo',
+            align=1
+        ) + name_size
+
+        contact_lines = [line for line in (school_info.get('email'), school_info.get('contact_number')) if line]
+        contact_size = page_width / 40
+        _fit_textbox(
+            page,
+            fitz.Rect(margin, y, page_width - margin, y + contact_size * 4),
+            "\n".join(contact_lines),
+            contact_size,
+            color=(0.3, 0.3, 0.3),
+            align=1
+        )
+        return cover_doc.tobytes(garbage=3, deflate=True)
+
+
+def compile_cover(school_info: Dict[str, str], logo_path: Optional[str], page_width: float, page_height: float) -> bytes:
+    """Return a school's one-page cover PDF for a page size, rendering it on first use"""
+    key = (
+        'cover',
+        school_info.get('school_name'),
+        school_info.get('email'),
+        school_info.get('contact_number'),
+        logo_version(logo_path),
+        round(page_width, 2),
+        round(page_height, 2),
+    )
+    return _compiled(key, lambda: _render_cover(school_info, logo_path, page_width, page_height))
+
+
+def branded_pages(page_count: int, mode: Optional[str], interval: Optional[int] = None) -> List[int]:
+    """0-based numbers of the pages a branding mode stamps (none for cover_page)"""
+    mode = mode or DEFAULT_BRANDING_MODE
+    if mode == 'cover_page' or page_count == 0:
+        return []
+    if mode == 'first_page':
+        return [0]
+    if mode == 'last_page':
+        return [page_count - 1]
+    if mode == 'first_last':
+        return sorted({0, page_count - 1})
+    if mode == 'every_nth':
+        # The first page and every Nth page after it
+        return list(range(0, page_count, max(1, interval or 1)))
+    return list(range(page_count))
+
+
+def render_stamp_overlay(school_info: Dict[str, str], logo_path: Optional[str], positions,
+                         page_width: float, page_height: float, width: int) -> bytes:
+    """Transparent PNG of just the stamp for a page size, scaled to width pixels.
+
+    Used by the positioning editor, which layers it over a cached raster of
+    the page instead of re-watermarking the whole document on every change.
+    Drawn directly rather than through compile_stamp, so slider positions
+    never evict the compiled stamps real downloads use.
+    """
+    with _draw_stamp(school_info, logo_path, positions, page_width, page_height) as stamp_doc:
+        zoom = width / page_width
+        pixmap = stamp_doc[0].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=True)
+    overlay = Image.frombytes('RGBA', (pixmap.width, pixmap.height), pixmap.samples)
+    png = io.BytesIO()
+    overlay.save(png, format='PNG')
+    return png.getvalue()
+
+
+def apply_stamp(pdf_document: "fitz.Document", school_info: Dict[str, str], logo_path: Optional[str], positions,
+                cancel=None, pages: Optional[Iterable[int]] = None) -> int:
+    """Overlay the compiled stamp on the given pages (default all) and return how many were stamped.
+
+    cancel (a RenderToken) is checked before each page, so an abandoned render stops early.
+    """
+    if pages is None:
+        pages = range(len(pdf_document))
+    # One opened stamp per page size; reusing the same source document lets
+    # PyMuPDF embed it once and reference it from every page
+    stamp_docs = {}
+    stamped = 0
+    try:
+        for page_number in pages:
+            if cancel is not None:
+                cancel.check()
+            page = pdf_document[page_number]
+            size = (round(page.rect.width, 2), round(page.rect.height, 2))
+            stamp_doc = stamp_docs.get(size)
+            if stamp_doc is None:
+                stamp_bytes = compile_stamp(school_info, logo_path, positions, page.rect.width, page.rect.height)
+                stamp_doc = fitz.open("pdf", stamp_bytes)
+                stamp_docs[size] = stamp_doc
+
+            page.show_pdf_page(page.rect, stamp_doc, 0, overlay=True)
+            stamped += 1
+
+        return stamped
+    finally:
+        for stamp_doc in stamp_docs.values():
+            stamp_doc.close()
+
+
+def apply_branding(pdf_document: "fitz.Document", school_info: Dict[str, str], logo_path: Optional[str], positions,
+                   cancel=None) -> int:
+    """Brand a PDF according to positions.branding_mode and return the number of pages branded"""
+    mode = getattr(positions, 'branding_mode', None) or DEFAULT_BRANDING_MODE
+    if mode == 'cover_page':
+        if len(pdf_document) == 0:
+            return 0
+        first_page = pdf_document[0].rect
+        cover_bytes = compile_cover(school_info, logo_path, first_page.width, first_page.height)
+        with fitz.open("pdf", cover_bytes) as cover_doc:
+            pdf_document.insert_pdf(cover_doc, start_at=0)
+        return 1
+
+    pages = branded_pages(len(pdf_document), mode, getattr(positions, 'branding_interval', None))
+    return apply_stamp(pdf_document, school_info, logo_path, positions, cancel, pages)
@@ -0,0 +1,78 @@
+"""
+Streaming ZIP writer.
+
+zipfile can write to an unseekable stream (it falls back to data
+descriptors), so entries are written into a small in-memory sink that is
+drained after every chunk. The caller yields those chunks straight into a
+StreamingResponse instead of building the archive on disk first.
+"""
+import os
+import zipfile
+from typing import Iterator
+
+CHUNK_SIZE = 1024 * 1024
+
+# Formats that are already compressed; DEFLATE only burns CPU on these
+STORED_EXTENSIONS = {
+    '.pdf', '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp4', '.mov', '.m4v', '.webm', '.mp3', '.m4a', '.aac',
+    '.zip', '.gz', '.7z', '.rar',
+    '.docx', '.xlsx', '.pptx',
+}
+
+
+def compress_type_for(filename: str) -> int:
+    """ZIP_STORED for already-compressed formats, ZIP_DEFLATED otherwise"""
+    ext = os.path.splitext(filename)[1].lower()
+    return zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+class _ChunkSink:
+    """Write-only file object that buffers bytes until drained"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, mode='w', allowZip64=True)
+
+    def add_file(self, path: str, arcname: str) -> Iterator[bytes]:
+        """Write one file into the archive, yielding output as it is produced"""
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = compress_type_for(arcname)
+
+        with open(path, 'rb') as src, self._zip.open(zinfo, mode='w') as dest:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dest.write(chunk)
+                data = self._sink.drain()
+                if data:
+                    yield data
+
+        data = self._sink.drain()
+        if data:
+            yield data
+
+    def add_bytes(self, arcname: str, content: bytes) -> Iterator[bytes]:
+        """Write a small in-memory entry, e.g. a summary text file"""
+        self._zip.writestr(arcname, content, compress_type=compress_type_for(arcname))
+        yield self._sink.drain()
+
+    def close(self) -> Iterator[bytes]:
+        """Write the central directory"""
+        self._zip.close()
+        yield self._sink.drain()
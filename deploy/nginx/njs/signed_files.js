@@ -0,0 +1,34 @@
+// Verifies /api/signed-files/ URLs issued by the API (FILE_DELIVERY_MODE=signed)
+// and hands valid ones to the internal file location, so nginx serves the
+// download without a round trip to Python. Must match sign_file_path in
+// backend/file_delivery.py: hex HMAC-SHA256 of "<expires>:<decoded uri>".
+import crypto from 'crypto';
+
+const PREFIX = '/api/signed-files/';
+
+function serve(r) {
+    const key = process.env.FILE_SIGNING_KEY;
+    const expires = parseInt(r.args.expires, 10);
+
+    if (!key || !expires || !r.args.signature) {
+        r.return(403);
+        return;
+    }
+    if (expires < Date.now() / 1000) {
+        r.return(410);
+        return;
+    }
+
+    const expected = crypto.createHmac('sha256', key)
+        .update(expires + ':' + r.uri)
+        .digest('hex');
+    if (expected !== r.args.signature) {
+        r.return(403);
+        return;
+    }
+
+    // Keep the query string so the internal location can set Content-Disposition
+    r.internalRedirect('/internal-files/' + r.uri.slice(PREFIX.length) + '?' + r.variables.args);
+}
+
+export default { serve };
@@ -1371,6 +1371,8 @@ const SchoolResourceCategory = ({ user }) => {
 
   const renderThumbnail = (resource) => {
     const fileUrl = resource.file_path;
+    // Small derivative generated at upload instead of the full original
+    const thumbnailUrl = `${API}/resources/${resource.resource_id}/thumbnail?width=320`;
     const fileType = resource.file_type?.toLowerCase() || '';
     const fileExtension = fileUrl?.split('.').pop()?.toLowerCase() || '';
 
@@ -1389,15 +1391,17 @@ const SchoolResourceCategory = ({ user }) => {
           }}
         >
           <div style={{ position: 'relative', width: '100%', height: '100%' }}>
-            <iframe
-              src={`${fileUrl}#page=1&toolbar=0&navpanes=0&scrollbar=0&zoom=50`}
+            <img
+              src={thumbnailUrl}
+              alt={resource.name}
+              loading="lazy"
               style={{
                 width: '100%',
                 height: '100%',
-                border: 'none',
+                objectFit: 'cover',
+                objectPosition: 'top',
                 pointerEvents: 'none'
               }}
-              title={`PDF thumbnail - ${resource.name}`}
             />
             <div style={{
               position: 'absolute',
@@ -1423,8 +1427,9 @@ const SchoolResourceCategory = ({ user }) => {
       return (
         <div style={{ position: 'relative', height: '150px', overflow: 'hidden' }}>
           <img
-            src={fileUrl}
+            src={thumbnailUrl}
             alt={resource.name}
+            loading="lazy"
             style={{
               width: '100%',
               height: '100%',